@@ -0,0 +1,102 @@
+import bisect
+import numpy as np
+
+# Rec. 709 luminance weights; a light's share of the samples is proportional to its area times emitted luminance.
+LUMINANCE = np.array([0.2126, 0.7152, 0.0722])
+
+
+class AreaLights:
+    """
+    Emissive triangles of a scene, sampled directly by the path tracer (next-event estimation).
+
+    A triangle is a light if its material record is emissive (MaterialRecord.is_emissive), the same test the path
+    tracer applies when a path hits it. Lights are emitting on both sides.
+    Coincident copies of the same emissive triangle are sampled once, otherwise every copy would add its emission.
+    A light is picked with probability proportional to its power (area times emitted luminance) and a point is then
+    drawn uniformly on it, so the density of a sampled point with respect to area is luminance / total power for every
+    point of every light.
+
+    Attributes:
+        face_index (np.ndarray): (L,) buffer indices of the emissive triangles.
+        emission (np.ndarray): (L, 3) emitted radiance of every light.
+        cdf (np.ndarray): (L,) cumulative selection probabilities.
+        area_pdf (np.ndarray): (N,) area density of the light sampler on every triangle of the buffer (on all copies
+            of a light), 0 on triangles that are not lights. Used for the MIS weight when a BSDF-sampled path hits
+            a light.
+    """
+    def __init__(self, triangles):
+        self.triangles = triangles
+        table = triangles.material_table
+        candidates = np.flatnonzero(table.is_emissive[triangles.material_index])
+        # coincident copies of a light are kept once; a path hitting them only ever sees one of them
+        keys = [tuple(sorted(map(tuple, tri))) for tri in np.round(triangles.vertices[candidates], 6).tolist()]
+        first = {}
+        copy_of = np.array([first.setdefault(key, idx) for idx, key in enumerate(keys)], dtype=np.int64)
+        unique = np.flatnonzero(copy_of == np.arange(len(candidates)))
+        self.face_index = candidates[unique]
+        self.emission = table.emission[triangles.material_index[self.face_index]]
+
+        luminance = np.maximum(self.emission @ LUMINANCE, 0.0)
+        area = 0.5 * np.linalg.norm(triangles.normal[self.face_index], axis=1)
+        power = area * luminance
+        total_power = power.sum()
+        self.area_pdf = np.zeros(len(triangles.material_index), dtype=np.float64)
+        if total_power > 0:
+            self.cdf = np.cumsum(power) / total_power
+            light_pdf = np.zeros(len(candidates), dtype=np.float64)
+            light_pdf[unique] = luminance / total_power
+            self.area_pdf[candidates] = light_pdf[copy_of]
+        else:
+            self.cdf = np.empty(0)
+        # plain lists for the scalar path tracer, which samples one light at a time
+        self._cdf = self.cdf.tolist()
+        self._area_pdf = self.area_pdf.tolist()
+
+    def __len__(self):
+        return len(self.cdf)
+
+    def pdf(self, face_index: int) -> float:
+        """
+        Area density with which sample() produces a point on the triangle face_index of the buffer.
+        """
+        return self._area_pdf[face_index]
+
+    def sample(self, u: float, u1: float, u2: float):
+        """
+        Picks a light with the uniform number u and a point on it with u1 and u2.
+
+        Returns:
+            tuple: (buffer index of the light, point as a list, area density of the point).
+        """
+        light = min(bisect.bisect_right(self._cdf, u), len(self._cdf) - 1)
+        face_index = int(self.face_index[light])
+        if u1 + u2 > 1:
+            u1, u2 = 1 - u1, 1 - u2
+        v0 = self.triangles.v0[face_index]
+        point = (v0 + u1 * self.triangles.edge1[face_index] + u2 * self.triangles.edge2[face_index]).tolist()
+        return face_index, point, self._area_pdf[face_index]
+
+    def sample_packet(self, u: np.ndarray, u1: np.ndarray, u2: np.ndarray):
+        """
+        Vectorized sample() for arrays of uniform numbers.
+
+        Returns:
+            tuple: (face_index, points, pdf) arrays of shape (R,), (R, 3) and (R,).
+        """
+        light = np.minimum(np.searchsorted(self.cdf, u, side='right'), len(self.cdf) - 1)
+        face_index = self.face_index[light]
+        u1, u2 = np.array(u1, dtype=np.float64), np.array(u2, dtype=np.float64)
+        fold = u1 + u2 > 1
+        u1[fold], u2[fold] = 1 - u1[fold], 1 - u2[fold]
+        points = (self.triangles.v0[face_index] + u1[:, None] * self.triangles.edge1[face_index]
+                  + u2[:, None] * self.triangles.edge2[face_index])
+        return face_index, points, self.area_pdf[face_index]
+
+
+def power_heuristic(pdf: float, other_pdf: float):
+    """
+    MIS weight (power heuristic with exponent 2) of a sample drawn with density pdf when other_pdf is the density of
+    the other strategy. Works on floats and NumPy arrays.
+    """
+    pdf2 = pdf * pdf
+    return pdf2 / (pdf2 + other_pdf * other_pdf)
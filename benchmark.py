@@ -0,0 +1,65 @@
+import argparse
+import glob
+import json
+import os
+from core.Benchmark import run_benchmark, save_results, DEFAULT_RESULTS_DIR
+from core.Sampler import SAMPLERS
+
+STRUCTURES = ["bvh", "grid", "hierarchical_grid", "kd-tree", "mesh_bvh", "no-structure"]
+
+
+def parse_resolution(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Ray Tracer benchmark")
+    parser.add_argument('--scenes', type=str, nargs='+', default=sorted(glob.glob("data/*.obj")),
+                        help="Pliki scen do zmierzenia (domyślnie wszystkie sceny z katalogu data/).")
+    parser.add_argument('--scene_config', type=str, default="scene_config.json",
+                        help="Ścieżka do pliku konfiguracji sceny.")
+    parser.add_argument('--camera_config', type=str, default="camera_config.json",
+                        help="Ścieżka do pliku konfiguracji kamery.")
+    parser.add_argument('--structures', type=str, nargs='+', default=["bvh", "kd-tree", "grid"], choices=STRUCTURES,
+                        help="Struktury akceleracji do porównania.")
+    parser.add_argument('--algorithms', type=str, nargs='+', default=["raytracing"],
+                        choices=["raytracing", "pathtracing"], help="Algorytmy śledzenia promieni do porównania.")
+    parser.add_argument('--resolutions', type=parse_resolution, nargs='+', default=[(64, 36)],
+                        help="Rozdzielczości w formacie SZEROKOŚĆxWYSOKOŚĆ, np. 64x36 160x90.")
+    parser.add_argument('--spp', type=int, nargs='+', default=[1], help="Liczby próbek na piksel do porównania.")
+    parser.add_argument('--sampler', type=str, default="stratified", choices=list(SAMPLERS),
+                        help="Generator próbek: niezależny, stratyfikowany lub ciąg Haltona.")
+    parser.add_argument('--render_mode', type=str, default="scalar", choices=["scalar", "packet"],
+                        help="Tryb renderowania: pojedyncze promienie lub pakiety promieni (NumPy, bez struktury akceleracji).")
+    parser.add_argument('--workers', type=int, default=1, help="Liczba procesów renderujących kafelki obrazu.")
+    parser.add_argument('--build_workers', type=int, default=1,
+                        help="Liczba procesów budujących strukturę akceleracji.")
+    parser.add_argument('--bvh_builder', type=str, default="median", choices=["median", "sah"],
+                        help="Metoda budowy BVH: podział w medianie lub heurystyka SAH.")
+    parser.add_argument('--kd_builder', type=str, default="sah", choices=["median", "sah"],
+                        help="Metoda budowy kd-drzewa: podział w medianie lub heurystyka SAH.")
+    parser.add_argument('--fov', type=float, default=60, help="Pole widzenia kamery.")
+    parser.add_argument('--warmup', type=int, default=1, help="Liczba niemierzonych przebiegów rozgrzewających.")
+    parser.add_argument('--repeats', type=int, default=3, help="Liczba mierzonych powtórzeń każdej konfiguracji.")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="Zmierz szczytowe zużycie sterty Pythona w dodatkowym, niemierzonym przebiegu.")
+    parser.add_argument('--statistics', action='store_true',
+                        help="Zbierz statystyki promieni i przejść struktur w dodatkowym, niemierzonym przebiegu.")
+    parser.add_argument('--output_dir', type=str, default=DEFAULT_RESULTS_DIR,
+                        help="Katalog wyników (benchmark.json i benchmark.csv).")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with open(args.camera_config, 'r') as f:
+        camera_config = json.load(f)
+    records = run_benchmark(args.scenes, args.structures, args.algorithms, args.resolutions, args.spp,
+                            args.scene_config, camera_config, render_mode=args.render_mode, workers=args.workers,
+                            build_workers=args.build_workers, bvh_builder=args.bvh_builder,
+                            kd_builder=args.kd_builder, warmup=args.warmup, repeats=args.repeats,
+                            trace_memory=args.tracemalloc, trace_statistics=args.statistics, fov=args.fov,
+                            sampler=args.sampler)
+    results = save_results(records, args.output_dir)
+    print(f"{len(records)} results saved, {len(results)} stored in {os.path.join(args.output_dir, 'benchmark.json')}")
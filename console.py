@@ -4,6 +4,7 @@ import tkinter as tk
 from tkinter import filedialog
 import os
 import matplotlib.pyplot as plt
+from core.Benchmark import load_results, KEY_FIELDS
 
 # Initialize Pygame
 pygame.init()
@@ -48,57 +49,45 @@ def calculate_button_positions(num_buttons, button_height, vertical_padding, tot
     
     return button_positions
 
-# Function to read efficiency results and plot graphs
-def check_results():
-    directory = "Efficiency_results"
-    render_times = {}
-    pixels_per_second = {}
-    ram_usage = {}
-
-    for filename in os.listdir(directory):
-        if filename.endswith("_efficiency.txt"):
-            with open(os.path.join(directory, filename), 'r') as file:
-                lines = file.readlines()
-                render_time = float(lines[0].split(":")[1].strip().replace("seconds", ""))
-                pps = int(lines[1].split(":")[1].strip().replace("pps", ""))
-                ram = float(lines[2].split(":")[1].strip().replace("MB", ""))
-                key = filename.replace("_efficiency.txt", "")
-                render_times[key] = render_time
-                pixels_per_second[key] = pps
-                ram_usage[key] = ram
-
-    # Plot render times
+# Function to draw one bar chart of benchmark results, with optional error bars
+def plot_bars(labels, values, ylabel, title, color, errors=None, digits=2):
     plt.figure(figsize=(10, 5))
-    bars = plt.bar(render_times.keys(), render_times.values(), color='blue')
-    plt.xlabel('Acceleration Structures')
-    plt.ylabel('Render Time (seconds)')
-    plt.title('Render Time Comparison')
+    bars = plt.bar(labels, values, color=color, yerr=errors, capsize=4 if errors else 0)
+    plt.xlabel('Configuration')
+    plt.ylabel(ylabel)
+    plt.title(title)
+    plt.xticks(rotation=30, ha='right')
     for bar in bars:
         yval = bar.get_height()
-        plt.text(bar.get_x() + bar.get_width()/2, yval, round(yval, 2), ha='center', va='bottom')
+        plt.text(bar.get_x() + bar.get_width()/2, yval, round(yval, digits), ha='center', va='bottom')
+    plt.tight_layout()
     plt.show(block=False)
 
-    # Plot pixels per second
-    plt.figure(figsize=(10, 5))
-    bars = plt.bar(pixels_per_second.keys(), pixels_per_second.values(), color='green')
-    plt.xlabel('Acceleration Structures')
-    plt.ylabel('Pixels per Second (pps)')
-    plt.title('Pixels per Second Comparison')
-    for bar in bars:
-        yval = bar.get_height()
-        plt.text(bar.get_x() + bar.get_width()/2, yval, yval, ha='center', va='bottom')
-    plt.show(block=False)
+# Function to read benchmark results (Efficiency_results/benchmark.json) and plot graphs
+def check_results():
+    results = load_results("Efficiency_results")
+    if not results:
+        print("Brak wyników w Efficiency_results/benchmark.json")
+        return
 
-    # Plot average RAM usage
-    plt.figure(figsize=(10, 5))
-    bars = plt.bar(ram_usage.keys(), ram_usage.values(), color='orange')
-    plt.xlabel('Acceleration Structures')
-    plt.ylabel('Average RAM Usage (MB)')
-    plt.title('Average RAM Usage During Rendering')
-    for bar in bars:
-        yval = bar.get_height()
-        plt.text(bar.get_x() + bar.get_width()/2, yval, round(yval, 2), ha='center', va='bottom')
-    plt.show(block=False)
+    # Label bars with the configuration fields that differ between the stored results
+    varying = [field for field in KEY_FIELDS if len({str(result[field]) for result in results}) > 1] or ["structure"]
+    def label(result):
+        return "_".join(os.path.splitext(os.path.basename(result[field]))[0] if field == "scene" else str(result[field])
+                        for field in varying)
+    labels = [label(result) for result in results]
+
+    plot_bars(labels, [result["render_time_median"] for result in results], 'Render Time (seconds)',
+              'Render Time Comparison (median)', 'blue', errors=[result["render_time_stddev"] for result in results])
+    plot_bars(labels, [result["camera_rays_per_second"] for result in results], 'Camera Rays per Second',
+              'Camera Rays per Second Comparison', 'green', digits=0)
+    plot_bars(labels, [result["peak_rss_mb"] for result in results], 'Peak RSS (MB)',
+              'Peak RAM Usage During Rendering', 'orange')
+    built = [result for result in results if result["build_time_median"] is not None]
+    if built:
+        plot_bars([label(result) for result in built], [result["build_time_median"] for result in built],
+                  'Build Time (seconds)', 'Acceleration Structure Build Time (median)', 'purple',
+                  errors=[result["build_time_stddev"] for result in built], digits=3)
 
 # Function to delete all files in the Efficiency_results directory
 def delete_results():
@@ -1,38 +1,14 @@
+from array import array
+from collections import Counter
+import numpy as np
 from core.Ray import Ray
-from models import Triangle
+from models import Triangle, MeshInstance, InstanceTriangle
 from core.Utils import sub
+from core.ParallelBuild import (build_pool, split_levels, worker_faces, face_indices, replace_primitives, face_map,
+                                resolve_tree, resolve_subtrees)
 
 
 
-def aabb_hit(ray: Ray, bounding_box_min: list[float], bounding_box_max: list[float]) -> bool:
-    """
-    Determines whether a given ray intersects with an AABB.
-
-    Parameters:
-        ray (Ray): The ray to test for intersection.
-        bounding_box_min (list of float): The minimum (x, y, z) coordinates of the bounding box.
-        bounding_box_max (list of float): The maximum (x, y, z) coordinates of the bounding box.
-
-    Returns:
-        bool: True if the ray intersects the bounding box, False otherwise.
-    """
-    tmin = ray.t_min
-    tmax = ray.t_max
-    for i in range(3):
-        adinv = 1.0 / (ray.direction[i] if abs(ray.direction[i]) > 1e-8 else 1e-8)
-        t0 = (bounding_box_min[i] - ray.origin[i]) * adinv
-        t1 = (bounding_box_max[i] - ray.origin[i]) * adinv
-        if t0<t1:
-            if(t0>tmin): tmin=t0
-            if(t1<tmax): tmax=t1
-        else:
-            if(t0<tmax): tmax=t0
-            if(t1>tmin): tmin=t1
-        if tmax <= tmin:
-            return False
-    return True
-
-
 def get_triangle_bbox(tri: Triangle):
     """
     Calculates the AABB for a given triangle.
@@ -45,9 +21,10 @@ def get_triangle_bbox(tri: Triangle):
             - bounding_box_min (list of float): The minimum (x, y, z) coordinates of the bounding box.
             - bounding_box_max (list of float): The maximum (x, y, z) coordinates of the bounding box.
     """
-    xs = [tri.v0[0], tri.v1[0], tri.v2[0]]
-    ys = [tri.v0[1], tri.v1[1], tri.v2[1]]
-    zs = [tri.v0[2], tri.v1[2], tri.v2[2]]
+    v0, v1, v2 = tri.vertices
+    xs = [v0[0], v1[0], v2[0]]
+    ys = [v0[1], v1[1], v2[1]]
+    zs = [v0[2], v1[2], v2[2]]
     return (
         [min(xs), min(ys), min(zs)],
         [max(xs), max(ys), max(zs)]
@@ -66,13 +43,21 @@ class BvhNode:
         is_leaf (bool): Indicates whether the node is a leaf node.
         bounding_box_min (list of float): The minimum (x, y, z) coordinates of the node's bounding box.
         bounding_box_max (list of float): The maximum (x, y, z) coordinates of the node's bounding box.
+
+    Parameters:
+        faces (list of Triangle): The triangles contained in this node.
+        bounding_box (tuple, optional): Precomputed (min, max) bounds of faces. Computed from faces if omitted.
     """
-    def __init__(self, faces: list[Triangle]):
+    def __init__(self, faces: list[Triangle], bounding_box=None):
         self.faces = faces
         self.left = None
         self.right = None
         self.is_leaf = False
 
+        if bounding_box is not None:
+            self.bounding_box_min, self.bounding_box_max = bounding_box
+            return
+
         min_pt = [float('inf'), float('inf'), float('inf')]
         max_pt = [float('-inf'), float('-inf'), float('-inf')]
         for f in faces:
@@ -85,17 +70,54 @@ class BvhNode:
 
 
 
-def build_bvh(faces: list[Triangle], max_faces_in_leaf) -> BvhNode:
+def build_bvh(faces: list[Triangle], max_faces_in_leaf, builder: str = "median", sah_bins: int = 12,
+              sah_leaf_cost: float = 1.0, workers: int = 1) -> BvhNode:
     """
     Constructs a Bounding Volume Hierarchy (BVH) tree from a list of triangles to accelerate ray intersection tests.
 
     Parameters:
         faces (list of Triangle): The list of triangles to include in the BVH.
         max_faces_in_leaf (int, optional): The maximum number of triangles allowed in a leaf node. Defaults to 4.
+        builder (str, optional): "median" splits the longest axis at the median centroid, "sah" uses the binned
+            surface area heuristic (see sah_split). Defaults to "median".
+        sah_bins (int, optional): Number of centroid bins per axis for the SAH builder. Defaults to 12.
+        sah_leaf_cost (float, optional): Cost of one triangle test relative to one node traversal, used by the
+            SAH builder. Defaults to 1.0.
+        workers (int, optional): Number of processes. With more than one, the top levels are split in this process
+            and the subtrees below them are built in parallel; the tree is identical to the serial one. Defaults to 1.
 
     Returns:
         BvhNode: The root node of the constructed BVH tree.
     """
+    if workers <= 1 or len(faces) <= max_faces_in_leaf:
+        return _build_bvh(faces, max_faces_in_leaf, builder, sah_bins, sah_leaf_cost)
+
+    with build_pool(faces[0].buffer, workers) as pool:
+        def spawn(subset):
+            return pool.submit(_build_bvh_subtree, [f.index for f in subset], max_faces_in_leaf, builder, sah_bins,
+                               sah_leaf_cost)
+        root = _build_bvh(faces, max_faces_in_leaf, builder, sah_bins, sah_leaf_cost, spawn, split_levels(workers))
+        return resolve_subtrees(root, "faces", ("left", "right"), faces)
+
+
+def _build_bvh(faces, max_faces_in_leaf, builder, sah_bins, sah_leaf_cost, spawn=None, levels=0):
+    if builder == "sah":
+        face_min, face_max = _face_bounds(faces)
+        return _build_sah(faces, face_min, face_max, BvhNode, max_faces_in_leaf, sah_bins, sah_leaf_cost,
+                          spawn, levels)
+    return _build_median(faces, max_faces_in_leaf, spawn, levels)
+
+
+def _build_median(faces, max_faces_in_leaf, spawn=None, levels=0):
+    """
+    Recursive median-split build: the longest axis of the node is split at the median triangle centroid.
+
+    spawn and levels are used by parallel builds: once levels reaches zero, the remaining subtree is handed to
+    spawn, which returns a Future in its place (see ParallelBuild.resolve_subtrees).
+    """
+    if spawn is not None and levels == 0:
+        return spawn(faces)
+
     node = BvhNode(faces)
 
     if len(faces) <= max_faces_in_leaf:
@@ -104,62 +126,36 @@ def build_bvh(faces: list[Triangle], max_faces_in_leaf) -> BvhNode:
 
     bbox_size = sub(node.bounding_box_max, node.bounding_box_min)
     axis = bbox_size.index(max(bbox_size))
-    faces.sort(key=lambda f: ((f.v0[axis] + f.v1[axis] + f.v2[axis]) / 3.0))
+    faces.sort(key=lambda f: sum(vertex[axis] for vertex in f.vertices) / 3.0)
     mid = len(faces) // 2
     left_faces = faces[:mid]
     right_faces = faces[mid:]
-    node.left = build_bvh(left_faces, max_faces_in_leaf)
-    node.right = build_bvh(right_faces, max_faces_in_leaf)
+    node.left = _build_median(left_faces, max_faces_in_leaf, spawn, levels - 1)
+    node.right = _build_median(right_faces, max_faces_in_leaf, spawn, levels - 1)
     return node
 
 
-def hit_bvh(ray: Ray, node: BvhNode):
+def _build_bvh_subtree(indices, max_faces_in_leaf, builder, sah_bins, sah_leaf_cost):
     """
-    Finds the closest intersection between a ray and the triangles contained within a BVH tree.
-
-    Parameters:
-        ray (Ray): The ray to test for intersections.
-        node (BvhNode): The current node in the BVH tree being tested.
-
-    Returns:
-        tuple or None: If an intersection is found, returns a tuple (t, intersection_point, face) where:
-            - t (float): The parameter value along the ray where the intersection occurs.
-            - intersection_point (list of float): The (x, y, z) coordinates of the intersection point.
-            - face (Triangle): The triangle that was intersected.
-        If no intersection is found, returns None.
+    Worker task of a parallel build_bvh: builds the subtree over the given buffer indices and returns it with
+    triangles replaced by their indices.
     """
-
-    if not aabb_hit(ray, node.bounding_box_min, node.bounding_box_max):
-        return None
-
-    if node.is_leaf:
-        closest_intersection = None
-        for f in node.faces:
-            res = f.hit(ray)
-            if res:
-                t, intersection_point, face = res
-                if (ray.t_min <= t <= ray.t_max):
-                    if not closest_intersection or t < closest_intersection[0]:
-                        closest_intersection = (t, intersection_point, face)
-        return closest_intersection
-
-
-    hit_left = hit_bvh(ray, node.left) if node.left else None
-    hit_right = hit_bvh(ray, node.right) if node.right else None
-
-    if hit_left and hit_right:
-        return hit_left if hit_left[0] < hit_right[0] else hit_right
-    return hit_left if hit_left else hit_right
+    root = _build_bvh(worker_faces(indices), max_faces_in_leaf, builder, sah_bins, sah_leaf_cost)
+    return replace_primitives(root, "faces", ("left", "right"), face_indices)
 
 
 class MeshBvhNode:
 
-    def __init__(self, meshes):
+    def __init__(self, meshes, bounding_box=None):
         self.meshes = meshes
         self.left = None
         self.right = None
         self.is_leaf = False
 
+        if bounding_box is not None:
+            self.bounding_box_min, self.bounding_box_max = bounding_box
+            return
+
         min_pt = [float('inf'), float('inf'), float('inf')]
         max_pt = [float('-inf'), float('-inf'), float('-inf')]
         for mesh in meshes:
@@ -169,7 +165,13 @@ class MeshBvhNode:
         self.bounding_box_min = min_pt
         self.bounding_box_max = max_pt
 
-def build_bvh_meshes(meshes, max_in_leaf=1) -> MeshBvhNode:
+def build_bvh_meshes(meshes, max_in_leaf=1, builder: str = "median", sah_bins: int = 12,
+                     sah_leaf_cost: float = 1.0) -> MeshBvhNode:
+    if builder == "sah":
+        mesh_min = np.array([mesh.bounding_box_min for mesh in meshes], dtype=np.float64).reshape(-1, 3)
+        mesh_max = np.array([mesh.bounding_box_max for mesh in meshes], dtype=np.float64).reshape(-1, 3)
+        return _build_sah(meshes, mesh_min, mesh_max, MeshBvhNode, max_in_leaf, sah_bins, sah_leaf_cost)
+
     node = MeshBvhNode(meshes)
     if len(meshes) <= max_in_leaf:
         node.is_leaf = True
@@ -190,30 +192,513 @@ def build_bvh_meshes(meshes, max_in_leaf=1) -> MeshBvhNode:
     node.right = build_bvh_meshes(right_meshes, max_in_leaf)
     return node
 
-def hit_bvh_meshes(ray: Ray, node: MeshBvhNode):
 
-    if not aabb_hit(ray, node.bounding_box_min, node.bounding_box_max):
-        return None
+def _clipped_entry(bounds, node: int, ox: float, oy: float, oz: float, inv_x: float, inv_y: float, inv_z: float,
+                   t_min: float, t_max: float):
+    """
+    Slab test of a ray against the box of a flattened node, clipped to [t_min, t_max].
+
+    Parameters:
+        bounds (array of float): Node boxes of a FlatBvh, 6 values per node.
+        node (int): Index of the node.
+        ox, oy, oz (float): Ray origin.
+        inv_x, inv_y, inv_z (float): Reciprocal of the ray direction.
+        t_min, t_max (float): Interval the box is clipped to.
+
+    Returns:
+        float or None: Distance at which the ray enters the clipped box, or None if it misses it.
+    """
+    k = 6 * node
+    near, far = (bounds[k] - ox) * inv_x, (bounds[k + 3] - ox) * inv_x
+    if near > far:
+        near, far = far, near
+    t0, t1 = (bounds[k + 1] - oy) * inv_y, (bounds[k + 4] - oy) * inv_y
+    if t0 > t1:
+        t0, t1 = t1, t0
+    if t0 > near:
+        near = t0
+    if t1 < far:
+        far = t1
+    t0, t1 = (bounds[k + 2] - oz) * inv_z, (bounds[k + 5] - oz) * inv_z
+    if t0 > t1:
+        t0, t1 = t1, t0
+    if t0 > near:
+        near = t0
+    if t1 < far:
+        far = t1
+    if near < t_min:
+        near = t_min
+    if far > t_max:
+        far = t_max
+    return near if near <= far else None
+
+
+class FlatBvh:
+    """
+    Linearized BVH with an iterative, front-to-back traversal.
+
+    Nodes of a BvhNode or MeshBvhNode tree are stored in depth-first order in flat arrays: the first child of an
+    internal node directly follows it, the index of the second child is stored explicitly, and leaves reference a
+    contiguous range of the primitives list. Traversal uses an explicit stack, visits the child whose box is
+    entered first, and skips every node whose entry distance lies beyond the closest hit found so far. hit() and
+    occluded() intersect triangles; a flattened MeshBvhNode tree (the TLAS of a TwoLevelBvh) is traversed by its
+    TwoLevelBvh.
+
+    Attributes:
+        bounds (array of float): 6 values per node, the (x, y, z) minimum followed by the (x, y, z) maximum.
+        second_child (array of int): Index of the second child of internal nodes, -1 for leaves.
+        first_primitive (array of int): Offset of a leaf's first primitive in primitives.
+        primitive_count (array of int): Number of primitives of a leaf, 0 for internal nodes.
+        primitives (list): Triangles (flattened BvhNode) or instances (flattened MeshBvhNode), in leaf order.
+        holds_meshes (bool): True when the source tree was a MeshBvhNode tree.
+        node_visits (int): Number of nodes popped from the traversal stack since the last reset_counters().
+        aabb_tests (int): Number of node boxes tested since the last reset_counters().
+        rays (int): Number of traversals since the last reset_counters().
+    """
+    def __init__(self, root):
+        self.bounds = array('d')
+        self.second_child = array('i')
+        self.first_primitive = array('i')
+        self.primitive_count = array('i')
+        self.primitives = []
+        self.holds_meshes = isinstance(root, MeshBvhNode)
+        self.node_visits = 0
+        self.aabb_tests = 0
+        self.rays = 0
+        self._flatten(root)
+
+    @staticmethod
+    def from_arrays(bounds, second_child, first_primitive, primitive_count, primitives):
+        """
+        Recreates a flattened triangle BVH from its node arrays (e.g. loaded from the scene cache) without the source
+        tree.
+        """
+        flat = FlatBvh.__new__(FlatBvh)
+        flat.bounds = array('d', np.asarray(bounds, dtype=np.float64).tobytes())
+        flat.second_child = array('i', np.asarray(second_child, dtype=np.int32).tobytes())
+        flat.first_primitive = array('i', np.asarray(first_primitive, dtype=np.int32).tobytes())
+        flat.primitive_count = array('i', np.asarray(primitive_count, dtype=np.int32).tobytes())
+        flat.primitives = list(primitives)
+        flat.holds_meshes = False
+        flat.node_visits = 0
+        flat.aabb_tests = 0
+        flat.rays = 0
+        return flat
+
+    def __len__(self) -> int:
+        return len(self.second_child)
+
+    def _flatten(self, node) -> int:
+        index = len(self.second_child)
+        self.bounds.extend(node.bounding_box_min)
+        self.bounds.extend(node.bounding_box_max)
+        self.second_child.append(-1)
+        self.first_primitive.append(len(self.primitives))
+        self.primitive_count.append(0)
+
+        if node.is_leaf:
+            items = node.meshes if self.holds_meshes else node.faces
+            self.primitives.extend(items)
+            self.primitive_count[index] = len(items)
+        else:
+            self._flatten(node.left)
+            self.second_child[index] = self._flatten(node.right)
+        return index
+
+    def reset_counters(self):
+        self.node_visits = 0
+        self.aabb_tests = 0
+        self.rays = 0
+
+    def hit(self, ray: Ray):
+        """
+        Finds the closest intersection between a ray and the primitives of the BVH.
+
+        Returns:
+            tuple or None: (t, intersection_point, face) of the closest hit, or None.
+        """
+        return self._traverse(ray, ray.t_max, False)
+
+    def occluded(self, ray: Ray, t_max: float) -> bool:
+        """
+        Any-hit query: True as soon as some primitive is hit with ray.t_min <= t < t_max.
+        """
+        return self._traverse(ray, t_max, True) is not None
+
+    def _traverse(self, ray: Ray, t_max: float, any_hit: bool):
+        ox, oy, oz = ray.origin
+        dx, dy, dz = ray.direction
+        inv_x = 1.0 / (dx if abs(dx) > 1e-8 else 1e-8)
+        inv_y = 1.0 / (dy if abs(dy) > 1e-8 else 1e-8)
+        inv_z = 1.0 / (dz if abs(dz) > 1e-8 else 1e-8)
+        t_min = ray.t_min
+        t_closest = t_max
+        bounds = self.bounds
+        second_child = self.second_child
+        first_primitive = self.first_primitive
+        primitive_count = self.primitive_count
+        primitives = self.primitives
+
+        self.rays += 1
+        visits = 0
+        boxes = 1
+        closest = None
+        root_entry = _clipped_entry(bounds, 0, ox, oy, oz, inv_x, inv_y, inv_z, t_min, t_closest)
+        stack = [] if root_entry is None else [(root_entry, 0)]
+        while stack:
+            node_entry, node = stack.pop()
+            if node_entry > t_closest:
+                continue
+            visits += 1
+
+            second = second_child[node]
+            if second < 0:
+                first = first_primitive[node]
+                for face in primitives[first:first + primitive_count[node]]:
+                    res = face.hit(ray)
+                    if res and t_min <= res[0] <= t_closest:
+                        if any_hit:
+                            if res[0] < t_closest:
+                                self.node_visits += visits
+                                self.aabb_tests += boxes
+                                return res
+                            continue
+                        closest = res
+                        t_closest = res[0]
+                continue
+
+            boxes += 2
+            first_entry = _clipped_entry(bounds, node + 1, ox, oy, oz, inv_x, inv_y, inv_z, t_min, t_closest)
+            second_entry = _clipped_entry(bounds, second, ox, oy, oz, inv_x, inv_y, inv_z, t_min, t_closest)
+            if first_entry is not None and second_entry is not None:
+                if first_entry <= second_entry:
+                    stack.append((second_entry, second))
+                    stack.append((first_entry, node + 1))
+                else:
+                    stack.append((first_entry, node + 1))
+                    stack.append((second_entry, second))
+            elif first_entry is not None:
+                stack.append((first_entry, node + 1))
+            elif second_entry is not None:
+                stack.append((second_entry, second))
+        self.node_visits += visits
+        self.aabb_tests += boxes
+        return closest
+
+
+class TwoLevelBvh:
+    """
+    Two-level acceleration structure: a bottom-level BVH (BLAS) over the faces of every mesh and a top-level BVH
+    (TLAS) over mesh instances.
+
+    Each mesh gets its BLAS once, no matter how many instances reference it, so instancing a mesh adds no triangles.
+    Rays reaching a TLAS leaf are transformed into the instance's object space (skipped for identity transforms) and
+    traverse the instance's BLAS with the closest hit found so far as their upper bound. Hits through transformed
+    instances are reported with an InstanceTriangle, whose normal is in world space.
 
-    if node.is_leaf:
+    Changing a mesh's geometry only requires update_mesh for that mesh; moving instances or adding new ones only
+    rebuilds the TLAS, which holds one leaf per instance.
 
-        closest_hit = None
-        for mesh in node.meshes:
-            if not aabb_hit(ray, mesh.bounding_box_min, mesh.bounding_box_max):
+    Attributes:
+        instances (list of MeshInstance): Instances in the scene.
+        blas (dict): FlatBvh over the faces of each instanced mesh, keyed by the Mesh.
+        tlas_root (MeshBvhNode or None): Top-level tree over the instances, None until build() runs.
+        tlas (FlatBvh or None): Flattened top-level tree.
+        builder (str): "median" or "sah", used for both levels.
+        max_faces_in_leaf (int): Leaf size of the bottom-level BVHs.
+    """
+    def __init__(self, builder: str = "median", max_faces_in_leaf: int = 4):
+        self.instances = []
+        self.blas = {}
+        self.tlas_root = None
+        self.tlas = None
+        self.builder = builder
+        self.max_faces_in_leaf = max_faces_in_leaf
+
+    def add_instance(self, mesh, transform=None) -> MeshInstance:
+        """
+        Adds an instance of mesh with the (4, 4) object-to-world transform (identity if omitted). The mesh's BLAS is
+        built on its first instance.
+        """
+        if mesh not in self.blas:
+            self._build_blas(mesh)
+        instance = MeshInstance(mesh, transform)
+        self.instances.append(instance)
+        self.tlas = self.tlas_root = None
+        return instance
+
+    def update_mesh(self, mesh) -> None:
+        """
+        Rebuilds the BLAS of a mesh whose faces or bounding box changed, leaving all other BLAS untouched.
+        """
+        self._build_blas(mesh)
+        for instance in self.instances:
+            if instance.mesh is mesh:
+                instance.update_bounds()
+        self.tlas = self.tlas_root = None
+
+    def _build_blas(self, mesh) -> None:
+        # build_bvh sorts its input in place; mesh.faces must keep the buffer order
+        self.blas[mesh] = FlatBvh(build_bvh(list(mesh.faces), self.max_faces_in_leaf, builder=self.builder))
+
+    def build_blas(self, meshes, workers: int = 1) -> None:
+        """
+        Builds the BLAS of several meshes up front, distributing whole meshes over workers processes. Instances
+        added afterwards reuse them.
+        """
+        meshes = [mesh for mesh in meshes if mesh.faces]
+        if workers <= 1 or len(meshes) < 2:
+            for mesh in meshes:
+                self._build_blas(mesh)
+            return
+        with build_pool(meshes[0].faces[0].buffer, workers) as pool:
+            # largest meshes first, so the last tasks to finish are short ones
+            futures = {mesh: pool.submit(_build_bvh_subtree, [f.index for f in mesh.faces], self.max_faces_in_leaf,
+                                         self.builder, 12, 1.0)
+                       for mesh in sorted(meshes, key=lambda m: len(m.faces), reverse=True)}
+            for mesh in meshes:
+                root = resolve_tree(futures[mesh], "faces", ("left", "right"), face_map(mesh.faces))
+                self.blas[mesh] = FlatBvh(root)
+
+    def build(self) -> None:
+        """
+        Builds the TLAS over the current instances. Called by hit() and occluded() when instances changed.
+        """
+        self.tlas_root = build_bvh_meshes(list(self.instances), max_in_leaf=1, builder=self.builder)
+        self.tlas = FlatBvh(self.tlas_root)
+
+    def hit(self, ray: Ray):
+        """
+        Finds the closest intersection between a ray and all instances.
+
+        Returns:
+            tuple or None: (t, intersection_point, face) of the closest hit, or None.
+        """
+        return self._traverse(ray, ray.t_max, False)
+
+    def occluded(self, ray: Ray, t_max: float) -> bool:
+        """
+        Any-hit query: True as soon as some instance is hit with ray.t_min <= t < t_max.
+        """
+        return self._traverse(ray, t_max, True) is not None
+
+    def _traverse(self, ray: Ray, t_max: float, any_hit: bool):
+        if self.tlas is None:
+            if not self.instances:
+                return None
+            self.build()
+        tlas = self.tlas
+        ox, oy, oz = ray.origin
+        dx, dy, dz = ray.direction
+        inv_x = 1.0 / (dx if abs(dx) > 1e-8 else 1e-8)
+        inv_y = 1.0 / (dy if abs(dy) > 1e-8 else 1e-8)
+        inv_z = 1.0 / (dz if abs(dz) > 1e-8 else 1e-8)
+        t_min = ray.t_min
+        t_closest = t_max
+        bounds = tlas.bounds
+        second_child = tlas.second_child
+        first_primitive = tlas.first_primitive
+        primitive_count = tlas.primitive_count
+        instances = tlas.primitives
+        blas = self.blas
+
+        tlas.rays += 1
+        visits = 0
+        boxes = 1
+        closest = None
+        root_entry = _clipped_entry(bounds, 0, ox, oy, oz, inv_x, inv_y, inv_z, t_min, t_closest)
+        stack = [] if root_entry is None else [(root_entry, 0)]
+        while stack:
+            node_entry, node = stack.pop()
+            if node_entry > t_closest:
+                continue
+            visits += 1
+
+            second = second_child[node]
+            if second < 0:
+                first = first_primitive[node]
+                for instance in instances[first:first + primitive_count[node]]:
+                    local_ray = ray if instance.is_identity else instance.ray_to_object(ray)
+                    res = blas[instance.mesh]._traverse(local_ray, t_closest, any_hit)
+                    if res is None:
+                        continue
+                    if any_hit:
+                        tlas.node_visits += visits
+                        tlas.aabb_tests += boxes
+                        return res
+                    if not instance.is_identity:
+                        res = (res[0], ray.at(res[0]), InstanceTriangle(res[2], instance))
+                    closest = res
+                    t_closest = res[0]
                 continue
 
-            for face in mesh.faces:
-                res = face.hit(ray)
-                if res:
-                    t, intersection_point, face_obj = res
-                    if ray.t_min <= t <= ray.t_max:
-                        if (closest_hit is None) or (t < closest_hit[0]):
-                            closest_hit = (t, intersection_point, face_obj)
-        return closest_hit
-
-    hit_left  = hit_bvh_meshes(ray, node.left)  if node.left  else None
-    hit_right = hit_bvh_meshes(ray, node.right) if node.right else None
-
-    if hit_left and hit_right:
-        return hit_left if hit_left[0] < hit_right[0] else hit_right
-    return hit_left if hit_left else hit_right
\ No newline at end of file
+            boxes += 2
+            first_entry = _clipped_entry(bounds, node + 1, ox, oy, oz, inv_x, inv_y, inv_z, t_min, t_closest)
+            second_entry = _clipped_entry(bounds, second, ox, oy, oz, inv_x, inv_y, inv_z, t_min, t_closest)
+            if first_entry is not None and second_entry is not None:
+                if first_entry <= second_entry:
+                    stack.append((second_entry, second))
+                    stack.append((first_entry, node + 1))
+                else:
+                    stack.append((first_entry, node + 1))
+                    stack.append((second_entry, second))
+            elif first_entry is not None:
+                stack.append((first_entry, node + 1))
+            elif second_entry is not None:
+                stack.append((second_entry, second))
+        tlas.node_visits += visits
+        tlas.aabb_tests += boxes
+        return closest
+
+
+def _face_bounds(faces: list[Triangle]):
+    """
+    Per-face (N, 3) bounding box minima and maxima, read from the faces' shared TriangleBuffer.
+    """
+    if not faces:
+        return np.zeros((0, 3)), np.zeros((0, 3))
+    indices = np.fromiter((f.index for f in faces), dtype=np.int64, count=len(faces))
+    bounds_min, bounds_max = faces[0].buffer.bounding_boxes()
+    return bounds_min[indices], bounds_max[indices]
+
+
+def _surface_area(extent: np.ndarray) -> np.ndarray:
+    return 2.0 * (extent[..., 0] * extent[..., 1] + extent[..., 1] * extent[..., 2] + extent[..., 2] * extent[..., 0])
+
+
+def sah_split(bounds_min: np.ndarray, bounds_max: np.ndarray, bins: int = 12, leaf_cost: float = 1.0):
+    """
+    Finds the cheapest binned surface area heuristic split of a set of primitives.
+
+    Primitive centroids are sorted into equally sized bins along each axis, and every boundary between bins is
+    evaluated with cost = 1 + leaf_cost * (A_left * N_left + A_right * N_right) / A_node, where one node traversal
+    costs 1. This is O(n) per node instead of the O(n log n) sort of the median builder.
+
+    Parameters:
+        bounds_min (np.ndarray): (N, 3) primitive bounding box minima.
+        bounds_max (np.ndarray): (N, 3) primitive bounding box maxima.
+        bins (int): Number of bins per axis.
+        leaf_cost (float): Cost of intersecting one primitive relative to one node traversal.
+
+    Returns:
+        tuple: (cost, left_mask) with left_mask selecting primitives of the left child, or (inf, None) when the
+        centroids cannot be separated.
+    """
+    count = len(bounds_min)
+    centroids = (bounds_min + bounds_max) * 0.5
+    centroid_min = centroids.min(axis=0)
+    centroid_extent = centroids.max(axis=0) - centroid_min
+    node_area = _surface_area(bounds_max.max(axis=0) - bounds_min.min(axis=0))
+    if node_area <= 0:
+        node_area = 1.0
+
+    best_cost, best_axis, best_bin, best_bins = float('inf'), None, None, None
+    for axis in range(3):
+        if centroid_extent[axis] <= 0:
+            continue
+        bin_index = ((centroids[:, axis] - centroid_min[axis]) * (bins / centroid_extent[axis])).astype(np.int64)
+        np.minimum(bin_index, bins - 1, out=bin_index)
+
+        bin_count = np.bincount(bin_index, minlength=bins)
+        bin_min = np.full((bins, 3), np.inf)
+        bin_max = np.full((bins, 3), -np.inf)
+        np.minimum.at(bin_min, bin_index, bounds_min)
+        np.maximum.at(bin_max, bin_index, bounds_max)
+
+        left_count = np.cumsum(bin_count)[:-1]
+        right_count = count - left_count
+        with np.errstate(invalid='ignore'):
+            left_area = _surface_area(np.maximum.accumulate(bin_max)[:-1] - np.minimum.accumulate(bin_min)[:-1])
+            right_area = _surface_area(np.maximum.accumulate(bin_max[::-1])[::-1][1:]
+                                       - np.minimum.accumulate(bin_min[::-1])[::-1][1:])
+            cost = 1.0 + leaf_cost * (left_area * left_count + right_area * right_count) / node_area
+        cost[(left_count == 0) | (right_count == 0)] = np.inf
+
+        split = int(np.argmin(cost))
+        if cost[split] < best_cost:
+            best_cost, best_axis, best_bin, best_bins = float(cost[split]), axis, split, bin_index
+
+    if best_axis is None:
+        return float('inf'), None
+    return best_cost, best_bins <= best_bin
+
+
+def _build_sah(items, bounds_min, bounds_max, node_class, max_in_leaf, bins, leaf_cost, spawn=None, levels=0):
+    """
+    Recursive binned-SAH build shared by build_bvh (items are triangles) and build_bvh_meshes (items are meshes).
+
+    A node is split while it holds more than max_in_leaf items or while the best split is cheaper than testing
+    all of its items; nodes whose centroids coincide are split in half by position. spawn and levels hand the
+    subtrees below the top levels to a parallel build, as in _build_median.
+    """
+    if spawn is not None and levels == 0:
+        return spawn(items)
+
+    node = node_class(items, (bounds_min.min(axis=0).tolist(), bounds_max.max(axis=0).tolist()))
+    count = len(items)
+    if count <= 1:
+        node.is_leaf = True
+        return node
+
+    cost, left_mask = sah_split(bounds_min, bounds_max, bins, leaf_cost)
+    if count <= max_in_leaf and cost >= count * leaf_cost:
+        node.is_leaf = True
+        return node
+    if left_mask is None:
+        if count <= max_in_leaf:
+            node.is_leaf = True
+            return node
+        left_mask = np.arange(count) < count // 2
+
+    left_idx = np.flatnonzero(left_mask)
+    right_idx = np.flatnonzero(~left_mask)
+    node.left = _build_sah([items[i] for i in left_idx], bounds_min[left_idx], bounds_max[left_idx],
+                           node_class, max_in_leaf, bins, leaf_cost, spawn, levels - 1)
+    node.right = _build_sah([items[i] for i in right_idx], bounds_min[right_idx], bounds_max[right_idx],
+                            node_class, max_in_leaf, bins, leaf_cost, spawn, levels - 1)
+    return node
+
+
+def bvh_statistics(root, leaf_cost: float = 1.0) -> dict:
+    """
+    Collects quality statistics of a BvhNode or MeshBvhNode tree.
+
+    The SAH cost is the expected cost of a random ray hitting the root: every node contributes its surface area
+    relative to the root's, times 1 for internal nodes and times leaf_cost per primitive for leaves.
+
+    Returns:
+        dict: sah_cost, node_count, leaf_count, max_depth, primitive_count and leaf_histogram
+        (Counter of primitives per leaf).
+    """
+    root_area = _surface_area(np.subtract(root.bounding_box_max, root.bounding_box_min)) or 1.0
+    stats = {'sah_cost': 0.0, 'node_count': 0, 'leaf_count': 0, 'max_depth': 0, 'primitive_count': 0,
+             'leaf_histogram': Counter()}
+    stack = [(root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        relative_area = _surface_area(np.subtract(node.bounding_box_max, node.bounding_box_min)) / root_area
+        stats['node_count'] += 1
+        stats['max_depth'] = max(stats['max_depth'], depth)
+        if node.is_leaf:
+            size = len(node.faces) if isinstance(node, BvhNode) else len(node.meshes)
+            stats['leaf_count'] += 1
+            stats['primitive_count'] += size
+            stats['leaf_histogram'][size] += 1
+            stats['sah_cost'] += relative_area * size * leaf_cost
+        else:
+            stats['sah_cost'] += relative_area
+            stack.extend((child, depth + 1) for child in (node.left, node.right) if child)
+    stats['sah_cost'] = float(stats['sah_cost'])
+    return stats
+
+
+def report_bvh(root, name: str = "BVH", leaf_cost: float = 1.0) -> dict:
+    """
+    Prints the statistics of bvh_statistics in a compact form, so different builders can be compared.
+    """
+    stats = bvh_statistics(root, leaf_cost)
+    histogram = ", ".join(f"{size}: {n}" for size, n in sorted(stats['leaf_histogram'].items()))
+    print(f"{name}: SAH cost {stats['sah_cost']:.2f}, {stats['node_count']} nodes, {stats['leaf_count']} leaves, "
+          f"depth {stats['max_depth']}, {stats['primitive_count']} primitives")
+    print(f"{name} leaf sizes: {histogram}")
+    return stats
@@ -0,0 +1,199 @@
+import csv
+import itertools
+import json
+import os
+import statistics
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+import psutil
+from core.Scene import Scene
+from core.Camera import Camera
+from core.Statistics import render_statistics
+
+DEFAULT_RESULTS_DIR = os.path.join(os.path.dirname(__file__), "..", "Efficiency_results")
+
+# Columns identifying one benchmark configuration; a new record replaces a stored one with the same key. source tells
+# benchmark runs apart from the single interactive renders main.py records.
+KEY_FIELDS = ("source", "scene", "structure", "algorithm", "render_mode", "width", "height", "spp", "sampler",
+              "workers", "build_workers")
+
+CSV_FIELDS = KEY_FIELDS + (
+    "triangles", "warmup", "repeats", "build_time_median", "build_time_stddev", "render_time_median",
+    "render_time_stddev", "render_time_min", "camera_rays_per_second", "pixels_per_second", "average_spp",
+    "peak_rss_mb", "python_heap_peak_mb", "time_to_first_image", "timestamp")
+
+
+class RssSampler:
+    """
+    Samples the resident set size of this process and of its child processes (render and build workers) on a
+    background thread, keeping the peak. Used as a context manager around the measured code.
+
+    Attributes:
+        interval (float): Seconds between two samples.
+        peak_bytes (int): Largest total RSS seen so far.
+    """
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak_bytes = 0
+        self._process = psutil.Process(os.getpid())
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def peak_mb(self) -> float:
+        return self.peak_bytes / (1024 * 1024)
+
+    def sample(self) -> int:
+        total = self._process.memory_info().rss
+        for child in self._process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:  # the worker exited between listing and sampling
+                pass
+        self.peak_bytes = max(self.peak_bytes, total)
+        return total
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        return False
+
+
+def summarize(times: list[float]) -> dict:
+    """
+    Median, standard deviation (0 for a single run) and minimum of a list of timings.
+    """
+    return {"median": statistics.median(times), "stddev": statistics.stdev(times) if len(times) > 1 else 0.0,
+            "min": min(times)}
+
+
+def run_benchmark(scenes: list[str], structures: list[str], algorithms: list[str], resolutions: list[tuple],
+                  spps: list[int], scene_config: str, camera_config: dict, render_mode: str = "scalar",
+                  workers: int = 1, build_workers: int = 1, bvh_builder: str = "median", kd_builder: str = "sah",
+                  warmup: int = 1, repeats: int = 3, trace_memory: bool = False, trace_statistics: bool = False,
+                  fov: float = 60, sampler: str = "stratified") -> list[dict]:
+    """
+    Runs every combination of scene, structure, algorithm, resolution and samples per pixel without a window.
+
+    For every scene and structure, the scene is loaded warmup + repeats times without the scene cache. Only the
+    build times of the last repeats loads are kept. Every render configuration is then rendered warmup times
+    untimed and repeats times timed, with the same seed, so all runs trace the same rays. Peak RSS covers the timed
+    renders, including the worker processes. With trace_memory, one more untimed render under tracemalloc records
+    the peak Python heap usage, which keeps tracemalloc's overhead out of the timings. Likewise, trace_statistics
+    adds an untimed in-process render whose ray and traversal counters (see RayStatistics.as_dict) are stored in
+    the record's "statistics" field. Packet renders intersect every triangle (see intersect_packet), so in packet
+    mode structures is replaced by ["no-structure"].
+
+    Returns:
+        list of dict: One record per render configuration with the fields of CSV_FIELDS and the raw build_times and
+        render_times.
+    """
+    if render_mode == "packet" and list(structures) != ["no-structure"]:
+        # intersect_packet tests every triangle, so a structure would only be built and mislabel the results
+        print(f"Packet mode tests every triangle; structures {', '.join(structures)} replaced by no-structure.")
+        structures = ["no-structure"]
+    records = []
+    for scene_path, structure in itertools.product(scenes, structures):
+        build_times = []
+        for _ in range(warmup + repeats):
+            scene = Scene(acceleration_structure=structure, bvh_builder=bvh_builder, kd_builder=kd_builder,
+                          build_workers=build_workers)
+            scene.load_from_file(scene_path)
+            build_times.append(scene.load_stats["structure_time"])
+        build_times = build_times[warmup:]
+        build = summarize(build_times)
+        scene.load_config(scene_config)
+
+        for algorithm, (width, height), spp in itertools.product(algorithms, resolutions, spps):
+            camera = Camera(scene, width, height, camera_origin=camera_config['camera_origin'],
+                            lookat=camera_config['lookat'], vup=camera_config['vup'], fov=fov,
+                            trace_algorithm=algorithm, render_mode=render_mode, workers=workers,
+                            samples_per_pixel=spp, sampler=sampler, progress=False, headless=True)
+            for _ in range(warmup):
+                camera.render()
+            render_times = []
+            with RssSampler() as rss:
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    camera.render()
+                    render_times.append(time.perf_counter() - start)
+            heap_peak = None
+            if trace_memory:
+                tracemalloc.start()
+                camera.render()
+                heap_peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                tracemalloc.stop()
+            statistics = render_statistics(camera).as_dict() if trace_statistics else None
+
+            render = summarize(render_times)
+            record = {
+                "source": "benchmark", "scene": scene_path, "structure": structure, "algorithm": algorithm,
+                "render_mode": render_mode, "width": width, "height": height, "spp": spp, "sampler": sampler, "workers": workers,
+                "build_workers": build_workers,
+                "triangles": scene.load_stats["triangles"], "warmup": warmup, "repeats": repeats,
+                "build_time_median": build["median"], "build_time_stddev": build["stddev"],
+                "render_time_median": render["median"], "render_time_stddev": render["stddev"],
+                "render_time_min": render["min"],
+                # camera rays: every sample of every pixel is one primary ray
+                "camera_rays_per_second": float(camera.spp_map.sum()) / render["median"],
+                "pixels_per_second": width * height / render["median"], "average_spp": camera.average_spp,
+                "peak_rss_mb": rss.peak_mb, "python_heap_peak_mb": heap_peak, "time_to_first_image": None,
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "build_times": build_times, "render_times": render_times, "statistics": statistics,
+            }
+            print(f"{scene_path} {structure} {algorithm} {width}x{height} {spp} spp: "
+                  f"build {build['median']:.3f} s, render {render['median']:.3f} s ± {render['stddev']:.3f}, "
+                  f"{record['camera_rays_per_second']:.0f} camera rays/s, peak RSS {rss.peak_mb:.1f} MB")
+            records.append(record)
+    return records
+
+
+def record_key(record: dict) -> tuple:
+    return tuple(record.get(field) for field in KEY_FIELDS)
+
+
+def load_results(directory: str = DEFAULT_RESULTS_DIR) -> list[dict]:
+    """
+    Returns the records stored in directory/benchmark.json, or an empty list if there are none.
+    """
+    path = os.path.join(directory, "benchmark.json")
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        return json.load(f)["results"]
+
+
+def save_results(records: list[dict], directory: str = DEFAULT_RESULTS_DIR) -> list[dict]:
+    """
+    Merges records into directory/benchmark.json, replacing stored records of the same configuration (see
+    KEY_FIELDS), and rewrites directory/benchmark.csv from the merged list. The CSV leaves out the raw timings and
+    the ray statistics.
+
+    Returns:
+        list of dict: All stored records.
+    """
+    os.makedirs(directory, exist_ok=True)
+    merged = {record_key(record): record for record in load_results(directory)}
+    merged.update((record_key(record), record) for record in records)
+    results = list(merged.values())
+    with open(os.path.join(directory, "benchmark.json"), "w") as f:
+        json.dump({"results": results}, f, indent=2)
+    with open(os.path.join(directory, "benchmark.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+    return results
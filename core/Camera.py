@@ -4,9 +4,72 @@ from core import *
 from models import *
 from typing import Tuple, List
 import math
-import random
 import time
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
+import numpy as np
+from core.ImageOutput import save_image, to_ldr
+from Lights.AreaLights import power_heuristic
+from core.PacketTracer import (PacketScene, primary_rays, trace_pathtrace_packet, trace_whitted_packet,
+                               MIRROR_REFLECTIVITY)
+from core.Sampler import (create_sampler, cosine_hemisphere, bounce_dimension, LIGHT_SELECT, LIGHT_U, LIGHT_V, BSDF_U,
+                          BSDF_V, ROULETTE)
+
+# Rec. 709 weights used to reduce a color sample to the luminance whose variance drives adaptive sampling.
+LUMINANCE = (0.2126, 0.7152, 0.0722)
+
+# Bounces after which path tracing starts terminating paths by Russian roulette.
+RUSSIAN_ROULETTE_DEPTH = 3
+
+# Default number of intersections along a ray: Whitted chains of mirror and glass bounces, path tracing bounces.
+WHITTED_MAX_DEPTH = 3
+PATHTRACE_MAX_DEPTH = 7
+
+
+def background(ray) -> List[float]:
+    """
+    Sky gradient seen along a ray that leaves the scene.
+    """
+    unit_ray_direction = norm(ray.direction)
+    a = 0.5 * (unit_ray_direction[1] + 1)
+    return add(scale(1.0 - a, [1, 1, 1]), scale(a, [0.5, 0.7, 1.0]))
+
+
+def reflect_ray(ray, face, intersection_point):
+    """
+    Mirror reflection of ray about the face normal at intersection_point.
+    """
+    direction = sub(ray.direction, scale(2 * dot(ray.direction, face.unit_norm), face.unit_norm))
+    return Ray(intersection_point, direction)
+
+
+def refract_ray(ray, face, intersection_point):
+    """
+    Ray refracted into or out of the face's material (Snell's law with the material's optical density), or the
+    reflected ray on total internal reflection.
+    """
+    n1 = 1.0
+    n2 = face.record.optical_density
+
+    if dot(norm(ray.direction), face.unit_norm) > 0:
+        n1, n2 = n2, n1
+        normal = scale(-1, face.unit_norm)
+    else:
+        normal = face.unit_norm
+
+    ri = n1 / n2
+    cos_theta = -dot(norm(ray.direction), normal)
+    sin_theta2 = ri ** 2 * (1 - cos_theta ** 2)
+
+    if sin_theta2 > 1.0:
+        return reflect_ray(ray, face, intersection_point)
+
+    ray_out_perp = scale(ri, add(norm(ray.direction), scale(cos_theta, normal)))
+    ray_out_parallel = scale(-math.sqrt(1.0 - sin_theta2), normal)
+    refracted_direction = add(ray_out_perp, ray_out_parallel)
+    return Ray(add(intersection_point, scale(1e-3, refracted_direction)), refracted_direction)
+
 
 class Camera:
     """
@@ -14,6 +77,9 @@ class Camera:
     onto a Pygame surface. It handles the generation of rays for each pixel, performing ray tracing
     to determine pixel colors based on scene intersections.
 
+    Every render leaves the averaged, unclipped colors in framebuffer, a (img_height, img_width, 3) float array
+    that save_image() writes to disk; the canvas only receives its 8-bit copy.
+
     Args:
         scene (Scene): The 3D scene to be rendered.
         img_width (int, optional): Width of the output image in pixels. Defaults to 400.
@@ -22,6 +88,32 @@ class Camera:
         lookat (List[float], optional): The point in space the camera is looking at. Defaults to (0, 0, -1).
         vup (List[float], optional): The "up" direction for the camera, defining the camera's orientation. Defaults to (0, 1, 0).
         fov (int, optional): Field of view in degrees. Determines the extent of the observable world. Defaults to 60.
+        trace_algorithm (str, optional): "raytracing" or "pathtracing". Defaults to "raytracing".
+        render_mode (str, optional): "scalar" traces one Ray object at a time, "packet" builds the primary rays
+            of a tile as NumPy arrays and intersects them in bulk with every triangle, without the scene's
+            acceleration structure; path tracing then runs as a wavefront over all live paths of the tile.
+            Defaults to "scalar".
+        workers (int, optional): Number of processes rendering tiles in parallel. Defaults to 1 (in-process).
+        seed (int, optional): Non-negative seed of the sampler. Defaults to 0.
+        samples_per_pixel (int, optional): Samples per pixel when adaptive sampling is off. Defaults to 5.
+        adaptive_sampling (bool, optional): Keep sampling a pixel until the variance of its mean luminance falls
+            below variance_threshold or max_spp samples were taken. Defaults to False.
+        min_spp (int, optional): Samples every pixel receives before its variance is checked. Defaults to 4.
+        max_spp (int, optional): Upper bound of samples per pixel in adaptive mode. Defaults to 32.
+        variance_threshold (float, optional): Variance of the mean luminance (colors in [0, 1]) below which a
+            pixel is considered converged. Defaults to 1e-4.
+        progress (bool, optional): Show a progress bar while rendering. Defaults to True.
+        headless (bool, optional): Render into framebuffer only, without creating a pygame canvas. Defaults to
+            False.
+        next_event_estimation (bool, optional): Path tracing samples the scene's emissive triangles directly at
+            every diffuse hit, combined with the bounce by multiple importance sampling. Defaults to True.
+        russian_roulette (bool, optional): Path tracing terminates paths of low throughput at random after
+            RUSSIAN_ROULETTE_DEPTH bounces instead of always tracing them to the maximal depth. Defaults to True.
+        sampler (str, optional): Source of the pixel jitter and of all random decisions of the integrators, one of
+            core.Sampler.SAMPLERS: "independent", "stratified" or "halton". Defaults to "stratified".
+        max_depth (int, optional): Intersections traced along a ray: the chain of mirror and glass bounces of ray
+            tracing or the bounces of a path. Defaults to None, which is WHITTED_MAX_DEPTH for ray tracing and
+            PATHTRACE_MAX_DEPTH for path tracing.
     """
     def __init__(self,
                  scene: Scene,
@@ -31,14 +123,49 @@ class Camera:
                  lookat: List[float] = (0,.75,-1), #Scene_3:(0,.0,-1),Scene_2:(0,.75,-1),Benchamrk:(0,0,-14)
                  vup: List[float] =(0,1,0),
                  fov: int = 60,
-                 trace_algorithm: str = "raytracing"):
+                 trace_algorithm: str = "raytracing",
+                 render_mode: str = "scalar",
+                 workers: int = 1,
+                 seed: int = 0,
+                 samples_per_pixel: int = 5,
+                 adaptive_sampling: bool = False,
+                 min_spp: int = 4,
+                 max_spp: int = 32,
+                 variance_threshold: float = 1e-4,
+                 progress: bool = True,
+                 headless: bool = False,
+                 next_event_estimation: bool = True,
+                 russian_roulette: bool = True,
+                 sampler: str = "stratified",
+                 max_depth: int = None):
         self.scene = scene
         self.img_width = img_width
         self.img_height = img_height
         self.camera_origin = tuple(camera_origin)
         self.fov = fov
-        self.canvas = pygame.Surface((img_width, img_height))
+        self.canvas = None if headless else pygame.Surface((img_width, img_height))
+        self.framebuffer = np.zeros((img_height, img_width, 3), dtype=np.float64)
         self.trace_algorithm = trace_algorithm
+        self.render_mode = render_mode
+        self.samples_per_pixel = samples_per_pixel
+        self.adaptive_sampling = adaptive_sampling
+        self.min_spp = max(2, min_spp)
+        self.max_spp = max(self.min_spp, max_spp)
+        self.variance_threshold = variance_threshold
+        self.progress = progress
+        self.next_event_estimation = next_event_estimation
+        self.russian_roulette = russian_roulette
+        self.max_depth = max_depth
+        self.spp_map = None
+        self.average_spp = 0.0
+        self.tile_size = 32
+        self.workers = workers
+        self.seed = seed
+        self.sampler_name = sampler
+        self.sampler = create_sampler(sampler, seed, self.min_spp if adaptive_sampling else samples_per_pixel)
+        # address of the camera sample being traced, see trace_sample
+        self._pixel = 0
+        self._sample_index = 0
         theta = math.radians(fov)
         half_width = math.tan(theta/2)
         self.viewport_width = 2* half_width
@@ -62,167 +189,444 @@ class Camera:
         Generates a ray originating from the camera and passing through the pixel at (i, j).
         """
 
-        offset_x = random.uniform(0,1) - 1
-        offset_y = random.uniform(0,1) - 1
+        offset_x = self.sample_1d(0) - 1
+        offset_y = self.sample_1d(1) - 1
         pixel_sample = add(self.pixel_00, add(scale(i + offset_x, self.pixel_delta_u), scale(j + offset_y, self.pixel_delta_v)))
         ray_direction = sub(pixel_sample, self.camera_origin)
         return Ray(self.camera_origin, ray_direction)
 
 
+    def __getstate__(self):
+        # pygame surfaces cannot be pickled; worker processes only return tile colors and never touch the canvas
+        state = self.__dict__.copy()
+        state['canvas'] = None
+        state['framebuffer'] = None
+        return state
+
+    def tiles(self) -> List[Tuple[int, int, int, int, int]]:
+        """
+        Splits the image into tile_size x tile_size tiles.
+
+        Returns:
+            list of tuple: (tile_index, x0, y0, x1, y1) for every tile, in row-major order.
+        """
+        tiles = []
+        for y0 in range(0, self.img_height, self.tile_size):
+            for x0 in range(0, self.img_width, self.tile_size):
+                x1, y1 = min(x0 + self.tile_size, self.img_width), min(y0 + self.tile_size, self.img_height)
+                tiles.append((len(tiles), x0, y0, x1, y1))
+        return tiles
+
     def render(self):
         """
         Renders the scene by casting rays through each pixel and determining their colors based on scene intersections.
         The rendered image is displayed on the Pygame surface.
+
+        The image is rendered tile by tile, either in-process or, with workers > 1, on a process pool where every
+        worker receives the camera together with the built scene and acceleration structure once. All random
+        numbers come from the sampler, addressed by pixel, sample index and dimension, so the image does not depend
+        on the worker count or on the order in which tiles finish. The number of samples taken for every pixel is kept in spp_map and its mean
+        in average_spp.
+        """
+        if self.render_mode == "packet":
+            PacketScene.from_scene(self.scene)  # built before forking so workers inherit it
+        with tqdm(total=self.img_height * self.img_width, desc="Rendering", unit="pixel",
+                  disable=not self.progress) as pbar:
+            with self._render_pool() as pool:
+                image, self.spp_map = self._render_pass(pool, pbar=pbar)
+        self.average_spp = float(self.spp_map.mean())
+        self._blit(image)
+
+    def render_progressive(self, preview_blocks: Tuple[int, ...] = (16, 4)):
+        """
+        Renders the scene in passes of increasing quality, updating the canvas after every pass.
+
+        The first passes trace a single ray through the center of every preview_blocks[k] x preview_blocks[k]
+        block and fill the whole block with its color, so a coarse image is available after a fraction of a
+        sample per pixel. Then samples_per_pixel accumulation passes follow, each adding one sample to every pixel.
+        Adaptive sampling is not used here; stopping after any pass leaves an image with uniform sample counts.
+
+        This is a generator: the caller can display the canvas and handle events between passes, and stops the
+        render by no longer iterating.
+
+        Yields:
+            dict: "pass" (pass number), "kind" ("preview" or "accumulate"), "spp" (samples per pixel accumulated
+            so far, 0 for previews) and "time" (seconds since the render started).
+        """
+        start = time.perf_counter()
+        pass_number = 0
+        for block in preview_blocks:
+            self._blit(self._render_preview(block))
+            pass_number += 1
+            yield {"pass": pass_number, "kind": "preview", "spp": 0, "time": time.perf_counter() - start}
+
+        if self.render_mode == "packet":
+            PacketScene.from_scene(self.scene)
+        accumulated = np.zeros((self.img_height, self.img_width, 3), dtype=np.float64)
+        self.spp_map = np.zeros((self.img_height, self.img_width), dtype=np.int32)
+        with self._render_pool() as pool:
+            for sample_pass in range(self.samples_per_pixel):
+                colors, spp = self._render_pass(pool, samples=1, pass_index=sample_pass)
+                accumulated += colors * spp[..., None]
+                self.spp_map += spp
+                self.average_spp = float(self.spp_map.mean())
+                self._blit(accumulated / self.spp_map[..., None])
+                pass_number += 1
+                yield {"pass": pass_number, "kind": "accumulate", "spp": sample_pass + 1,
+                       "time": time.perf_counter() - start}
+
+    def _render_pool(self):
+        """
+        Returns a process pool for workers > 1, or a no-op context manager for in-process rendering.
+        """
+        if self.workers > 1:
+            return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_render_worker, initargs=(self,))
+        return nullcontext()
+
+    def _render_pass(self, pool, samples: int = None, pass_index: int = None, pbar=None):
+        """
+        Renders every tile once, on the pool if one is given, and returns the (colors, spp) arrays of the image.
+        """
+        image = np.zeros((self.img_height, self.img_width, 3), dtype=np.float64)
+        spp_map = np.zeros((self.img_height, self.img_width), dtype=np.int32)
+        tasks = [(tile, samples, pass_index) for tile in self.tiles()]
+        if pool is not None:
+            results = (future.result() for future in
+                       as_completed([pool.submit(_render_tile_in_worker, task) for task in tasks]))
+        else:
+            results = ((task, self.render_tile(*task[0], samples=samples, pass_index=pass_index)) for task in tasks)
+        for ((_, x0, y0, x1, y1), _, _), (colors, spp) in results:
+            image[y0:y1, x0:x1] = colors
+            spp_map[y0:y1, x0:x1] = spp
+            if pbar is not None:
+                pbar.update((x1 - x0) * (y1 - y0))
+        return image, spp_map
+
+    def _render_preview(self, block: int) -> np.ndarray:
+        """
+        Traces one ray through the center of every block x block pixel block and returns the block-filled image.
+        """
+        rows = [min(y + block // 2, self.img_height - 1) for y in range(0, self.img_height, block)]
+        cols = [min(x + block // 2, self.img_width - 1) for x in range(0, self.img_width, block)]
+        centers = np.array([j * self.img_width + i for j in rows for i in cols])
+        if self.render_mode == "packet":
+            origins, directions, _, image_pixel, sample_index = primary_rays(self, 0, 0, self.img_width,
+                                                                             self.img_height, 1, pixels=centers)
+            colors = self.trace_packet(PacketScene.from_scene(self.scene), origins, directions, image_pixel,
+                                       sample_index)
+        else:
+            colors = np.array([self.trace_sample(i, j) for j in rows for i in cols])
+        colors = colors.reshape(len(rows), len(cols), 3)
+        image = np.repeat(np.repeat(colors, block, axis=0), block, axis=1)
+        return image[:self.img_height, :self.img_width]
+
+    def _blit(self, image: np.ndarray):
+        # one bulk copy per pass instead of writing the canvas pixel by pixel
+        self.framebuffer = image
+        if self.canvas is not None:
+            pygame.surfarray.blit_array(self.canvas, to_ldr(image).transpose(1, 0, 2))
+
+    def save_image(self, path: str):
+        """
+        Writes the framebuffer of the last render or pass to path (.png, .ppm or .pfm, see ImageOutput.save_image).
         """
-        total_pixels = self.img_height * self.img_width
-        with tqdm(total=total_pixels, desc="Rendering", unit="pixel") as pbar:
-            for j in range(self.img_height):
-                for i in range(self.img_width):
-                    pixel_color = [0,0,0]
-                    for sample in range(5): #TODO: various number of samples per pixel
-                        ray = self.get_ray(i,j)
-                        if self.trace_algorithm == "raytracing":
-                            color = self.get_color(ray)
-                        elif self.trace_algorithm == "pathtracing":
-                            color=self.get_color_pathtrace(ray)
-                        pixel_color = add(pixel_color, color)
-                    pixel_color = [min(255, max(0, val*255/5)) for val in pixel_color]
-                    self.canvas.set_at((i, j), pixel_color)
-                    
-                    pbar.update(1)
-
-    def get_color(self, ray,depth=0):
-        if depth >5 :
-            return [0,0,0]
-        hit = self.scene.hit(ray)
-        if hit:
+        save_image(path, self.framebuffer)
+
+    def render_tile(self, tile_index: int, x0: int, y0: int, x1: int, y1: int, samples: int = None,
+                    pass_index: int = None) -> np.ndarray:
+        """
+        Renders the pixel rectangle [x0, x1) x [y0, y1). With samples given every pixel gets exactly that many
+        samples, otherwise samples_per_pixel or, with adaptive_sampling, min_spp to max_spp. Progressive pass
+        pass_index takes the sample indices following those of the earlier passes.
+
+        Returns:
+            tuple: (colors, spp) with the (y1 - y0, x1 - x0, 3) averaged colors in [0, 1] units and the
+            (y1 - y0, x1 - x0) number of samples taken for every pixel.
+        """
+        first_sample = 0 if pass_index is None else pass_index * samples
+        if self.render_mode == "packet":
+            return self.render_tile_packet(PacketScene.from_scene(self.scene), x0, y0, x1, y1, samples, first_sample)
+        return self.render_tile_scalar(x0, y0, x1, y1, samples, first_sample)
+
+    def _converged(self, samples, luminance_sum, luminance_sq_sum):
+        """
+        True where the variance of the mean luminance, estimated from the running sums of at least two samples, is
+        below variance_threshold. Works on scalars and on NumPy arrays.
+        """
+        variance = (luminance_sq_sum - luminance_sum * luminance_sum / samples) / (samples - 1)
+        return variance / samples <= self.variance_threshold
+
+    def sample_1d(self, dimension: int) -> float:
+        """
+        Sampler value of the camera sample being traced in the given dimension.
+        """
+        return self.sampler.get(self._pixel, self._sample_index, dimension)
+
+    def trace_sample(self, i: int, j: int, index: int = 0) -> List[float]:
+        """
+        Traces the index-th jittered sample through pixel (i, j) with the configured algorithm and returns its color.
+        """
+        self._pixel = j * self.img_width + i
+        self._sample_index = index
+        ray = self.get_ray(i,j)
+        if self.trace_algorithm == "raytracing":
+            color = self.get_color(ray)
+        elif self.trace_algorithm == "pathtracing":
+            color=self.get_color_pathtrace(ray)
+        return color[:3]
+
+    def render_tile_scalar(self, x0: int, y0: int, x1: int, y1: int, samples: int = None, first_sample: int = 0):
+        """
+        Traces one tile ray by ray and returns its averaged (y1 - y0, x1 - x0, 3) colors in [0, 1] units and the
+        number of samples taken for every pixel.
+        """
+        colors = np.zeros((y1 - y0, x1 - x0, 3), dtype=np.float64)
+        spp = np.zeros((y1 - y0, x1 - x0), dtype=np.int32)
+        adaptive = self.adaptive_sampling and samples is None
+        if samples is None:
+            samples = self.max_spp if adaptive else self.samples_per_pixel
+        for j in range(y0, y1):
+            for i in range(x0, x1):
+                pixel_color = [0,0,0]
+                luminance_sum = luminance_sq_sum = 0.0
+                taken = 0
+                while taken < samples:
+                    color = self.trace_sample(i, j, first_sample + taken)
+                    pixel_color = add(pixel_color, color)
+                    taken += 1
+                    if adaptive:
+                        luminance = dot(LUMINANCE, color)
+                        luminance_sum += luminance
+                        luminance_sq_sum += luminance * luminance
+                        if taken >= self.min_spp and self._converged(taken, luminance_sum, luminance_sq_sum):
+                            break
+                colors[j - y0, i - x0] = [val / taken for val in pixel_color]
+                spp[j - y0, i - x0] = taken
+        return colors, spp
+
+    def render_tile_packet(self, packet_scene: PacketScene, x0: int, y0: int, x1: int, y1: int,
+                           samples: int = None, first_sample: int = 0):
+        """
+        Traces one tile as a packet and returns its averaged (y1 - y0, x1 - x0, 3) colors in [0, 1] units and the
+        number of samples taken for every pixel.
+
+        In adaptive mode the tile is traced in rounds of min_spp samples; every round only re-traces the pixels
+        that have not converged yet.
+        """
+        pixel_count = (x1 - x0) * (y1 - y0)
+        pixel_colors = np.zeros((pixel_count, 3), dtype=np.float64)
+        spp = np.zeros(pixel_count, dtype=np.int32)
+        luminance_sum = np.zeros(pixel_count, dtype=np.float64)
+        luminance_sq_sum = np.zeros(pixel_count, dtype=np.float64)
+        active = np.arange(pixel_count)
+        adaptive = self.adaptive_sampling and samples is None
+        if samples is None:
+            samples = self.min_spp if adaptive else self.samples_per_pixel
+
+        while active.size:
+            origins, directions, pixel, image_pixel, sample_index = primary_rays(
+                self, x0, y0, x1, y1, samples, pixels=active, first_sample=first_sample + spp[active])
+            colors = self.trace_packet(packet_scene, origins, directions, image_pixel, sample_index)
+            np.add.at(pixel_colors, pixel, colors)
+            spp[active] += samples
+            if not adaptive:
+                break
+            luminance = colors @ np.asarray(LUMINANCE)
+            np.add.at(luminance_sum, pixel, luminance)
+            np.add.at(luminance_sq_sum, pixel, luminance * luminance)
+            done = self._converged(spp[active], luminance_sum[active], luminance_sq_sum[active])
+            active = active[~done & (spp[active] < self.max_spp)]
+            if active.size:
+                samples = min(self.min_spp, self.max_spp - int(spp[active[0]]))
+
+        colors = (pixel_colors / spp[:, None]).reshape(y1 - y0, x1 - x0, 3)
+        return colors, spp.reshape(y1 - y0, x1 - x0)
+
+    def trace_packet(self, packet_scene: PacketScene, origins: np.ndarray, directions: np.ndarray,
+                     image_pixel: np.ndarray, sample_index: np.ndarray) -> np.ndarray:
+        """
+        Returns the (N, 3) colors of a packet of primary rays, given the image pixel and sample index of every ray.
+        """
+        if self.trace_algorithm == "raytracing":
+            max_depth = self.max_depth if self.max_depth is not None else WHITTED_MAX_DEPTH
+            return trace_whitted_packet(self, packet_scene, origins, directions, image_pixel, sample_index,
+                                        max_depth=max_depth)
+        lights = self.scene.area_lights if self.next_event_estimation else None
+        max_depth = self.max_depth if self.max_depth is not None else PATHTRACE_MAX_DEPTH
+        return trace_pathtrace_packet(packet_scene, origins, directions, self.sampler, image_pixel, sample_index,
+                                      max_depth=max_depth, lights=lights,
+                                      russian_roulette_depth=RUSSIAN_ROULETTE_DEPTH if self.russian_roulette else None)
+
+    def get_color(self, ray, max_depth: int = None) -> List[float]:
+        """
+        Whitted ray traced color along a camera ray.
+
+        Glass picks reflection or refraction at random (with the Fresnel reflectance as probability) instead of
+        tracing both, so a ray never splits and its chain of bounces is followed in a loop carrying the weight of
+        the next hit: mirrors (illumination model 3) add 1 - MIRROR_REFLECTIVITY of their Phong color and pass
+        MIRROR_REFLECTIVITY on. The chain ends on a diffuse surface (illumination model 2), on a miss or other
+        illumination model (the sky) or after max_depth intersections, which then contribute nothing.
+        """
+        if max_depth is None:
+            max_depth = self.max_depth if self.max_depth is not None else WHITTED_MAX_DEPTH
+        color = [0.0, 0.0, 0.0]
+        weight = 1.0
+        for depth in range(max_depth):
+            hit = self.scene.hit(ray)
+            if not hit:
+                return add(color, scale(weight, background(ray)))
             t, intersection_point, face = hit
-            if face.material.illumination_model == 2:
-                out_color = scale(self.scene.ambient_light, face.material.ambient)
-
-                for light in self.scene.lights:
-                    light_ray = Ray(add(intersection_point, scale(1e-3, face.unit_norm)),
-                                    norm(sub(light.position, intersection_point)))
-                    t_to_light = sum(x ** 2 for x in sub(light.position, intersection_point)) ** (1 / 2)
-                    light_hit = self.scene.hit(light_ray)
-
-                    if light_hit:
-                        light_t, _, _ = light_hit
-                        if light_t < t_to_light:
-                            continue
-                    out_color =  self.phong(face, light, intersection_point)
-
-                return out_color
-            if face.material.illumination_model == 3:
+            material = face.record
+            illum = material.illumination_model
+            if illum == 2:
+                return add(color, scale(weight, self.shade_diffuse(face, intersection_point)))
+            if illum == 3:
                 phong_color = self.phong(face, self.scene.lights[0], intersection_point)
-                reflectivity = 0.7
-                return add(scale(1 - reflectivity, phong_color), scale(reflectivity, self.get_reflect(ray, face, intersection_point, depth + 1)))
-                #return matmul(self.get_color(reflected_ray), face.material.diffuse)
-
-            if face.material.illumination_model == 4 or face.material.illumination_model == 5:
-                R_0 = ((1 - face.material.optical_density)/(1 + face.material.optical_density))**2
+                color = add(color, scale(weight * (1 - MIRROR_REFLECTIVITY), phong_color))
+                weight *= MIRROR_REFLECTIVITY
+                ray = reflect_ray(ray, face, intersection_point)
+            elif material.is_glass:
+                R_0 = material.reflectance
                 theta = dot(norm(ray.direction), face.unit_norm)
                 reflection_probability = R_0 + (1-R_0)*(1-math.cos(theta))**5
-                does_reflect = random.choices([True, False], weights=[reflection_probability, 1-reflection_probability], k=1)[0]
-                if does_reflect: #Reflect
-                    color = self.get_reflect(ray, face, intersection_point, depth + 1)
+                if self.sample_1d(bounce_dimension(depth, BSDF_U)) < reflection_probability:
+                    ray = reflect_ray(ray, face, intersection_point)
                 else:
-                    color = self.get_refraction(ray, face, intersection_point, depth + 1)
-                return color if color else [0,0,0]
+                    ray = refract_ray(ray, face, intersection_point)
+            else:
+                return add(color, scale(weight, background(ray)))
+        return color
 
-        unit_ray_direction = norm(ray.direction)
-        a = 0.5 * (unit_ray_direction[1] + 1)
-        return add(scale(1.0 - a, [1, 1, 1]), scale(a, [0.5, 0.7, 1.0]))
+    def shade_diffuse(self, face, intersection_point) -> List[float]:
+        """
+        Color of a diffuse (illumination model 2) hit: the ambient term, replaced by the Phong color of the last
+        light that is not occluded.
+        """
+        out_color = scale(self.scene.ambient_light, face.record.ambient)
+        shadow_origin = add(intersection_point, scale(1e-3, face.unit_norm))
+        for light in self.scene.lights:
+            light_ray = Ray(shadow_origin,
+                            norm(sub(light.position, intersection_point)))
+            t_to_light = sum(x ** 2 for x in sub(light.position, intersection_point)) ** (1 / 2)
+            if self.scene.occluded(light_ray, t_to_light):
+                continue
+            out_color = self.phong(face, light, intersection_point)
+        return out_color
 
     def phong(self, face, light, intersection_point) -> List[float]:
-        Ns, ka, kd, ks, Ni, d, illum = (face.material.shininess,
-                                        face.material.ambient,
-                                        face.material.diffuse,
-                                        face.material.specular,
-                                        face.material.optical_density,
-                                        face.material.transparency,
-                                        face.material.illumination_model,)
+        material = face.record
+        Ns, ka, kd, ks = material.shininess, material.ambient, material.diffuse, material.specular
+        N = face.unit_norm
         L = norm(sub(light.position, intersection_point))
-        R = norm(sub(scale(2 * dot(face.unit_norm, L), face.unit_norm), L))
+        R = norm(sub(scale(2 * dot(N, L), N), L))
         V = norm(sub(self.camera_origin, intersection_point))
         color = add(scale(self.scene.ambient_light, ka), scale(light.intensity, matmul(light.color, add(scale(
-            max(0, dot(L, face.unit_norm)), kd), scale(max(0, dot(R, V)) ** Ns, ks)))))
+            max(0, dot(L, N)), kd), scale(max(0, dot(R, V)) ** Ns, ks)))))
         return color
 
-    def get_reflect(self, ray, face, intersection_point, depth):
-        direction = sub(ray.direction, scale(2 * dot(ray.direction, face.unit_norm), face.unit_norm))
-        reflected_ray = Ray(intersection_point, direction)
-        return self.get_color(reflected_ray, depth + 1)
-
-    def get_refraction(self, ray, face, intersection_point, depth):
-        n1 = 1.0
-        n2 = face.material.optical_density
+    def get_color_pathtrace(self, ray, max_depth: int = None):
+        """
+        Path traced color along a camera ray.
+
+        The path is followed in a loop that carries its throughput. Diffuse surfaces are Lambertian (BRDF kd / pi)
+        and bounce into a cosine-weighted hemisphere direction. Mirrors (illumination model 3) reflect and tint by
+        their diffuse color, and emissive surfaces end the path. With next_event_estimation, every diffuse hit also
+        samples a point on the scene's area lights (sample_area_light); when a diffuse bounce itself reaches a light,
+        its emission is weighted against that light sample with the power heuristic. With russian_roulette, paths
+        past RUSSIAN_ROULETTE_DEPTH bounces survive with a probability given by their throughput and are reweighted
+        to stay unbiased. A path still alive after max_depth intersections contributes nothing more.
+        """
+        if max_depth is None:
+            max_depth = self.max_depth if self.max_depth is not None else PATHTRACE_MAX_DEPTH
+        lights = self.scene.area_lights if self.next_event_estimation else None
+        if lights is not None and not len(lights):
+            lights = None
+        color = [0.0, 0.0, 0.0]
+        throughput = [1.0, 1.0, 1.0]
+        # solid angle density of the last bounce direction; None after camera rays and mirror reflections
+        bsdf_pdf = None
+
+        for depth in range(max_depth):
+            hit = self.scene.hit(ray)
+            if not hit:
+                return add(color, matmul(throughput, background(ray)))
 
-        if dot(norm(ray.direction), face.unit_norm) > 0:
-            n1, n2 = n2, n1
-            normal = scale(-1, face.unit_norm)
-        else:
+            t, intersection_point, face = hit
+            material = face.record
             normal = face.unit_norm
+            if dot(ray.direction, normal) > 0:
+                normal = scale(-1, normal)
+
+            if material.illumination_model == 3:
+                reflected_dir = sub(ray.direction, scale(2 * dot(ray.direction, normal), normal))
+                ray = Ray(add(intersection_point, scale(1e-4, normal)), reflected_dir)
+                throughput = matmul(throughput, material.diffuse)
+                bsdf_pdf = None
+                continue
+
+            if material.is_emissive:
+                emission = material.emission
+                if lights is not None and bsdf_pdf is not None:
+                    # only buffer triangles are in the light list, not transformed instances of them
+                    area_pdf = lights.pdf(face.index) if isinstance(face, Triangle) else 0.0
+                    length2 = dot(ray.direction, ray.direction)
+                    cos_light = abs(dot(ray.direction, face.unit_norm)) / math.sqrt(length2)
+                    light_pdf = area_pdf * t * t * length2 / max(cos_light, 1e-12)
+                    emission = scale(power_heuristic(bsdf_pdf, light_pdf), emission)
+                return add(color, matmul(throughput, emission))
+
+            kd = material.diffuse
+            if lights is not None:
+                color = add(color, matmul(throughput, self.sample_area_light(lights, intersection_point, normal, kd,
+                                                                             depth)))
+            new_dir = cosine_hemisphere(self.sample_1d(bounce_dimension(depth, BSDF_U)),
+                                        self.sample_1d(bounce_dimension(depth, BSDF_V)), normal)
+            # BRDF kd / pi times the cosine over the density cos / pi leaves kd
+            throughput = matmul(throughput, kd)
+            bsdf_pdf = dot(new_dir, normal) / math.pi
+            ray = Ray(add(intersection_point, scale(1e-4, normal)), new_dir)
+
+            if self.russian_roulette and depth + 1 >= RUSSIAN_ROULETTE_DEPTH:
+                survival = min(max(throughput), 0.95)
+                if self.sample_1d(bounce_dimension(depth, ROULETTE)) >= survival:
+                    return color
+                throughput = scale(1 / survival, throughput)
+        return color
 
-        ri = n1 / n2
-        cos_theta = -dot(norm(ray.direction), normal)
-        sin_theta2 = ri ** 2 * (1 - cos_theta ** 2)
-
-        if sin_theta2 > 1.0:
-            return self.get_reflect(ray, face, intersection_point, depth)
-
-        ray_out_perp = scale(ri, add(norm(ray.direction), scale(cos_theta, normal)))
-        ray_out_parallel = scale(-math.sqrt(1.0 - sin_theta2), normal)
-        refracted_direction = add(ray_out_perp, ray_out_parallel)
-
-        refracted_ray = Ray(add(intersection_point, scale(1e-3, refracted_direction)), refracted_direction)
-
-        refracted_color = self.get_color(refracted_ray, depth + 1)
-        return refracted_color
-
-    def random_in_hemisphere(self,normal):
-        while True:
-            rx = random.uniform(-1, 1)
-            ry = random.uniform(-1, 1)
-            rz = random.uniform(-1, 1)
-            v = [rx, ry, rz]
-            if dot(v, v) <= 1.0:
-                v = norm(v)
-                if dot(v, normal) < 0:
-                    v = scale(-1, v)
-                return v
-
-    def get_color_pathtrace(self, ray, depth=0, max_depth=7):
-        if depth >= max_depth:
-            return [0,0,0]
-
-        hit = self.scene.hit(ray)
-        if not hit:
-            unit_ray_direction = norm(ray.direction)
-            a = 0.5 * (unit_ray_direction[1] + 1)
-            return add(scale(1.0 - a, [1, 1, 1]), scale(a, [0.5, 0.7, 1.0]))
+    def sample_area_light(self, lights, point, normal, kd, depth: int = 0) -> List[float]:
+        """
+        Next-event estimation at the diffuse hit of bounce depth: light reflected towards the path from one point
+        sampled on the scene's area lights, weighted by the power heuristic against hemisphere sampling of the same
+        direction.
+        """
+        face_index, light_point, area_pdf = lights.sample(self.sample_1d(bounce_dimension(depth, LIGHT_SELECT)),
+                                                          self.sample_1d(bounce_dimension(depth, LIGHT_U)),
+                                                          self.sample_1d(bounce_dimension(depth, LIGHT_V)))
+        light = self.scene.faces[face_index]
+        to_light = sub(light_point, point)
+        distance2 = dot(to_light, to_light)
+        distance = math.sqrt(distance2)
+        direction = div_by_scalar(to_light, distance)
+        cos_surface = dot(direction, normal)
+        cos_light = abs(dot(direction, light.unit_norm))
+        if cos_surface <= 0 or cos_light <= 0:
+            return [0.0, 0.0, 0.0]
+        if self.scene.occluded(Ray(add(point, scale(1e-4, normal)), direction), distance - 1e-3):
+            return [0.0, 0.0, 0.0]
 
-        t, intersection_point, face = hit
+        light_pdf = area_pdf * distance2 / cos_light
+        weight = power_heuristic(light_pdf, cos_surface / math.pi) * cos_surface / (math.pi * light_pdf)
+        return scale(weight, matmul(kd, light.record.emission))
 
 
+_worker_camera = None
 
-        normal = face.unit_norm
-        if dot(ray.direction, normal) > 0:
-            normal = scale(-1, normal)
 
-        if face.material.illumination_model == 3:
+def _init_render_worker(camera: Camera):
+    global _worker_camera
+    _worker_camera = camera
 
-            reflected_dir = sub(ray.direction, scale(2 * dot(ray.direction, normal), normal))
-            reflected_ray = Ray(add(intersection_point, scale(1e-4, normal)), reflected_dir)
-            return matmul(self.get_color_pathtrace(reflected_ray, depth + 1, max_depth),face.material.diffuse)
 
-        else:
-            emission_color = face.material.emissive
-            if emission_color != [0.,0.,0.,1.]:
-                return emission_color
-            kd = face.material.diffuse
-            new_dir = self.random_in_hemisphere(normal)
-            new_origin = add(intersection_point, scale(1e-4, normal))
-            new_ray = Ray(new_origin, new_dir)
-            bounce_color = self.get_color_pathtrace(new_ray, depth + 1, max_depth)
-            return add(matmul(kd, bounce_color),emission_color)
\ No newline at end of file
+def _render_tile_in_worker(task):
+    tile, samples, pass_index = task
+    return task, _worker_camera.render_tile(*tile, samples=samples, pass_index=pass_index)
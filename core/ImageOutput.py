@@ -0,0 +1,70 @@
+import os
+import struct
+import zlib
+import numpy as np
+
+
+def to_ldr(image: np.ndarray) -> np.ndarray:
+    """
+    Converts a (height, width, 3) float framebuffer in [0, 1] units to 8-bit pixels, clipping values outside
+    [0, 1] as the on-screen canvas does. uint8 images are returned unchanged.
+    """
+    if image.dtype == np.uint8:
+        return image
+    return np.clip(image * 255, 0, 255).astype(np.uint8)
+
+
+def write_ppm(path: str, image: np.ndarray) -> None:
+    """
+    Writes a binary (P6) PPM file.
+    """
+    pixels = to_ldr(image)
+    height, width = pixels.shape[:2]
+    with open(path, "wb") as f:
+        f.write(b"P6\n%d %d\n255\n" % (width, height))
+        f.write(np.ascontiguousarray(pixels).tobytes())
+
+
+def write_png(path: str, image: np.ndarray) -> None:
+    """
+    Writes an 8-bit RGB PNG file using only zlib, so no display or imaging library is needed.
+    """
+    pixels = to_ldr(image)
+    height, width = pixels.shape[:2]
+    # every scanline starts with its filter type, 0 (none)
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = pixels.reshape(height, width * 3)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def write_pfm(path: str, image: np.ndarray) -> None:
+    """
+    Writes a color PFM file: 32-bit floats without clipping, so HDR values above 1 are kept. PFM stores the rows
+    bottom to top; a negative scale marks little-endian data.
+    """
+    height, width = image.shape[:2]
+    with open(path, "wb") as f:
+        f.write(b"PF\n%d %d\n-1.0\n" % (width, height))
+        f.write(np.ascontiguousarray(image[::-1], dtype="<f4").tobytes())
+
+
+IMAGE_WRITERS = {".png": write_png, ".ppm": write_ppm, ".pfm": write_pfm}
+
+
+def save_image(path: str, image: np.ndarray) -> None:
+    """
+    Saves a (height, width, 3) framebuffer, with the format chosen by the file extension: .png and .ppm store 8-bit
+    pixels, .pfm the floating point values.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in IMAGE_WRITERS:
+        raise ValueError(f"unsupported image format {extension!r}, expected one of {', '.join(IMAGE_WRITERS)}")
+    IMAGE_WRITERS[extension](path, image)
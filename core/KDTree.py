@@ -1,8 +1,13 @@
+import math
+from array import array
+from collections import Counter
 from core.Utils import Utils
 from core.Ray import Ray
 from statistics import median
-from copy import deepcopy
+import numpy as np
 from models.Triangle import Triangle
+from core.ParallelBuild import (build_pool, split_levels, worker_faces, face_indices, replace_primitives,
+                                resolve_subtrees)
 
 
 class KdTreeNode:
@@ -32,6 +37,11 @@ class KdTreeNode:
     bbox : tuple[list[float], list[float]]
         Bounding box containing all the elements of obj_list. It consists of two three-element float list, each list
         specifies accordingly lower bound point and upper bound point
+    spawn : callable, optional
+        Used by parallel builds (see build_kd_tree): called as spawn(obj_list, depth, bbox) for the children below
+        the first levels levels, it returns a Future that takes the place of the child until the worker is done.
+    levels : int
+        Number of levels built in this process before children are handed to spawn.
 
     Attributes
     ----------
@@ -51,16 +61,17 @@ class KdTreeNode:
     """
     _MAX_DEPTH = 16
 
-    def __init__(self, obj_list: list[Triangle], depth: int, bbox: tuple[list[float], list[float]]):
+    def __init__(self, obj_list: list[Triangle], depth: int, bbox: tuple[list[float], list[float]], spawn=None,
+                 levels: int = 0):
         self.depth = depth
         self.meshes_list = obj_list
-        self.bbox = deepcopy(bbox)  # needed, cause python tries to be smarter than its programmers
+        self.bbox = (list(bbox[0]), list(bbox[1]))  # children get their own corner lists, see _split_bbox_and_list
         self.new_point = (-1, float('inf'))
 
         if self._is_splitable():
             left, right = self._split_bbox_and_list()  # tuples -> (bbox, mesh_list)
-            self.first_child = KdTreeNode(obj_list=left[1], depth=self.depth + 1, bbox=left[0])
-            self.second_child = KdTreeNode(obj_list=right[1], depth=self.depth + 1, bbox=right[0])
+            self.first_child = self._child(left, spawn, levels)
+            self.second_child = self._child(right, spawn, levels)
             self.is_leaf = False
 
         else:
@@ -68,6 +79,12 @@ class KdTreeNode:
             self.second_child = None
             self.is_leaf = True
 
+    def _child(self, part, spawn, levels):
+        bbox, obj_list = part
+        if spawn is not None and levels <= 1:
+            return spawn(obj_list, self.depth + 1, bbox)
+        return KdTreeNode(obj_list=obj_list, depth=self.depth + 1, bbox=bbox, spawn=spawn, levels=levels - 1)
+
     def _split_bbox_and_list(self):
         """Split bounding box into two and create two lists of meshes for them
 
@@ -83,9 +100,10 @@ class KdTreeNode:
         coords = [[], [], []]  # all mesh points coordinates list
 
         for mesh in self.meshes_list:
-            coords[0] += [mesh.v0[0], mesh.v1[0], mesh.v2[0]]  # x
-            coords[1] += [mesh.v0[1], mesh.v1[1], mesh.v2[1]]  # y
-            coords[2] += [mesh.v0[2], mesh.v1[2], mesh.v2[2]]  # z
+            v0, v1, v2 = mesh.vertices
+            coords[0] += [v0[0], v1[0], v2[0]]  # x
+            coords[1] += [v0[1], v1[1], v2[1]]  # y
+            coords[2] += [v0[2], v1[2], v2[2]]  # z
 
         bbox_lengths = [abs(length_) for length_ in Utils.sub(self.bbox[1], self.bbox[0])]
         side_idx = bbox_lengths.index(max(bbox_lengths))  # index of the longest side
@@ -94,9 +112,9 @@ class KdTreeNode:
         # So when splitting a 3D bbox into two halves by splitting, we move either the upper bound point for left bbox
         # or the lower bound point for right bbox. These points are moved by updating the value of side, where the split
         # is happenning; so if we split along x-axis, we will update only x coordinates for those points.
-        l_bbox = deepcopy(self.bbox)
+        l_bbox = (list(self.bbox[0]), list(self.bbox[1]))
         l_bbox[1][side_idx] = new_pos
-        r_bbox = deepcopy(self.bbox)
+        r_bbox = (list(self.bbox[0]), list(self.bbox[1]))
         r_bbox[0][side_idx] = new_pos
         self.new_point = (side_idx, new_pos)
 
@@ -106,10 +124,11 @@ class KdTreeNode:
         l_list = []
         r_list = []
         for mesh in self.meshes_list:
-            if any(point_coords <= new_pos for point_coords in [mesh.v0[side_idx], mesh.v1[side_idx], mesh.v2[side_idx]]):
+            side_coords = [vertex[side_idx] for vertex in mesh.vertices]
+            if any(point_coords <= new_pos for point_coords in side_coords):
                 l_list.append(mesh)
 
-            if any(point_coords >= new_pos for point_coords in [mesh.v0[side_idx], mesh.v1[side_idx], mesh.v2[side_idx]]):
+            if any(point_coords >= new_pos for point_coords in side_coords):
                 r_list.append(mesh)
 
         return (l_bbox, l_list), (r_bbox, r_list)
@@ -117,123 +136,471 @@ class KdTreeNode:
     def _is_splitable(self):
         return True if 1 < len(self.meshes_list) and self._MAX_DEPTH > self.depth else False
 
-    def traverse_tree(self, ray: Ray):
-        """Allows to travel down the Kd-tree to search for intersection with meshes
-
-        Implementation based on Indo-Wald's https://arxiv.org/abs/2211.00120
+    @staticmethod
+    def create_meshlist_bbox(mesh_list):
+        """Create bounding box that overlap all the meshes inside input list
 
-        Traversing happens by following steps:
-        > 0. check if node hit at all
-        > 1. if node is a leaf -> check all the meshes for hits
-        > 2. analyze backside child node -> node that is further from ray origin
-        > 3. analyze frontside child node
-        > 4. analyze both children in order: front, back. If hit is found, we can safely terminate.
+        Used to create bounding box for tree root, as bboxes for children nodes are provided by parent node
 
         Returns
         -------
-        tuple[float, list[float], Triangle],
-            (t parameter of ray equation, intersection point coordinates, hit mesh object) OR None
+        tuple[list[float], list[float]]
+            lower bound and upper bound point coordinates for boundingboxes
         """
-        ray_overall_tmin = ray.t_min
-        ray_overall_tmax = ray.t_max
-
-        r = (None, None, None)
-
-        # 0. if on hit -> break
-        for i in range(3):
-            adinv = 1.0 / (ray.direction[i] if abs(ray.direction[i]) > 1e-8 else 1e-8)
-            t0 = (self.bbox[0][i] - ray.origin[i]) * adinv
-            t1 = (self.bbox[1][i] - ray.origin[i]) * adinv
-
-            # store for later children order analysis
-            if i == self.new_point[0]:
-                r = (t0, t1, (self.new_point[1] - ray.origin[i]) * adinv)
-
-            # update min-max t-values
-            if t0 < t1:
-                if t0 > ray_overall_tmin: ray_overall_tmin = t0
-                if t1 < ray_overall_tmax: ray_overall_tmax = t1
-            else:
-                if t0 < ray_overall_tmax: ray_overall_tmax = t0
-                if t1 > ray_overall_tmin: ray_overall_tmin = t1
-
-            if ray_overall_tmax <= ray_overall_tmin:
-                return None
-
-        # 'new_pos' = median(point_coords[along_specified_axis]) change parameter explained
-        # so when splitting into two boundingboxes, we change one of the coordinates of corner by 'new_pos' or
-        # '-new_pos' along one of three global axes. Thus, comparing t0 and t1 agains a change parameter
-        #
-        # t_new = t0 + r = t1 - r
-        #
-        # so now, using Ingo Wald's thesis we can say, which of the children is first!
-
-        # 1. if at leaf, check all meshes
-        if self.is_leaf:
-            closest_intersection = None  # if no meshes hit, we return no hit
+        mesh_coords = [[], [], []]
+        for mesh in mesh_list:
+            v0, v1, v2 = mesh.vertices
+            mesh_coords[0] += [v0[0], v1[0], v2[0]]
+            mesh_coords[1] += [v0[1], v1[1], v2[1]]
+            mesh_coords[2] += [v0[2], v1[2], v2[2]]
 
-            for mesh in self.meshes_list:
-                res = mesh.hit(ray)
-                if res:
-                    t, intersection_point, face = res
+        return (
+            [min(mesh_coords[0]), min(mesh_coords[1]), min(mesh_coords[2])],
+            [max(mesh_coords[0]), max(mesh_coords[1]), max(mesh_coords[2])]
+            )
 
-                    if ray.t_min <= t <= ray.t_max:
-                        if not closest_intersection or t < closest_intersection[0]:
-                            closest_intersection = (t, intersection_point, face)
 
-            return closest_intersection
+class FlatKdTree:
+    """Linearized kd-tree with an iterative, interval-clipped traversal
 
-        # unpack r parameter values of P(r)=Q+rd
-        enter_point_parameter, leave_point_parameter, split_point_parameter = r
+    Nodes of a KdTreeNode tree are stored in depth-first order in flat arrays: the first child (below the split
+    plane) of an internal node directly follows it, the index of the second child is stored explicitly, and leaves
+    reference a contiguous range of the primitives list.
 
-        # Next steps are:
-        # 2. r_0 <= r_start <= r_end -> hit happens in backside node
-        # 3. r_start <= r_end <= r_0 -> hit happens in frontside node
-        # 4. r_start <= r_0 <= r_end -> hit happens in both child nodes
-        #
-        # if r_start >= r_end it means that hit happens from the other direction, so backside node becomes frontside and
-        # so on.
-        if enter_point_parameter < leave_point_parameter:
+    Only the root box is slab tested. Below it the [t_near, t_far] interval of the ray is cut at every split plane and
+    carried down with the child it belongs to, so the near child is visited first and the far child is pushed on an
+    explicit stack together with its own interval. Traversal stops as soon as the closest hit lies inside the current
+    cell's interval; a hit found beyond the cell does not end the search, because a closer triangle may still sit in
+    a later cell.
 
-            if split_point_parameter <= enter_point_parameter:
-                return self.second_child.traverse_tree(ray)
+    Triangles referenced by several leaves are tested once per ray: every traversal gets a new ray id, and a
+    triangle whose mailbox entry already holds that id is skipped.
 
-            elif split_point_parameter >= leave_point_parameter:
-                return self.first_child.traverse_tree(ray)
+    Attributes
+    ----------
+    bounds : tuple[list[float], list[float]]
+        Lower and upper corner of the root box.
+    split_axis : array of int
+        Split axis (0, 1, 2) of internal nodes, -1 for leaves.
+    split_position : array of float
+        Split plane coordinate of internal nodes.
+    second_child : array of int
+        Index of the second child (above the split plane) of internal nodes, -1 for leaves.
+    first_primitive : array of int
+        Offset of a leaf's first triangle in primitives.
+    primitive_count : array of int
+        Number of triangles of a leaf, 0 for internal nodes.
+    primitives : list[Triangle]
+        Triangles in leaf order; duplicated triangles appear once per leaf.
+    mailbox : array of int
+        Id of the last ray tested against each triangle, indexed by the triangle's buffer index.
+    node_visits : int
+        Number of nodes visited since the last reset_counters().
+    triangle_tests : int
+        Number of ray-triangle tests since the last reset_counters().
+    rays : int
+        Number of traversals so far. It doubles as the mailbox ray id and is therefore not reset by reset_counters().
+    """
+    def __init__(self, root: KdTreeNode):
+        self.bounds = (list(root.bbox[0]), list(root.bbox[1]))
+        self.split_axis = array('i')
+        self.split_position = array('d')
+        self.second_child = array('i')
+        self.first_primitive = array('i')
+        self.primitive_count = array('i')
+        self.primitives = []
+        self._flatten(root)
+        self._reset_mailbox()
 
+    @staticmethod
+    def from_arrays(bounds, split_axis, split_position, second_child, first_primitive, primitive_count, primitives):
+        """Recreate a flattened kd-tree from its node arrays (e.g. loaded from the scene cache) without the source tree"""
+        flat = FlatKdTree.__new__(FlatKdTree)
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(2, 3).tolist()
+        flat.bounds = (bounds[0], bounds[1])
+        flat.split_axis = array('i', np.asarray(split_axis, dtype=np.int32).tobytes())
+        flat.split_position = array('d', np.asarray(split_position, dtype=np.float64).tobytes())
+        flat.second_child = array('i', np.asarray(second_child, dtype=np.int32).tobytes())
+        flat.first_primitive = array('i', np.asarray(first_primitive, dtype=np.int32).tobytes())
+        flat.primitive_count = array('i', np.asarray(primitive_count, dtype=np.int32).tobytes())
+        flat.primitives = list(primitives)
+        flat._reset_mailbox()
+        return flat
+
+    def __len__(self) -> int:
+        return len(self.split_axis)
+
+    def _flatten(self, root: KdTreeNode):
+        stack = [(root, None)]
+        while stack:
+            node, parent = stack.pop()
+            index = len(self.split_axis)
+            if parent is not None:
+                self.second_child[parent] = index
+            self.first_primitive.append(len(self.primitives))
+            self.second_child.append(-1)
+            if node.is_leaf:
+                self.split_axis.append(-1)
+                self.split_position.append(0.0)
+                self.primitive_count.append(len(node.meshes_list))
+                self.primitives.extend(node.meshes_list)
             else:
-                first_hit = self.first_child.traverse_tree(ray)
-                return self.second_child.traverse_tree(ray) if not first_hit else first_hit
-
-        else:
-            if split_point_parameter <= leave_point_parameter:
-                return self.first_child.traverse_tree(ray)
+                self.split_axis.append(node.new_point[0])
+                self.split_position.append(node.new_point[1])
+                self.primitive_count.append(0)
+                # the first child is popped next and therefore stored right after its parent
+                stack.append((node.second_child, index))
+                stack.append((node.first_child, None))
+
+    def _reset_mailbox(self):
+        size = max((face.index for face in self.primitives), default=-1) + 1
+        self.mailbox = array('q', [-1]) * size
+        self.node_visits = 0
+        self.triangle_tests = 0
+        self.rays = 0
+
+    def reset_counters(self):
+        self.node_visits = 0
+        self.triangle_tests = 0
+
+    def hit(self, ray: Ray):
+        """Find the closest intersection between a ray and the triangles of the tree
 
-            elif split_point_parameter >= enter_point_parameter:
-                return self.second_child.traverse_tree(ray)
+        Returns
+        -------
+        tuple[float, list[float], Triangle]
+            (t, intersection_point, face) of the closest hit with ray.t_min <= t <= ray.t_max: the ray parameter,
+            the hit point and the hit Triangle; None if the ray misses
+        """
+        return self._traverse(ray, ray.t_max, False)
 
-            else:
-                first_hit = self.second_child.traverse_tree(ray)
-                return self.first_child.traverse_tree(ray) if not first_hit else first_hit
+    def occluded(self, ray: Ray, t_max: float) -> bool:
+        """Any-hit query: True as soon as some triangle is hit with ray.t_min <= t < t_max"""
+        return self._traverse(ray, t_max, True) is not None
 
-    @staticmethod
-    def create_meshlist_bbox(mesh_list):
-        """Create bounding box that overlap all the meshes inside input list
+    def _traverse(self, ray: Ray, t_max: float, any_hit: bool):
+        origin = ray.origin
+        direction = ray.direction
+        inv_direction = [1.0 / (d if abs(d) > 1e-8 else 1e-8) for d in direction]
+        t_min = ray.t_min
 
-        Used to create bounding box for tree root, as bboxes for children nodes are provided by parent node
+        t_near, t_far = t_min, t_max
+        for i in range(3):
+            t0 = (self.bounds[0][i] - origin[i]) * inv_direction[i]
+            t1 = (self.bounds[1][i] - origin[i]) * inv_direction[i]
+            if t0 > t1:
+                t0, t1 = t1, t0
+            if t0 > t_near: t_near = t0
+            if t1 < t_far: t_far = t1
+            if t_far < t_near:
+                return None
 
-        Returns
-        -------
-        tuple[list[float], list[float]]
-            lower bound and upper bound point coordinates for boundingboxes
-        """
-        mesh_coords = [[], [], []]
-        for mesh in mesh_list:
-            mesh_coords[0] += [mesh.v0[0], mesh.v1[0], mesh.v2[0]]
-            mesh_coords[1] += [mesh.v0[1], mesh.v1[1], mesh.v2[1]]
-            mesh_coords[2] += [mesh.v0[2], mesh.v1[2], mesh.v2[2]]
+        self.rays += 1
+        ray_id = self.rays
+        mailbox = self.mailbox
+        split_axis = self.split_axis
+        split_position = self.split_position
+        second_child = self.second_child
+        first_primitive = self.first_primitive
+        primitive_count = self.primitive_count
+        primitives = self.primitives
+
+        visits = tests = 0
+        closest = None
+        t_closest = t_max
+        stack = []
+        node = 0
+        while True:
+            visits += 1
+            axis = split_axis[node]
+            if axis >= 0:
+                position = split_position[node]
+                o, d = origin[axis], direction[axis]
+                if o < position or (o == position and d <= 0):
+                    near_child, far_child = node + 1, second_child[node]
+                else:
+                    near_child, far_child = second_child[node], node + 1
+                t_split = (position - o) * inv_direction[axis]
+                if t_split > t_far or t_split <= 0:
+                    node = near_child
+                elif t_split < t_near:
+                    node = far_child
+                else:
+                    stack.append((far_child, t_split, t_far))
+                    node, t_far = near_child, t_split
+                continue
+
+            first = first_primitive[node]
+            for face in primitives[first:first + primitive_count[node]]:
+                if mailbox[face.index] == ray_id:
+                    continue
+                mailbox[face.index] = ray_id
+                tests += 1
+                res = face.hit(ray)
+                if res and t_min <= res[0] <= t_closest:
+                    if any_hit:
+                        if res[0] < t_closest:
+                            self.node_visits += visits
+                            self.triangle_tests += tests
+                            return res
+                        continue
+                    closest = res
+                    t_closest = res[0]
+
+            if t_closest <= t_far or not stack:
+                break
+            node, t_near, t_far = stack.pop()
+            if t_closest < t_near:
+                break
+        self.node_visits += visits
+        self.triangle_tests += tests
+        return closest
+
+
+def build_kd_tree(faces: list[Triangle], builder: str = "sah", traversal_cost: float = 1.0,
+                  intersection_cost: float = 1.5, empty_bonus: float = 0.8, max_depth: int = None,
+                  workers: int = 1) -> KdTreeNode:
+    """Build a kd-tree over a list of triangles
+
+    The "median" builder is the original KdTreeNode constructor: it halves the longest side at the median vertex
+    coordinate down to KdTreeNode._MAX_DEPTH. The "sah" builder chooses every split plane with the surface area
+    heuristic evaluated over sorted bounding box events (see _sah_kd_split) and turns a node into a leaf as soon as no
+    split is cheaper than intersecting all of its triangles.
 
-        return (
-            [min(mesh_coords[0]), min(mesh_coords[1]), min(mesh_coords[2])],
-            [max(mesh_coords[0]), max(mesh_coords[1]), max(mesh_coords[2])]
-            )
+    Parameters
+    ----------
+    faces : list[Triangle]
+        Triangles of the scene, all views into the same TriangleBuffer.
+    builder : str
+        "median" or "sah".
+    traversal_cost : float
+        Cost of traversing one internal node (K_T), SAH builder only.
+    intersection_cost : float
+        Cost of one ray-triangle test (K_I), SAH builder only.
+    empty_bonus : float
+        Relative discount given to splits that cut off an empty child, SAH builder only.
+    max_depth : int
+        Hard depth limit of the SAH builder. Defaults to 8 + 1.3 * log2(len(faces)).
+    workers : int
+        Number of processes. With more than one, the top levels are split in this process and the subtrees below them
+        are built in parallel; the tree is identical to the serial one.
+
+    Returns
+    -------
+    KdTreeNode
+        Root of the tree. SAH nodes only keep meshes_list in leaves.
+    """
+    scene_bbox = KdTreeNode.create_meshlist_bbox(faces)
+    if builder == "median":
+        if workers <= 1 or not faces:
+            return KdTreeNode(obj_list=faces, depth=0, bbox=scene_bbox)
+        with build_pool(faces[0].buffer, workers) as pool:
+            def spawn_median(subset, depth, bbox):
+                return pool.submit(_build_kd_median_subtree, [face.index for face in subset], depth, bbox)
+            root = KdTreeNode(obj_list=faces, depth=0, bbox=scene_bbox, spawn=spawn_median,
+                              levels=split_levels(workers))
+            return resolve_subtrees(root, "meshes_list", ("first_child", "second_child"), faces)
+
+    if max_depth is None:
+        max_depth = int(round(8 + 1.3 * math.log2(max(len(faces), 1))))
+    indices = np.fromiter((face.index for face in faces), dtype=np.int64, count=len(faces))
+    bounds_min, bounds_max = faces[0].buffer.bounding_boxes()
+    costs = (traversal_cost, intersection_cost, empty_bonus)
+    node_min = np.array(scene_bbox[0], dtype=np.float64)
+    node_max = np.array(scene_bbox[1], dtype=np.float64)
+    if workers <= 1 or not faces:
+        return _build_sah_kd(faces, bounds_min[indices], bounds_max[indices], node_min, node_max, 0, max_depth, costs)
+
+    with build_pool(faces[0].buffer, workers) as pool:
+        def spawn(subset, sub_min, sub_max, sub_node_min, sub_node_max, depth):
+            return pool.submit(_build_kd_subtree, [face.index for face in subset], sub_min, sub_max, sub_node_min,
+                               sub_node_max, depth, max_depth, costs)
+        root = _build_sah_kd(faces, bounds_min[indices], bounds_max[indices], node_min, node_max, 0, max_depth, costs,
+                             spawn, split_levels(workers))
+        return resolve_subtrees(root, "meshes_list", ("first_child", "second_child"), faces)
+
+
+def _kd_node(obj_list: list[Triangle], depth: int, bbox_min: np.ndarray, bbox_max: np.ndarray) -> KdTreeNode:
+    """Create a leaf KdTreeNode without running the median split of the constructor"""
+    node = KdTreeNode.__new__(KdTreeNode)
+    node.depth = depth
+    node.meshes_list = obj_list
+    node.bbox = (bbox_min.tolist(), bbox_max.tolist())
+    node.new_point = (-1, float('inf'))
+    node.first_child = None
+    node.second_child = None
+    node.is_leaf = True
+    return node
+
+
+def _build_sah_kd(faces, bounds_min, bounds_max, node_min, node_max, depth, max_depth, costs, spawn=None,
+                  levels=0) -> KdTreeNode:
+    """Recursive SAH kd-tree build
+
+    bounds_min and bounds_max are the (N, 3) bounding boxes of faces. They are clipped to the node box first, so a
+    triangle straddling a split plane only contributes the part of its box that lies inside each child. In parallel
+    builds, the subtrees below the first levels levels are handed to spawn, which returns a Future in their place.
+    """
+    if spawn is not None and levels == 0:
+        return spawn(faces, bounds_min, bounds_max, node_min, node_max, depth)
+
+    node = _kd_node(faces, depth, node_min, node_max)
+    if not faces or depth >= max_depth:
+        return node
+
+    bounds_min = np.maximum(bounds_min, node_min)
+    bounds_max = np.minimum(bounds_max, node_max)
+    traversal_cost, intersection_cost, empty_bonus = costs
+    cost, axis, position, planar_left = _sah_kd_split(bounds_min, bounds_max, node_min, node_max, traversal_cost,
+                                                      intersection_cost, empty_bonus)
+    if cost >= intersection_cost * len(faces):
+        return node
+
+    lo, hi = bounds_min[:, axis], bounds_max[:, axis]
+    in_plane = (lo == position) & (hi == position)
+    left_mask = (lo < position) | (in_plane & planar_left)
+    right_mask = (hi > position) | (in_plane & ~planar_left)
+
+    left_max = node_max.copy()
+    left_max[axis] = position
+    right_min = node_min.copy()
+    right_min[axis] = position
+    left_idx = np.flatnonzero(left_mask)
+    right_idx = np.flatnonzero(right_mask)
+    node.first_child = _build_sah_kd([faces[i] for i in left_idx], bounds_min[left_idx], bounds_max[left_idx],
+                                     node_min, left_max, depth + 1, max_depth, costs, spawn, levels - 1)
+    node.second_child = _build_sah_kd([faces[i] for i in right_idx], bounds_min[right_idx], bounds_max[right_idx],
+                                      right_min, node_max, depth + 1, max_depth, costs, spawn, levels - 1)
+    node.new_point = (axis, position)
+    node.meshes_list = []
+    node.is_leaf = False
+    return node
+
+
+def _build_kd_median_subtree(indices, depth, bbox) -> KdTreeNode:
+    """Worker task of a parallel median build_kd_tree, returns the subtree with triangles replaced by their indices"""
+    root = KdTreeNode(obj_list=worker_faces(indices), depth=depth, bbox=bbox)
+    return replace_primitives(root, "meshes_list", ("first_child", "second_child"), face_indices)
+
+
+def _build_kd_subtree(indices, bounds_min, bounds_max, node_min, node_max, depth, max_depth, costs) -> KdTreeNode:
+    """Worker task of a parallel build_kd_tree, returns the subtree with triangles replaced by their indices"""
+    root = _build_sah_kd(worker_faces(indices), bounds_min, bounds_max, node_min, node_max, depth, max_depth, costs)
+    return replace_primitives(root, "meshes_list", ("first_child", "second_child"), face_indices)
+
+
+def _sah_kd_split(bounds_min, bounds_max, node_min, node_max, traversal_cost, intersection_cost, empty_bonus):
+    """Find the cheapest split plane of a kd-tree node with an event sweep
+
+    Along each axis every triangle box produces a start and an end event, or a single planar event when it is flat on
+    that axis. The events are sorted once (O(n log n)) and swept in order, so the number of triangles left of, right
+    of and lying in every candidate plane comes from running sums. The cost of a plane is
+
+        lambda * (K_T + K_I * (P_L * N_L + P_R * N_R))
+
+    where P_L and P_R are the surface areas of the children relative to the node, triangles lying in the plane are put
+    on the cheaper side, and lambda = 1 - empty_bonus when one child is empty, 1 otherwise.
+
+    Returns
+    -------
+    tuple[float, int, float, bool]
+        (cost, axis, position, planar_left), cost is inf when no plane lies strictly inside the node
+    """
+    count = len(bounds_min)
+    extent = node_max - node_min
+    node_area = 2.0 * (extent[0] * extent[1] + extent[1] * extent[2] + extent[2] * extent[0])
+    best = (float('inf'), None, None, True)
+    if node_area <= 0:
+        return best
+
+    for axis in range(3):
+        if extent[axis] <= 0:
+            continue
+        lo, hi = bounds_min[:, axis], bounds_max[:, axis]
+        flat = lo == hi
+        # kinds: 0 = end, 1 = planar, 2 = start
+        positions = np.concatenate((hi[~flat], lo[flat], lo[~flat]))
+        kinds = np.repeat(np.array([0, 1, 2]), [count - flat.sum(), flat.sum(), count - flat.sum()])
+        planes, event_plane = np.unique(positions, return_inverse=True)
+        per_plane = np.zeros((3, len(planes)), dtype=np.int64)
+        np.add.at(per_plane, (kinds, event_plane), 1)
+        ends, planars, starts = per_plane
+
+        n_left = np.concatenate(([0], np.cumsum(starts + planars)[:-1]))
+        n_right = count - np.cumsum(ends + planars)
+        inside = (planes > node_min[axis]) & (planes < node_max[axis])
+        if not inside.any():
+            continue
+        planes, n_left, n_right, planars = planes[inside], n_left[inside], n_right[inside], planars[inside]
+
+        other_a, other_b = (axis + 1) % 3, (axis + 2) % 3
+        cap = extent[other_a] * extent[other_b]
+        girth = extent[other_a] + extent[other_b]
+        p_left = 2.0 * (cap + girth * (planes - node_min[axis])) / node_area
+        p_right = 2.0 * (cap + girth * (node_max[axis] - planes)) / node_area
+
+        def plane_cost(left, right):
+            bonus = np.where((left == 0) | (right == 0), 1.0 - empty_bonus, 1.0)
+            return bonus * (traversal_cost + intersection_cost * (p_left * left + p_right * right))
+
+        cost_planar_left = plane_cost(n_left + planars, n_right)
+        cost_planar_right = plane_cost(n_left, n_right + planars)
+        planar_left = cost_planar_left <= cost_planar_right
+        cost = np.where(planar_left, cost_planar_left, cost_planar_right)
+        split = int(np.argmin(cost))
+        if cost[split] < best[0]:
+            best = (float(cost[split]), axis, float(planes[split]), bool(planar_left[split]))
+    return best
+
+
+def kd_tree_statistics(root: KdTreeNode, traversal_cost: float = 1.0, intersection_cost: float = 1.5) -> dict:
+    """Collect quality statistics of a kd-tree
+
+    The SAH cost is the expected cost of a random ray hitting the root box: every node contributes its surface area
+    relative to the root's, times traversal_cost for internal nodes and times intersection_cost per triangle for
+    leaves. The duplication factor is the number of triangle references held by leaves divided by the number of
+    distinct triangles; it is 1 for a tree that never duplicates straddling triangles.
+
+    Returns
+    -------
+    dict
+        sah_cost, node_count, leaf_count, empty_leaf_count, max_depth, reference_count, triangle_count,
+        duplication_factor and leaf_histogram (Counter of triangles per leaf)
+    """
+    def area(node):
+        extent = Utils.sub(node.bbox[1], node.bbox[0])
+        return 2.0 * (extent[0] * extent[1] + extent[1] * extent[2] + extent[2] * extent[0])
+
+    root_area = area(root) or 1.0
+    stats = {'sah_cost': 0.0, 'node_count': 0, 'leaf_count': 0, 'empty_leaf_count': 0, 'max_depth': 0,
+             'reference_count': 0, 'leaf_histogram': Counter()}
+    triangles = set()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        stats['node_count'] += 1
+        stats['max_depth'] = max(stats['max_depth'], node.depth - root.depth)
+        if node.is_leaf:
+            size = len(node.meshes_list)
+            stats['leaf_count'] += 1
+            stats['empty_leaf_count'] += size == 0
+            stats['reference_count'] += size
+            stats['leaf_histogram'][size] += 1
+            stats['sah_cost'] += area(node) / root_area * size * intersection_cost
+            triangles.update(face.index for face in node.meshes_list)
+        else:
+            stats['sah_cost'] += area(node) / root_area * traversal_cost
+            stack.extend((node.first_child, node.second_child))
+    stats['triangle_count'] = len(triangles)
+    stats['duplication_factor'] = stats['reference_count'] / max(len(triangles), 1)
+    return stats
+
+
+def report_kd_tree(root: KdTreeNode, name: str = "kd-tree", build_time: float = None) -> dict:
+    """Print the statistics of kd_tree_statistics in a compact form, so different builders can be compared"""
+    stats = kd_tree_statistics(root)
+    timing = f", built in {build_time:.3f} s" if build_time is not None else ""
+    print(f"{name}: SAH cost {stats['sah_cost']:.2f}, {stats['node_count']} nodes, {stats['leaf_count']} leaves "
+          f"({stats['empty_leaf_count']} empty), depth {stats['max_depth']}, {stats['reference_count']} references "
+          f"to {stats['triangle_count']} triangles (duplication {stats['duplication_factor']:.2f}){timing}")
+    return stats
@@ -0,0 +1,440 @@
+import numpy as np
+from Lights.AreaLights import power_heuristic
+from core.Sampler import (cosine_hemisphere_packet, bounce_dimension, LIGHT_SELECT, LIGHT_U, LIGHT_V, BSDF_U, BSDF_V,
+                          ROULETTE)
+
+_EPSILON = 1e-8
+
+# Share of a mirror's (illumination model 3) color taken from the reflected ray, the rest is its Phong color.
+MIRROR_REFLECTIVITY = 0.7
+
+
+class PacketScene:
+    """
+    Array view of a scene used by the packet (batched) tracing kernels.
+
+    Geometry comes straight from the scene's TriangleBuffer; on top of it the packet view adds per-triangle
+    barycentric transforms for intersect_packet and the columns of its MaterialTable for vectorized shading.
+
+    Attributes:
+        faces (list of Triangle): Scene faces, indexed the same way as the buffer arrays.
+        unit_norm (np.ndarray): (N, 3) unit normals.
+        material_index (np.ndarray): (N,) index into materials for every triangle.
+        materials (list): Materials referenced by material_index.
+        transform_rows, transform_offsets (np.ndarray): Per-triangle barycentric transforms, see
+            triangle_transforms.
+        ambient, diffuse, specular, emissive (np.ndarray): (M, 3) material colors.
+        shininess (np.ndarray): (M,) Phong exponents.
+        optical_density (np.ndarray): (M,) index of refraction of each material.
+        reflectance (np.ndarray): (M,) Fresnel reflectance at normal incidence (R_0) of each material.
+        illumination_model (np.ndarray): (M,) illumination model of each material.
+        is_glass, is_emissive (np.ndarray): (M,) whether a material is glass (illumination model 4 or 5) and
+            whether the path tracer treats it as a light.
+    """
+    def __init__(self, triangles, faces):
+        self.faces = faces
+        self.unit_norm = triangles.unit_norm
+        self.material_index = triangles.material_index
+        self.materials = triangles.materials
+        self.transform_rows, self.transform_offsets = triangle_transforms(triangles.v0, triangles.edge1,
+                                                                          triangles.edge2)
+
+        table = triangles.material_table
+        self.ambient = table.ambient
+        self.diffuse = table.diffuse
+        self.specular = table.specular
+        self.emissive = table.emission
+        self.shininess = table.shininess
+        self.optical_density = table.optical_density
+        self.reflectance = table.reflectance
+        self.illumination_model = table.illumination_model
+        self.is_glass = table.is_glass
+        self.is_emissive = table.is_emissive
+
+    @staticmethod
+    def from_scene(scene) -> "PacketScene":
+        """
+        Returns the packet view of a scene, building it on first use and caching it on the scene.
+        """
+        packet_scene = getattr(scene, 'packet_scene', None)
+        if packet_scene is None:
+            packet_scene = PacketScene(scene.triangles, scene.faces)
+            scene.packet_scene = packet_scene
+        return packet_scene
+
+
+def triangle_transforms(v0: np.ndarray, edge1: np.ndarray, edge2: np.ndarray):
+    """
+    Precomputes, for every triangle, the affine map taking world space to the triangle's barycentric frame.
+
+    The rows of the map are (edge2 x n, n x edge1, n) / |n|^2 with n = edge1 x edge2, so a point p maps to
+    (u, v, w) = rows . (p - v0) with (u, v) the barycentric coordinates and w the signed distance to the plane in
+    units of |n|. Degenerate (zero-area) triangles get all-zero rows and are never hit.
+
+    Returns:
+        tuple: (rows, offsets) with rows of shape (3, 3, N) laid out for matmul and offsets of shape (3, N).
+    """
+    normal = np.cross(edge1, edge2)
+    length2 = np.sum(normal * normal, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_length2 = np.where(length2 > 0, 1.0 / length2, 0.0)
+    rows = np.stack([np.cross(edge2, normal), np.cross(normal, edge1), normal]) * inv_length2[None, :, None]
+    offsets = np.sum(rows * v0[None, :, :], axis=2)
+    return np.ascontiguousarray(rows.transpose(0, 2, 1)), offsets
+
+
+def intersect_packet(origins: np.ndarray, directions: np.ndarray, triangles, t_min: float = 0.001, t_max=np.inf,
+                     any_hit: bool = False, ray_block: int = 4096, tri_block: int = 256):
+    """
+    Finds the closest triangle hit for every ray of a packet.
+
+    Each ray is mapped into every triangle's barycentric frame (see triangle_transforms), which turns all
+    ray/triangle dot products into dense matrix products. Rays are processed in blocks of ray_block and tested
+    against triangles in blocks of tri_block, so the temporary (rays x triangles) arrays stay small regardless of
+    frame or scene size.
+
+    Parameters:
+        origins (np.ndarray): (R, 3) ray origins.
+        directions (np.ndarray): (R, 3) ray directions (not necessarily normalized).
+        triangles: Object exposing the transform_rows / transform_offsets arrays, see PacketScene.
+        t_min (float): Minimal accepted ray parameter.
+        t_max (float or np.ndarray): Maximal accepted ray parameter, scalar or one value per ray.
+        any_hit (bool): Shadow ray mode. A block of rays stops testing triangles once every ray in it has some
+            hit, so the returned hit is any hit below t_max rather than the closest.
+
+    Returns:
+        tuple: (t, face_index) arrays of shape (R,). Rays without a hit have t = inf and face_index = -1.
+    """
+    ray_count = len(origins)
+    best_t = np.empty(ray_count, dtype=np.float64)
+    best_t[:] = t_max
+    best_idx = np.full(ray_count, -1, dtype=np.int64)
+    rows, offsets = triangles.transform_rows, triangles.transform_offsets
+    tri_count = offsets.shape[1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for r0 in range(0, ray_count, ray_block):
+            r1 = min(r0 + ray_block, ray_count)
+            o = origins[r0:r1]
+            d = directions[r0:r1]
+            block_t = best_t[r0:r1]
+            block_idx = best_idx[r0:r1]
+            ray_rows = np.arange(r1 - r0)
+
+            for t0 in range(0, tri_count, tri_block):
+                t1 = min(t0 + tri_block, tri_count)
+                d_w = d @ rows[2, :, t0:t1]
+                t = (offsets[2, t0:t1] - o @ rows[2, :, t0:t1]) / d_w
+                u = o @ rows[0, :, t0:t1] - offsets[0, t0:t1] + t * (d @ rows[0, :, t0:t1])
+                v = o @ rows[1, :, t0:t1] - offsets[1, t0:t1] + t * (d @ rows[1, :, t0:t1])
+
+                valid = (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t > _EPSILON) & (t >= t_min) & (d_w != 0)
+                t = np.where(valid, t, np.inf)
+
+                nearest = np.argmin(t, axis=1)
+                nearest_t = t[ray_rows, nearest]
+                closer = nearest_t < block_t
+                block_t[closer] = nearest_t[closer]
+                block_idx[closer] = nearest[closer] + t0
+                if any_hit and np.all(block_idx >= 0):
+                    break
+
+    best_t[best_idx < 0] = np.inf
+    return best_t, best_idx
+
+
+def primary_rays(camera, x0: int, y0: int, x1: int, y1: int, samples: int, pixels: np.ndarray = None,
+                 first_sample=0):
+    """
+    Builds all jittered primary rays for the pixel rectangle [x0, x1) x [y0, y1).
+
+    The jitter is drawn from camera.sampler exactly as in Camera.get_ray, so the packet and scalar render paths
+    trace the same rays. If pixels (flat indices within the rectangle) is given, only those pixels are sampled.
+    Every pixel takes the sample indices first_sample ... first_sample + samples - 1; first_sample is a scalar or
+    one value per sampled pixel.
+
+    Returns:
+        tuple: (origins, directions, pixel, image_pixel, sample_index) where pixel is the flat index of the pixel
+        within the rectangle and image_pixel within the image, rays are ordered pixel-major (all samples of a pixel
+        are adjacent).
+    """
+    width, height = x1 - x0, y1 - y0
+    if pixels is None:
+        pixels = np.arange(width * height)
+    pixel = np.repeat(pixels, samples)
+    sample_index = (np.repeat(np.broadcast_to(first_sample, pixels.shape), samples)
+                    + np.tile(np.arange(samples), len(pixels)))
+    column, row = x0 + pixel % width, y0 + pixel // width
+    image_pixel = row * camera.img_width + column
+    ii, jj = column.astype(np.float64), row.astype(np.float64)
+    offset_x = camera.sampler.get_packet(image_pixel, sample_index, 0) - 1
+    offset_y = camera.sampler.get_packet(image_pixel, sample_index, 1) - 1
+
+    pixel_00 = np.asarray(camera.pixel_00, dtype=np.float64)
+    delta_u = np.asarray(camera.pixel_delta_u, dtype=np.float64)
+    delta_v = np.asarray(camera.pixel_delta_v, dtype=np.float64)
+    origin = np.asarray(camera.camera_origin, dtype=np.float64)
+
+    pixel_sample = pixel_00 + (ii + offset_x)[:, None] * delta_u + (jj + offset_y)[:, None] * delta_v
+    directions = pixel_sample - origin
+    origins = np.broadcast_to(origin, directions.shape)
+    return origins, directions, pixel, image_pixel, sample_index
+
+
+def sky_color(directions: np.ndarray) -> np.ndarray:
+    """
+    Vectorized background gradient, equivalent to the miss color of Camera.get_color.
+    """
+    unit = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+    a = 0.5 * (unit[:, 1:2] + 1)
+    return (1.0 - a) * np.ones(3) + a * np.array([0.5, 0.7, 1.0])
+
+
+def _normalize(v: np.ndarray) -> np.ndarray:
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def phong_packet(camera, packet_scene: PacketScene, points: np.ndarray, face_idx: np.ndarray, light) -> np.ndarray:
+    """
+    Vectorized Camera.phong for a single light.
+    """
+    normals = packet_scene.unit_norm[face_idx]
+    mat = packet_scene.material_index[face_idx]
+    ka, kd, ks = packet_scene.ambient[mat], packet_scene.diffuse[mat], packet_scene.specular[mat]
+
+    light_dir = _normalize(np.asarray(light.position, dtype=np.float64) - points)
+    view = _normalize(np.asarray(camera.camera_origin, dtype=np.float64) - points)
+    n_dot_l = np.sum(normals * light_dir, axis=1)
+    reflected = _normalize(2 * n_dot_l[:, None] * normals - light_dir)
+    r_dot_v = np.maximum(0, np.sum(reflected * view, axis=1))
+    return camera.scene.ambient_light * ka + light.intensity * np.asarray(light.color[:3], dtype=np.float64) * (
+        np.maximum(0, n_dot_l)[:, None] * kd + (r_dot_v ** packet_scene.shininess[mat])[:, None] * ks)
+
+
+def shade_phong_packet(camera, packet_scene: PacketScene, points: np.ndarray, face_idx: np.ndarray) -> np.ndarray:
+    """
+    Vectorized equivalent of the illumination model 2 branch of Camera.get_color: ambient term plus Phong shading
+    from the last light that is not occluded, with shadow rays traced as one packet per light.
+    """
+    normals = packet_scene.unit_norm[face_idx]
+    colors = camera.scene.ambient_light * packet_scene.ambient[packet_scene.material_index[face_idx]]
+    shadow_origins = points + 1e-3 * normals
+
+    for light in camera.scene.lights:
+        to_light = np.asarray(light.position, dtype=np.float64) - points
+        distance = np.linalg.norm(to_light, axis=1)
+        _, blocker = intersect_packet(shadow_origins, to_light / distance[:, None], packet_scene, t_max=distance,
+                                      any_hit=True)
+        lit = blocker < 0
+        colors[lit] = phong_packet(camera, packet_scene, points[lit], face_idx[lit], light)
+    return colors
+
+
+def trace_whitted_packet(camera, packet_scene: PacketScene, origins: np.ndarray, directions: np.ndarray,
+                         image_pixel: np.ndarray, sample_index: np.ndarray, max_depth: int = 3) -> np.ndarray:
+    """
+    Vectorized Camera.get_color for a whole packet of rays.
+
+    Whitted shading in Camera never splits a ray (glass picks reflection or refraction at random), so every ray
+    follows a single chain of bounces. The packet is bounced in a loop carrying a per-ray weight, and rays that
+    miss or land on a diffuse surface are dropped before the next bounce. As in Camera.get_color, every ray is
+    intersected at most max_depth times and glass draws its choice of the bounce's sampler dimension, so all rays
+    of a bounce share it.
+
+    Returns:
+        np.ndarray: (R, 3) colors.
+    """
+    colors = np.zeros((len(origins), 3), dtype=np.float64)
+    ray_id = np.arange(len(origins))
+    weight = np.ones(len(origins), dtype=np.float64)
+    bounce = 0
+    o, d = np.asarray(origins, dtype=np.float64), np.asarray(directions, dtype=np.float64)
+
+    while len(ray_id):
+        t, face_idx = intersect_packet(o, d, packet_scene)
+        hit = face_idx >= 0
+        safe_idx = np.maximum(face_idx, 0)
+        mat = packet_scene.material_index[safe_idx]
+        illum = packet_scene.illumination_model[mat]
+        points = o + t[:, None] * d
+
+        # misses and hits with an illumination model get_color does not handle fall back to the background
+        background = ~hit | ~np.isin(illum, (2, 3, 4, 5))
+        colors[ray_id[background]] += weight[background, None] * sky_color(d[background])
+
+        diffuse = hit & (illum == 2)
+        if diffuse.any():
+            colors[ray_id[diffuse]] += weight[diffuse, None] * shade_phong_packet(
+                camera, packet_scene, points[diffuse], face_idx[diffuse])
+
+        normals = packet_scene.unit_norm[safe_idx]
+        new_d = d - 2 * np.sum(d * normals, axis=1)[:, None] * normals
+        new_o = points.copy()
+
+        mirror = hit & (illum == 3)
+        if mirror.any():
+            colors[ray_id[mirror]] += (weight[mirror] * (1 - MIRROR_REFLECTIVITY))[:, None] * phong_packet(
+                camera, packet_scene, points[mirror], face_idx[mirror], camera.scene.lights[0])
+            weight[mirror] *= MIRROR_REFLECTIVITY
+
+        glass = hit & packet_scene.is_glass[mat]
+        if glass.any():
+            glass_mat = mat[glass]
+            ni = packet_scene.optical_density[glass_mat]
+            unit_d = _normalize(d[glass])
+            n = normals[glass]
+            r_0 = packet_scene.reflectance[glass_mat]
+            theta = np.sum(unit_d * n, axis=1)
+            reflection_probability = r_0 + (1 - r_0) * (1 - np.cos(theta)) ** 5
+            rays = ray_id[glass]
+            refract = camera.sampler.get_packet(image_pixel[rays], sample_index[rays],
+                                                bounce_dimension(bounce, BSDF_U)) >= reflection_probability
+
+            entering = theta <= 0
+            n1 = np.where(entering, 1.0, ni)
+            n2 = np.where(entering, ni, 1.0)
+            normal = np.where(entering[:, None], n, -n)
+            ri = n1 / n2
+            cos_theta = -np.sum(unit_d * normal, axis=1)
+            sin_theta2 = ri ** 2 * (1 - cos_theta ** 2)
+            total_internal = sin_theta2 > 1.0
+            with np.errstate(invalid='ignore'):
+                refracted = (ri[:, None] * (unit_d + cos_theta[:, None] * normal)
+                             - np.sqrt(1.0 - sin_theta2)[:, None] * normal)
+
+            transmit = refract & ~total_internal
+            glass_idx = np.flatnonzero(glass)
+            new_d[glass_idx[transmit]] = refracted[transmit]
+            new_o[glass_idx[transmit]] = points[glass][transmit] + 1e-3 * refracted[transmit]
+
+        bounce += 1
+        alive = (mirror | glass) & (bounce < max_depth)
+        ray_id, weight = ray_id[alive], weight[alive]
+        o, d = new_o[alive], new_d[alive]
+
+    return colors
+
+
+def sample_area_lights_packet(packet_scene: PacketScene, lights, points: np.ndarray, normals: np.ndarray,
+                              kd: np.ndarray, u: np.ndarray, u1: np.ndarray, u2: np.ndarray) -> np.ndarray:
+    """
+    Vectorized Camera.sample_area_light: one light sample per diffuse hit, picked with the uniform values u, u1 and
+    u2, with all shadow rays traced as one packet.
+
+    Returns:
+        np.ndarray: (R, 3) MIS-weighted reflected light.
+    """
+    face_index, light_points, area_pdf = lights.sample_packet(u, u1, u2)
+    to_light = light_points - points
+    distance2 = np.sum(to_light * to_light, axis=1)
+    distance = np.sqrt(distance2)
+    direction = to_light / distance[:, None]
+    cos_surface = np.sum(direction * normals, axis=1)
+    cos_light = np.abs(np.sum(direction * packet_scene.unit_norm[face_index], axis=1))
+
+    reflected = np.zeros((len(points), 3), dtype=np.float64)
+    candidates = np.flatnonzero((cos_surface > 0) & (cos_light > 0))
+    if candidates.size:
+        _, blocker = intersect_packet(points[candidates] + 1e-4 * normals[candidates], direction[candidates],
+                                      packet_scene, t_max=distance[candidates] - 1e-3, any_hit=True)
+        lit = candidates[blocker < 0]
+        light_pdf = area_pdf[lit] * distance2[lit] / cos_light[lit]
+        weight = power_heuristic(light_pdf, cos_surface[lit] / np.pi) * cos_surface[lit] / (np.pi * light_pdf)
+        emission = packet_scene.emissive[packet_scene.material_index[face_index[lit]]]
+        reflected[lit] = weight[:, None] * kd[lit] * emission
+    return reflected
+
+
+def trace_pathtrace_packet(packet_scene: PacketScene, origins: np.ndarray, directions: np.ndarray, sampler,
+                           image_pixel: np.ndarray, sample_index: np.ndarray, max_depth: int = 7, lights=None,
+                           russian_roulette_depth: int = None) -> np.ndarray:
+    """
+    Wavefront version of Camera.get_color_pathtrace for a whole packet of rays.
+
+    All live paths are kept in arrays (origin, direction, throughput and ray index) and bounced together:
+    every bounce intersects the remaining paths in one intersect_packet call, shades them by material class and
+    compacts away the paths that terminated, so the next bounce only traces live rays. The materials are classified
+    as in get_color_pathtrace: misses add the sky color, emissive surfaces add their emission and stop, mirrors
+    (illumination model 3) reflect and everything else bounces diffusely into a cosine-weighted hemisphere direction.
+    A path that reaches max_depth contributes nothing. All paths of a bounce have the same depth and draw their
+    decisions from the sampler dimensions of that bounce.
+
+    Parameters:
+        sampler (Sampler): Source of the random decisions, addressed by the image_pixel and sample_index of every
+            ray.
+        lights (AreaLights): Area lights for next-event estimation with MIS, None to only gather light that the
+            bounces hit.
+        russian_roulette_depth (int): Bounces after which paths are terminated by Russian roulette, None to always
+            trace them to max_depth.
+
+    Returns:
+        np.ndarray: (R, 3) colors.
+    """
+    if lights is not None and not len(lights):
+        lights = None
+    colors = np.zeros((len(origins), 3), dtype=np.float64)
+    ray_id = np.arange(len(origins))
+    throughput = np.ones((len(origins), 3), dtype=np.float64)
+    image_pixel, sample_index = np.asarray(image_pixel), np.asarray(sample_index)
+    # solid angle density of the last bounce direction, 0 after camera rays and mirror reflections
+    bsdf_pdf = np.zeros(len(origins), dtype=np.float64)
+    o, d = np.asarray(origins, dtype=np.float64), np.asarray(directions, dtype=np.float64)
+
+    bounce = 0
+    while len(ray_id):
+        t, face_idx = intersect_packet(o, d, packet_scene)
+        hit = face_idx >= 0
+        colors[ray_id[~hit]] += throughput[~hit] * sky_color(d[~hit])
+
+        o, d, t, face_idx = o[hit], d[hit], t[hit], face_idx[hit]
+        ray_id, throughput, bsdf_pdf = ray_id[hit], throughput[hit], bsdf_pdf[hit]
+        mat = packet_scene.material_index[face_idx]
+        points = o + t[:, None] * d
+        normals = packet_scene.unit_norm[face_idx]
+        normals = np.where((np.sum(d * normals, axis=1) > 0)[:, None], -normals, normals)
+
+        mirror = packet_scene.illumination_model[mat] == 3
+        emissive = ~mirror & packet_scene.is_emissive[mat]
+        emission = packet_scene.emissive[mat[emissive]]
+        if lights is not None:
+            bounced = np.flatnonzero(bsdf_pdf[emissive] > 0)
+            light_hits = np.flatnonzero(emissive)[bounced]
+            length2 = np.sum(d[light_hits] * d[light_hits], axis=1)
+            cos_light = np.abs(np.sum(d[light_hits] * packet_scene.unit_norm[face_idx[light_hits]], axis=1))
+            light_pdf = (lights.area_pdf[face_idx[light_hits]] * t[light_hits] ** 2 * length2
+                         / np.maximum(cos_light / np.sqrt(length2), 1e-12))
+            emission[bounced] *= power_heuristic(bsdf_pdf[light_hits], light_pdf)[:, None]
+        colors[ray_id[emissive]] += throughput[emissive] * emission
+
+        diffuse = ~mirror & ~emissive
+        pixel, index = image_pixel[ray_id[diffuse]], sample_index[ray_id[diffuse]]
+        if lights is not None and diffuse.any():
+            u, u1, u2 = (sampler.get_packet(pixel, index, bounce_dimension(bounce, offset))
+                         for offset in (LIGHT_SELECT, LIGHT_U, LIGHT_V))
+            colors[ray_id[diffuse]] += throughput[diffuse] * sample_area_lights_packet(
+                packet_scene, lights, points[diffuse], normals[diffuse], packet_scene.diffuse[mat[diffuse]], u, u1, u2)
+
+        new_d = np.empty_like(d)
+        new_d[mirror] = d[mirror] - 2 * np.sum(d[mirror] * normals[mirror], axis=1)[:, None] * normals[mirror]
+        new_d[diffuse] = cosine_hemisphere_packet(sampler.get_packet(pixel, index, bounce_dimension(bounce, BSDF_U)),
+                                                  sampler.get_packet(pixel, index, bounce_dimension(bounce, BSDF_V)),
+                                                  normals[diffuse])
+        # mirrors tint by kd; diffuse bounces weigh BRDF kd / pi times the cosine over the density cos / pi, also kd
+        throughput *= packet_scene.diffuse[mat]
+        bsdf_pdf = np.zeros(len(d), dtype=np.float64)
+        bsdf_pdf[diffuse] = np.sum(new_d[diffuse] * normals[diffuse], axis=1) / np.pi
+
+        bounce += 1
+        alive = ~emissive & (bounce < max_depth)
+        if russian_roulette_depth is not None and bounce >= russian_roulette_depth:
+            roulette = np.flatnonzero(diffuse & alive)
+            survival = np.minimum(throughput[roulette].max(axis=1), 0.95)
+            u = sampler.get_packet(image_pixel[ray_id[roulette]], sample_index[ray_id[roulette]],
+                                   bounce_dimension(bounce - 1, ROULETTE))
+            survive = u < survival
+            throughput[roulette[survive]] /= survival[survive, None]
+            alive[roulette[~survive]] = False
+        ray_id, throughput, bsdf_pdf = ray_id[alive], throughput[alive], bsdf_pdf[alive]
+        o, d = points[alive] + 1e-4 * normals[alive], new_d[alive]
+
+    return colors
@@ -0,0 +1,137 @@
+import math
+from array import array
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from models.Triangle import Triangle
+
+# Buffer of the scene being built, set once per worker process by build_pool's initializer.
+_worker_buffer = None
+
+
+def _init_build_worker(buffer):
+    global _worker_buffer
+    _worker_buffer = buffer
+
+
+def build_pool(buffer, workers: int) -> ProcessPoolExecutor:
+    """
+    Returns a process pool for acceleration structure builds. Every worker receives the TriangleBuffer once, so tasks
+    only carry triangle indices.
+    """
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_build_worker, initargs=(buffer,))
+
+
+def split_levels(workers: int) -> int:
+    """
+    Number of tree levels built in the calling process: enough for about two subtrees per worker.
+    """
+    return math.ceil(math.log2(workers)) + 1
+
+
+def worker_faces(indices) -> list[Triangle]:
+    """
+    Triangles of the worker's buffer at the given buffer indices.
+    """
+    return [Triangle(_worker_buffer, int(idx)) for idx in indices]
+
+
+def face_indices(faces: list[Triangle]) -> array:
+    """
+    Buffer indices of faces, the compact form in which workers send primitive lists back.
+    """
+    return array('i', [face.index for face in faces])
+
+
+def replace_primitives(root, primitives: str, children: tuple, convert):
+    """
+    Applies convert to the primitive list (attribute primitives) of every node of a tree whose child nodes are stored
+    in the attributes children. Subtrees are sent between processes with triangles replaced by their indices, since a
+    pickled Triangle would carry its whole buffer.
+    """
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        setattr(node, primitives, convert(getattr(node, primitives)))
+        stack.extend(child for child in (getattr(node, name) for name in children) if child is not None)
+    return root
+
+
+def face_map(faces: list[Triangle]) -> dict:
+    """
+    Maps the buffer index of every triangle in faces to the triangle, to turn worker results back into faces.
+    """
+    return {face.index: face for face in faces}
+
+
+def resolve_tree(future: Future, primitives: str, children: tuple, by_index: dict):
+    """
+    Waits for a tree built by a worker and maps its triangle indices back to triangles through by_index (see
+    face_map).
+    """
+    return replace_primitives(future.result(), primitives, children, lambda indices: [by_index[idx] for idx in indices])
+
+
+def resolve_subtrees(root, primitives: str, children: tuple, faces: list[Triangle]):
+    """
+    Replaces the Futures a parallel build left in the top levels of a tree by the subtrees computed by the workers.
+    """
+    by_index = face_map(faces)
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for name in children:
+            child = getattr(node, name)
+            if isinstance(child, Future):
+                setattr(node, name, resolve_tree(child, primitives, children, by_index))
+            elif child is not None:
+                stack.append(child)
+    return root
+
+
+def benchmark_builds(path: str, worker_counts=(1, 2, 4), repeats: int = 3) -> list[dict]:
+    """
+    Times every acceleration structure builder over the scene at path for each worker count and prints the best of
+    repeats runs together with the speedup over one worker.
+
+    Returns:
+        list of dict: structure, workers, time (seconds) and speedup for every measurement.
+    """
+    from core.Scene import Scene
+    from core.BVH import build_bvh
+    from core.KDTree import build_kd_tree
+    from core.UniformGrid import build_grid
+
+    scene = Scene()
+    scene.load_from_file(path)
+    builders = {
+        "bvh (median)": lambda faces, workers: build_bvh(faces, 4, builder="median", workers=workers),
+        "bvh (sah)": lambda faces, workers: build_bvh(faces, 4, builder="sah", workers=workers),
+        "kd-tree (median)": lambda faces, workers: build_kd_tree(faces, builder="median", workers=workers),
+        "kd-tree (sah)": lambda faces, workers: build_kd_tree(faces, builder="sah", workers=workers),
+        "grid": lambda faces, workers: build_grid(faces, workers=workers),
+    }
+    results = []
+    print(f"{path}: {len(scene.faces)} triangles")
+    for name, build in builders.items():
+        serial_time = None
+        for workers in worker_counts:
+            best = float('inf')
+            for _ in range(repeats):
+                faces = list(scene.faces)
+                start = time.perf_counter()
+                build(faces, workers)
+                best = min(best, time.perf_counter() - start)
+            serial_time = best if serial_time is None else serial_time
+            results.append({"structure": name, "workers": workers, "time": best, "speedup": serial_time / best})
+            print(f"  {name:<16} {workers:>2} workers: {best:8.3f} s  speedup {serial_time / best:5.2f}x")
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Acceleration structure build benchmark")
+    parser.add_argument('scene', type=str, help="Path to the OBJ scene.")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help="Worker counts to compare.")
+    parser.add_argument('--repeats', type=int, default=3, help="Runs per measurement; the best one is reported.")
+    args = parser.parse_args()
+    benchmark_builds(args.scene, args.workers, args.repeats)
@@ -0,0 +1,303 @@
+import math
+from abc import ABC, abstractmethod
+import numpy as np
+
+# Layout of the dimensions of one camera sample: the pixel jitter first, then a fixed block per bounce, so every
+# integrator draws the same decision of the same bounce from the same dimension.
+PIXEL_DIMENSIONS = 2
+BOUNCE_DIMENSIONS = 6
+LIGHT_SELECT, LIGHT_U, LIGHT_V, BSDF_U, BSDF_V, ROULETTE = range(BOUNCE_DIMENSIONS)
+
+_MASK64 = (1 << 64) - 1
+_MASK32 = (1 << 32) - 1
+_GOLDEN = 0x9E3779B97F4A7C15
+
+
+def bounce_dimension(bounce: int, offset: int) -> int:
+    """
+    Dimension of the value offset (LIGHT_SELECT ... ROULETTE) of the given bounce.
+    """
+    return PIXEL_DIMENSIONS + bounce * BOUNCE_DIMENSIONS + offset
+
+
+def _mix(x: int) -> int:
+    # splitmix64 finalizer
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+def _mix_packet(x: np.ndarray) -> np.ndarray:
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _hash(*keys: int) -> int:
+    h = 0
+    for key in keys:
+        h = _mix((h + _GOLDEN + key) & _MASK64)
+    return h
+
+
+def _hash_packet(*keys) -> np.ndarray:
+    h = np.uint64(0)
+    with np.errstate(over='ignore'):
+        for key in keys:
+            h = _mix_packet(h + np.uint64(_GOLDEN) + np.asarray(key).astype(np.uint64))
+    return h
+
+
+def _to_unit(h: int) -> float:
+    return (h >> 11) * (1.0 / (1 << 53))
+
+
+def _to_unit_packet(h: np.ndarray) -> np.ndarray:
+    return (h >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+
+def _permute(i: int, length: int, p: int) -> int:
+    """
+    Kensler's hashed permutation: element i of a pseudo-random permutation of range(length) chosen by p, without
+    building the permutation (Correlated Multi-Jittered Sampling, 2013).
+    """
+    w = length - 1
+    w |= w >> 1
+    w |= w >> 2
+    w |= w >> 4
+    w |= w >> 8
+    w |= w >> 16
+    while True:
+        i ^= p
+        i = (i * 0xe170893d) & _MASK32
+        i ^= p >> 16
+        i ^= (i & w) >> 4
+        i ^= p >> 8
+        i = (i * 0x0929eb3f) & _MASK32
+        i ^= p >> 23
+        i ^= (i & w) >> 1
+        i = (i * (1 | p >> 27)) & _MASK32
+        i = (i * 0x6935fa69) & _MASK32
+        i ^= (i & w) >> 11
+        i = (i * 0x74dcb303) & _MASK32
+        i ^= (i & w) >> 2
+        i = (i * 0x9e501cc3) & _MASK32
+        i ^= (i & w) >> 2
+        i = (i * 0xc860a3df) & _MASK32
+        i &= w
+        i ^= i >> 5
+        if i < length:
+            return (i + p) % length
+
+
+def _permute_packet(i: np.ndarray, length: int, p: np.ndarray) -> np.ndarray:
+    """
+    Vectorized _permute; elements that fall outside range(length) keep cycling until all are inside.
+    """
+    w = length - 1
+    for shift in (1, 2, 4, 8, 16):
+        w |= w >> shift
+    w = np.uint32(w)
+    i = np.asarray(i, dtype=np.uint32).copy()
+    p = np.asarray(p, dtype=np.uint32)
+    p = np.broadcast_to(p, i.shape)
+    pending = np.arange(i.size)
+    result = np.empty_like(i)
+    with np.errstate(over='ignore'):
+        while pending.size:
+            x, q = i[pending], p[pending]
+            x ^= q
+            x *= np.uint32(0xe170893d)
+            x ^= q >> np.uint32(16)
+            x ^= (x & w) >> np.uint32(4)
+            x ^= q >> np.uint32(8)
+            x *= np.uint32(0x0929eb3f)
+            x ^= q >> np.uint32(23)
+            x ^= (x & w) >> np.uint32(1)
+            x *= np.uint32(1) | q >> np.uint32(27)
+            x *= np.uint32(0x6935fa69)
+            x ^= (x & w) >> np.uint32(11)
+            x *= np.uint32(0x74dcb303)
+            x ^= (x & w) >> np.uint32(2)
+            x *= np.uint32(0x9e501cc3)
+            x ^= (x & w) >> np.uint32(2)
+            x *= np.uint32(0xc860a3df)
+            x &= w
+            x ^= x >> np.uint32(5)
+            i[pending] = x
+            done = x < length
+            result[pending[done]] = (x[done].astype(np.uint64) + q[done]) % length
+            pending = pending[~done]
+    return result.astype(np.int64)
+
+
+class Sampler(ABC):
+    """
+    Deterministic source of sample values in [0, 1), addressed by (pixel, sample index, dimension).
+
+    Every value is a pure function of the seed and of this address, so an image does not depend on tiling, on the
+    worker count or on the order in which pixels are traced, and the i-th sample of a pixel is the same in a single
+    render and in the i-th progressive pass. pixel is the row-major index of the pixel in the image, the dimensions
+    follow the layout of PIXEL_DIMENSIONS and bounce_dimension.
+
+    Subclasses implement get for single values and get_packet for arrays of pixels and sample indices; both return
+    the same values for the same address.
+
+    Attributes:
+        seed (int): Non-negative seed.
+        samples_per_pixel (int): Expected number of samples per pixel; samplers that stratify over a pixel's samples
+            use it as the number of strata.
+    """
+    def __init__(self, seed: int = 0, samples_per_pixel: int = 1):
+        self.seed = seed
+        self.samples_per_pixel = max(1, samples_per_pixel)
+
+    @abstractmethod
+    def get(self, pixel: int, index: int, dimension: int) -> float:
+        """
+        Value of one sample address.
+        """
+
+    @abstractmethod
+    def get_packet(self, pixel: np.ndarray, index: np.ndarray, dimension: int) -> np.ndarray:
+        """
+        Values of arrays of pixels and sample indices in one dimension.
+        """
+
+
+class IndependentSampler(Sampler):
+    """
+    Uniform values hashed from the seed and the sample address, without any stratification.
+    """
+    def get(self, pixel: int, index: int, dimension: int) -> float:
+        return _to_unit(_hash(self.seed, pixel, index, dimension))
+
+    def get_packet(self, pixel: np.ndarray, index: np.ndarray, dimension: int) -> np.ndarray:
+        return _to_unit_packet(_hash_packet(self.seed, pixel, index, dimension))
+
+
+class StratifiedSampler(Sampler):
+    """
+    Jittered Latin hypercube sampling of a pixel's samples: in every dimension the samples_per_pixel samples of a
+    pixel fall into distinct strata of width 1 / samples_per_pixel, in an order permuted independently per pixel and
+    dimension. Samples beyond samples_per_pixel (adaptive sampling) start a new, independently permuted set of
+    strata.
+    """
+    def get(self, pixel: int, index: int, dimension: int) -> float:
+        n = self.samples_per_pixel
+        epoch, position = divmod(index, n)
+        stratum = _permute(position, n, _hash(self.seed, pixel, dimension, epoch, 1) & _MASK32)
+        return (stratum + _to_unit(_hash(self.seed, pixel, index, dimension))) / n
+
+    def get_packet(self, pixel: np.ndarray, index: np.ndarray, dimension: int) -> np.ndarray:
+        n = self.samples_per_pixel
+        index = np.asarray(index, dtype=np.int64)
+        epoch, position = np.divmod(index, n)
+        key = _hash_packet(self.seed, pixel, dimension, epoch, 1) & np.uint64(_MASK32)
+        stratum = _permute_packet(position, n, key.astype(np.uint32))
+        return (stratum + _to_unit_packet(_hash_packet(self.seed, pixel, index, dimension))) / n
+
+
+def _primes(count: int) -> list[int]:
+    primes = []
+    candidate = 2
+    while len(primes) < count:
+        if all(candidate % p for p in primes if p * p <= candidate):
+            primes.append(candidate)
+        candidate += 1
+    return primes
+
+
+# Dimensions drawn from the Halton sequence; deeper dimensions fall back to independent values.
+HALTON_PRIMES = _primes(32)
+
+
+class HaltonSampler(IndependentSampler):
+    """
+    Scrambled Halton sequence: dimension d of the i-th sample of a pixel is the radical inverse of i in the d-th
+    prime base. Every digit position of every base gets its own random digit permutation (random digit scrambling),
+    which breaks the correlation between dimensions of large bases, and every pixel shifts its values by its own
+    random offset modulo 1 (Cranley-Patterson rotation), so neighbouring pixels do not repeat the same pattern.
+    Digits are generated for 32 bits of precision; dimensions past HALTON_PRIMES use independent values.
+    """
+    def __init__(self, seed: int = 0, samples_per_pixel: int = 1):
+        super().__init__(seed, samples_per_pixel)
+        rng = np.random.default_rng([seed, 0x4a1705])
+        self.digit_count = [math.ceil(32 / math.log2(base)) for base in HALTON_PRIMES]
+        self.permutations = [np.array([rng.permutation(base) for _ in range(digits)])
+                             for base, digits in zip(HALTON_PRIMES, self.digit_count)]
+        self._permutation_lists = [permutation.tolist() for permutation in self.permutations]
+
+    def get(self, pixel: int, index: int, dimension: int) -> float:
+        if dimension >= len(HALTON_PRIMES):
+            return super().get(pixel, index, dimension)
+        base = HALTON_PRIMES[dimension]
+        inverse = 1.0 / base
+        factor = inverse
+        value = 0.0
+        for permutation in self._permutation_lists[dimension]:
+            index, digit = divmod(index, base)
+            value += permutation[digit] * factor
+            factor *= inverse
+        value += _to_unit(_hash(self.seed, pixel, dimension, 2))
+        return value - 1.0 if value >= 1.0 else value
+
+    def get_packet(self, pixel: np.ndarray, index: np.ndarray, dimension: int) -> np.ndarray:
+        if dimension >= len(HALTON_PRIMES):
+            return super().get_packet(pixel, index, dimension)
+        base = HALTON_PRIMES[dimension]
+        index = np.asarray(index, dtype=np.int64).copy()
+        inverse = 1.0 / base
+        factor = inverse
+        value = np.zeros(index.shape, dtype=np.float64)
+        for permutation in self.permutations[dimension]:
+            index, digit = np.divmod(index, base)
+            value += permutation[digit] * factor
+            factor *= inverse
+        value += _to_unit_packet(_hash_packet(self.seed, pixel, dimension, 2))
+        return np.where(value >= 1.0, value - 1.0, value)
+
+
+SAMPLERS = {"independent": IndependentSampler, "stratified": StratifiedSampler, "halton": HaltonSampler}
+
+
+def create_sampler(name: str, seed: int = 0, samples_per_pixel: int = 1) -> Sampler:
+    """
+    Returns the sampler registered in SAMPLERS under name.
+    """
+    if name not in SAMPLERS:
+        raise ValueError(f"unknown sampler {name!r}, expected one of {', '.join(SAMPLERS)}")
+    return SAMPLERS[name](seed, samples_per_pixel)
+
+
+def cosine_hemisphere(u1: float, u2: float, normal) -> list[float]:
+    """
+    Maps two uniform values to a direction in the hemisphere around the unit normal with density cos(theta) / pi.
+    The tangent frame is the branchless orthonormal basis of Duff et al. (2017).
+    """
+    nx, ny, nz = normal
+    sign = 1.0 if nz >= 0 else -1.0
+    a = -1.0 / (sign + nz)
+    b = nx * ny * a
+    r = math.sqrt(u1)
+    phi = 2 * math.pi * u2
+    x, y, z = r * math.cos(phi), r * math.sin(phi), math.sqrt(max(0.0, 1.0 - u1))
+    return [x * (1 + sign * nx * nx * a) + y * b + z * nx,
+            x * sign * b + y * (sign + ny * ny * a) + z * ny,
+            -x * sign * nx - y * ny + z * nz]
+
+
+def cosine_hemisphere_packet(u1: np.ndarray, u2: np.ndarray, normals: np.ndarray) -> np.ndarray:
+    """
+    Vectorized cosine_hemisphere for (R,) uniform values and (R, 3) unit normals.
+    """
+    nx, ny, nz = normals[:, 0], normals[:, 1], normals[:, 2]
+    sign = np.where(nz >= 0, 1.0, -1.0)
+    a = -1.0 / (sign + nz)
+    b = nx * ny * a
+    r = np.sqrt(u1)
+    phi = 2 * np.pi * u2
+    x, y, z = r * np.cos(phi), r * np.sin(phi), np.sqrt(np.maximum(0.0, 1.0 - u1))
+    return np.stack([x * (1 + sign * nx * nx * a) + y * b + z * nx,
+                     x * sign * b + y * (sign + ny * ny * a) + z * ny,
+                     -x * sign * nx - y * ny + z * nz], axis=1)
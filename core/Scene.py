@@ -4,18 +4,21 @@ from pywavefront import Wavefront, material
 
 from Lights import Light
 from Lights.Light import PointLight
+from Lights.AreaLights import AreaLights
 from models import *
 from core import *
 from core.Utils import *
 import os
-from core.KDTree import KdTreeNode
+import time
+import numpy as np
+from core.KDTree import KdTreeNode, FlatKdTree, build_kd_tree
 from core.BVH import (
     build_bvh,
-    hit_bvh,
     build_bvh_meshes,
-    hit_bvh_meshes
+    FlatBvh,
+    TwoLevelBvh
 )
-from core.UniformGrid import build_grid, hit_grid
+from core.UniformGrid import build_grid, build_hierarchical_grid, hit_grid, occluded_grid
 class Scene:
     """
     Represents a 3D scene composed of multiple meshes loaded from a Wavefront OBJ file.
@@ -23,59 +26,141 @@ class Scene:
     and performing ray intersections to determine visibility and color information.
     """
 
-    def __init__(self,acceleration_structure="none") -> None:
+    def __init__(self,acceleration_structure="none", bvh_builder="median", kd_builder="sah", cache=None,
+                 build_workers=1) -> None:
 
         self.ambient_light = None
         self.mesh_list = None
         self.lights = None
         self.acceleration_structure = acceleration_structure
+        self.bvh_builder = bvh_builder
+        self.kd_builder = kd_builder
+        self.build_workers = build_workers
         self.bvh_root = None
         self.kd_root = None
+        self.flat_kd_tree = None
         self.mesh_bvh_root=None
+        self.flat_bvh = None
+        self.two_level_bvh = None
+        self.grid = None
+        self.triangles = None
+        self.faces = None
+        self.packet_scene = None
+        self.area_lights = None
+        self.cache = cache
+        self.load_stats = {}
 
     def load_from_file(self, filepath):
         """
-        Loads a 3D scene from a Wavefront OBJ file and constructs Mesh and Triangle objects.
+        Loads a 3D scene from a Wavefront OBJ file and constructs Mesh and Triangle objects. Emissive triangles are
+        collected into area_lights for the path tracer.
+
+        With a SceneCache attached, parsed geometry and the built acceleration structure are taken from the cache
+        when possible and stored in it otherwise. Timings of both phases are recorded in load_stats.
         """
         root_path = os.path.join(os.path.dirname(__file__) + "/..")
-        scene = Wavefront(os.path.join(root_path, filepath), collect_faces=True)
-        meshes = []
-        all_faces = []
+        path = os.path.join(root_path, filepath)
+        start = time.perf_counter()
+        geometry_cached = self.cache is not None and self.cache.load_geometry(self, path)
+        if not geometry_cached:
+            self._parse_obj(path)
+            if self.cache is not None:
+                self.cache.store_geometry(self, path)
+        self.area_lights = AreaLights(self.triangles)
+        geometry_done = time.perf_counter()
+        structure_cached = self.cache is not None and self.cache.load_structure(self, path)
+        if not structure_cached:
+            self._build_acceleration_structure()
+            if self.cache is not None:
+                self.cache.store_structure(self, path)
+        self.load_stats = {
+            "triangles": len(self.faces),
+            "area_lights": len(self.area_lights),
+            "geometry_time": geometry_done - start,
+            "structure_time": time.perf_counter() - geometry_done,
+            "geometry_cached": geometry_cached,
+            "structure_cached": structure_cached,
+        }
+
+    @staticmethod
+    def _material_triangles(material) -> np.ndarray:
+        """
+        Reads the interleaved vertex buffer of a pywavefront material (e.g. T2F_N3F_V3F) into an (N, 3, 3) array of
+        triangle vertex positions in one shot.
+        """
+        components = material.vertex_format.split("_")
+        sizes = [int(component[1:-1]) for component in components]
+        stride = sum(sizes)
+        offset = sum(sizes[:components.index("V3F")])
+        data = np.array(material.vertices, dtype=np.float64).reshape(-1, stride)
+        return data[:, offset:offset + 3].reshape(-1, 3, 3)
+
+    def _parse_obj(self, path):
+        scene = Wavefront(path)
+        materials = []
+        material_ids = {}
+        material_triangles = []
+        blocks = []
+        block_materials = []
+        mesh_ranges = []
+        face_count = 0
         for m in scene.mesh_list:
-            mesh = Mesh(m.name)
-            min_point = [float('+inf'),float('+inf'),float('+inf')]
-            max_point = [float('-inf'),float('-inf'),float('-inf')]
+            first_face = face_count
             for material in m.materials:
-                for i in range(0, len(material.vertices), 24):
-                    temp = material.vertices[i:i+24]
-                    v0_all = temp[0:8]
-                    v1_all = temp[8:16]
-                    v2_all = temp[16:24]
-                    vt0, vn0, v0 = v0_all[:2], v0_all[2:5], v0_all[5:]
-                    vt1, vn1, v1 = v1_all[:2], v1_all[2:5], v1_all[5:]
-                    vt2, vn2, v2 = v2_all[:2], v2_all[2:5], v2_all[5:]
-                    min_point = [min(v0[0], v1[0], v2[0], min_point[0]),
-                                min(v0[1], v1[1], v2[1], min_point[1]),
-                                min(v0[2], v1[2], v2[2], min_point[2])]
-                    max_point = [max(v0[0], v1[0], v2[0], max_point[0]),
-                                max(v0[1], v1[1], v2[1], max_point[1]),
-                                max(v0[2], v1[2], v2[2], max_point[2])]
-                    face = Triangle(v0, v1, v2, material)
-                    mesh.faces.append(face)     
-            mesh.set_bounding_box(min_point, max_point)   
-            meshes.append(mesh)
-
-        self.mesh_list = meshes
-        all_faces = sum([mesh.faces for mesh in self.mesh_list], [])
-        scene_bbox = KdTreeNode.create_meshlist_bbox(all_faces)
+                if id(material) not in material_ids:
+                    material_ids[id(material)] = len(materials)
+                    materials.append(material)
+                    material_triangles.append(self._material_triangles(material))
+                    # The array now holds the positions; drop the much larger list of Python floats right away.
+                    material.vertices = []
+                idx = material_ids[id(material)]
+                blocks.append(material_triangles[idx])
+                block_materials.append(idx)
+                face_count += len(material_triangles[idx])
+            mesh_ranges.append((first_face, face_count))
+
+        vertices = np.concatenate(blocks) if blocks else np.empty((0, 3, 3))
+        material_index = np.repeat(np.array(block_materials, dtype=np.int32), [len(block) for block in blocks])
+        del blocks, material_triangles
+
+        # All triangles share one structure-of-arrays buffer; Triangle objects are only (buffer, index) views.
+        self.triangles = TriangleBuffer(vertices, material_index, materials)
+        self.faces = [Triangle(self.triangles, idx) for idx in range(len(self.triangles))]
+        self.mesh_list = []
+        for m, (first_face, last_face) in zip(scene.mesh_list, mesh_ranges):
+            mesh = Mesh(m.name)
+            if last_face > first_face:
+                mesh_vertices = self.triangles.vertices[first_face:last_face].reshape(-1, 3)
+                mesh.set_bounding_box(mesh_vertices.min(axis=0).tolist(), mesh_vertices.max(axis=0).tolist())
+            else:
+                mesh.set_bounding_box([float('+inf')] * 3, [float('-inf')] * 3)
+            mesh.faces = self.faces[first_face:last_face]
+            self.mesh_list.append(mesh)
+
+    def _build_acceleration_structure(self):
+        # The median builders sort their input in place; faces and mesh_list must keep the buffer order.
+        all_faces = list(self.faces)
+        meshes = list(self.mesh_list)
         if self.acceleration_structure == "bvh":
-            self.bvh_root = build_bvh(all_faces, max_faces_in_leaf=4)
+            self.bvh_root = build_bvh(all_faces, max_faces_in_leaf=4, builder=self.bvh_builder,
+                                      workers=self.build_workers)
+            self.flat_bvh = FlatBvh(self.bvh_root)
         if self.acceleration_structure == "kd-tree":
-            self.kd_root = KdTreeNode(obj_list=all_faces, depth=0, bbox=scene_bbox)
+            self.kd_root = build_kd_tree(all_faces, builder=self.kd_builder, workers=self.build_workers)
+            self.flat_kd_tree = FlatKdTree(self.kd_root)
         if self.acceleration_structure == "mesh_bvh":
-            self.mesh_bvh_root = build_bvh_meshes(meshes, max_in_leaf=1)
+            # one identity instance per mesh over per-mesh bottom-level BVHs
+            self.two_level_bvh = TwoLevelBvh(builder=self.bvh_builder)
+            self.two_level_bvh.build_blas(meshes, workers=self.build_workers)
+            for mesh in meshes:
+                if mesh.faces:
+                    self.two_level_bvh.add_instance(mesh)
+            self.two_level_bvh.build()
+            self.mesh_bvh_root = self.two_level_bvh.tlas_root
         if self.acceleration_structure == "grid":
-            self.grid = build_grid(all_faces, desired_resolution=20)
+            self.grid = build_grid(all_faces, workers=self.build_workers)
+        if self.acceleration_structure == "hierarchical_grid":
+            self.grid = build_hierarchical_grid(all_faces, workers=self.build_workers)
     def load_config(self, path):
         LIGHT_TYPE_MAP = {
             'point': PointLight,
@@ -93,22 +178,20 @@ class Scene:
     def hit(self, ray: Ray):
         """
         Determines if a given ray intersects with any objects in the scene and returns
-        information about the closest intersection.
+        information about the closest intersection with ray.t_min <= t <= ray.t_max.
         """
-        if self.acceleration_structure == "bvh" and self.bvh_root:
-           return hit_bvh(ray, self.bvh_root)
-        elif self.acceleration_structure == "kd-tree" and self.kd_root:
-            return self.kd_root.traverse_tree(ray)
-        elif self.acceleration_structure == "mesh_bvh" and self.mesh_bvh_root:
-            return hit_bvh_meshes(ray, self.mesh_bvh_root)
-        elif self.acceleration_structure == "grid" and self.grid:
+        if self.acceleration_structure == "bvh" and self.flat_bvh:
+            return self.flat_bvh.hit(ray)
+        elif self.acceleration_structure == "kd-tree" and self.flat_kd_tree:
+            return self.flat_kd_tree.hit(ray)
+        elif self.acceleration_structure == "mesh_bvh" and self.two_level_bvh:
+            return self.two_level_bvh.hit(ray)
+        elif self.acceleration_structure in ("grid", "hierarchical_grid") and self.grid:
             return hit_grid(ray, self.grid)
 
         else:
             closest_intersection = None
             for mesh in self.mesh_list:
-                ray.t_max = float('+inf')
-                ray.t_min = 0.1
                 for i in range(3):
                     if ray.direction[i] < 1e-8:
                         if ray.origin[i] < mesh.bounding_box_min[i] or ray.origin[i] > mesh.bounding_box_max[i]:
@@ -139,3 +222,24 @@ class Scene:
                         closest_intersection = closest__mesh_intersection
             return closest_intersection
 
+    def occluded(self, ray: Ray, t_max: float) -> bool:
+        """
+        Shadow ray query: returns True if any object blocks the ray between ray.t_min and t_max.
+
+        Unlike hit(), this does not search for the closest intersection and stops at the first blocker found.
+        """
+        if self.acceleration_structure == "bvh" and self.flat_bvh:
+            return self.flat_bvh.occluded(ray, t_max)
+        elif self.acceleration_structure == "kd-tree" and self.flat_kd_tree:
+            return self.flat_kd_tree.occluded(ray, t_max)
+        elif self.acceleration_structure == "mesh_bvh" and self.two_level_bvh:
+            return self.two_level_bvh.occluded(ray, t_max)
+        elif self.acceleration_structure in ("grid", "hierarchical_grid") and self.grid:
+            return occluded_grid(ray, self.grid, t_max)
+
+        for mesh in self.mesh_list:
+            for face in mesh.faces:
+                result = face.hit(ray)
+                if result and ray.t_min <= result[0] < t_max:
+                    return True
+        return False
@@ -0,0 +1,322 @@
+import copy
+import hashlib
+import io
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+from models.Mesh import Mesh
+from models.Triangle import Triangle
+from models.TriangleBuffer import TriangleBuffer
+from core.BVH import FlatBvh
+from core.KDTree import FlatKdTree
+
+# Bump whenever the layout of a cache entry or of a cached structure changes; older entries are then never matched
+# again and are eventually removed by the eviction policy.
+CACHE_VERSION = 6
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(__file__), "..", ".scene_cache")
+
+
+class SceneCache:
+    """
+    Persistent on-disk cache for parsed scenes and built acceleration structures.
+
+    Every entry is a directory named after a SHA-256 key. Geometry entries are keyed by the content of the OBJ file
+    and of the MTL libraries it references and hold the TriangleBuffer arrays as .npy files, which are memory mapped
+    on load instead of being parsed. Structure entries are additionally keyed by the acceleration structure and its
+    builder parameters: flattened BVHs and kd-trees are stored as arrays, other structures are pickled with triangles and
+    meshes replaced by their indices. Several structures built over the same scene therefore share one geometry entry.
+
+    Editing a scene changes its content hash, so stale entries are simply never looked up again. Whenever the total
+    size of the cache exceeds max_size_bytes the least recently used entries are deleted.
+
+    Attributes:
+        directory (str): Directory holding the cache entries.
+        max_size_bytes (int): Upper bound for the total size of all entries.
+    """
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_size_bytes: int = 1024 * 1024 * 1024):
+        self.directory = os.path.abspath(directory)
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self._hashes = {}
+
+    def scene_hash(self, obj_path: str) -> str:
+        """
+        Hashes the OBJ file together with every MTL library it references.
+        """
+        stat = os.stat(obj_path)
+        memo_key = (os.path.abspath(obj_path), stat.st_mtime_ns, stat.st_size)
+        if memo_key not in self._hashes:
+            self._hashes[memo_key] = self._hash_files(obj_path)
+        return self._hashes[memo_key]
+
+    @staticmethod
+    def _hash_files(obj_path: str) -> str:
+        digest = hashlib.sha256(f"scene-cache-v{CACHE_VERSION}".encode())
+        with open(obj_path, 'rb') as f:
+            content = f.read()
+        digest.update(content)
+        base_dir = os.path.dirname(obj_path)
+        for line in content.decode(errors="ignore").splitlines():
+            if line.startswith("mtllib"):
+                for name in line.split()[1:]:
+                    mtl_path = os.path.join(base_dir, name)
+                    digest.update(name.encode())
+                    if os.path.exists(mtl_path):
+                        with open(mtl_path, 'rb') as f:
+                            digest.update(f.read())
+        return digest.hexdigest()
+
+    @staticmethod
+    def structure_key(scene_hash: str, params: dict) -> str:
+        return hashlib.sha256((scene_hash + json.dumps(params, sort_keys=True)).encode()).hexdigest()
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _open(self, key: str):
+        """
+        Returns the path of an existing entry and marks it as recently used, or None.
+        """
+        path = self._entry(key)
+        if not os.path.isfile(os.path.join(path, "meta.pickle")):
+            return None
+        os.utime(path)
+        return path
+
+    def _write(self, key: str, arrays: dict, meta: dict, files: dict = None) -> None:
+        """
+        Writes an entry to a temporary directory and moves it in place, so readers never see partial entries.
+        """
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+        try:
+            for name, value in arrays.items():
+                np.save(os.path.join(tmp, name + ".npy"), np.ascontiguousarray(value))
+            for name, payload in (files or {}).items():
+                with open(os.path.join(tmp, name), 'wb') as f:
+                    f.write(payload)
+            with open(os.path.join(tmp, "meta.pickle"), 'wb') as f:
+                pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL)
+            target = self._entry(key)
+            if os.path.exists(target):
+                shutil.rmtree(target, ignore_errors=True)
+            os.replace(tmp, target)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.evict()
+
+    @staticmethod
+    def _load_array(path: str, name: str) -> np.ndarray:
+        return np.load(os.path.join(path, name + ".npy"), mmap_mode='r')
+
+    def load_geometry(self, scene, obj_path: str) -> bool:
+        """
+        Restores scene.triangles, scene.faces and scene.mesh_list from the cache.
+
+        Returns:
+            bool: False on a cache miss, in which case the scene is left untouched.
+        """
+        path = self._open(self.scene_hash(obj_path))
+        if path is None:
+            return False
+        with open(os.path.join(path, "meta.pickle"), 'rb') as f:
+            meta = pickle.load(f)
+        vertices = self._load_array(path, "vertices")
+        buffer = TriangleBuffer.from_arrays(vertices=vertices,
+                                            edge1=self._load_array(path, "edge1"),
+                                            edge2=self._load_array(path, "edge2"),
+                                            normal=self._load_array(path, "normal"),
+                                            unit_norm=self._load_array(path, "unit_norm"),
+                                            material_index=self._load_array(path, "material_index"),
+                                            materials=meta["materials"])
+        mesh_ranges = np.load(os.path.join(path, "mesh_ranges.npy")).tolist()
+        mesh_bounds = np.load(os.path.join(path, "mesh_bounds.npy")).tolist()
+        faces = [Triangle(buffer, idx) for idx in range(len(buffer))]
+        meshes = []
+        for name, (first_face, last_face), (min_point, max_point) in zip(meta["mesh_names"], mesh_ranges, mesh_bounds):
+            mesh = Mesh(name)
+            mesh.set_bounding_box(min_point, max_point)
+            mesh.faces = faces[first_face:last_face]
+            meshes.append(mesh)
+        scene.triangles = buffer
+        scene.faces = faces
+        scene.mesh_list = meshes
+        return True
+
+    def store_geometry(self, scene, obj_path: str) -> None:
+        buffer = scene.triangles
+        mesh_ranges = []
+        for mesh in scene.mesh_list:
+            first_face = mesh.faces[0].index if mesh.faces else 0
+            mesh_ranges.append((first_face, first_face + len(mesh.faces)))
+        materials = []
+        for material in buffer.materials:
+            # The parser keeps the interleaved vertex data on every material; the buffer already holds it.
+            material = copy.copy(material)
+            material.vertices = []
+            materials.append(material)
+        arrays = {
+            "vertices": buffer.vertices,
+            "edge1": buffer.edge1,
+            "edge2": buffer.edge2,
+            "normal": buffer.normal,
+            "unit_norm": buffer.unit_norm,
+            "material_index": buffer.material_index,
+            "mesh_ranges": np.array(mesh_ranges, dtype=np.int64).reshape(-1, 2),
+            "mesh_bounds": np.array([(mesh.bounding_box_min, mesh.bounding_box_max) for mesh in scene.mesh_list],
+                                    dtype=np.float64).reshape(-1, 2, 3),
+        }
+        meta = {"materials": materials, "mesh_names": [mesh.name for mesh in scene.mesh_list]}
+        self._write(self.scene_hash(obj_path), arrays, meta)
+
+    @staticmethod
+    def structure_params(scene) -> dict:
+        params = {"acceleration_structure": scene.acceleration_structure, "bvh_builder": scene.bvh_builder}
+        if scene.acceleration_structure == "kd-tree":
+            params["kd_builder"] = scene.kd_builder
+        return params
+
+    def load_structure(self, scene, obj_path: str) -> bool:
+        """
+        Restores the acceleration structure of the scene from the cache. Geometry must already be loaded.
+
+        Returns:
+            bool: False on a cache miss, in which case the scene is left untouched.
+        """
+        path = self._open(self.structure_key(self.scene_hash(obj_path), self.structure_params(scene)))
+        if path is None:
+            return False
+        with open(os.path.join(path, "meta.pickle"), 'rb') as f:
+            meta = pickle.load(f)
+        if meta["kind"] == "flat_bvh":
+            flat = FlatBvh.from_arrays(bounds=self._load_array(path, "bounds"),
+                                       second_child=self._load_array(path, "second_child"),
+                                       first_primitive=self._load_array(path, "first_primitive"),
+                                       primitive_count=self._load_array(path, "primitive_count"),
+                                       primitives=[scene.faces[i] for i in self._load_array(path, "primitive_index").tolist()])
+            setattr(scene, meta["attribute"], flat)
+        elif meta["kind"] == "flat_kd_tree":
+            scene.flat_kd_tree = FlatKdTree.from_arrays(
+                bounds=self._load_array(path, "bounds"),
+                split_axis=self._load_array(path, "split_axis"),
+                split_position=self._load_array(path, "split_position"),
+                second_child=self._load_array(path, "second_child"),
+                first_primitive=self._load_array(path, "first_primitive"),
+                primitive_count=self._load_array(path, "primitive_count"),
+                primitives=[scene.faces[i] for i in self._load_array(path, "primitive_index").tolist()])
+        else:
+            with open(os.path.join(path, "structure.pickle"), 'rb') as f:
+                structure = _SceneUnpickler(f, scene).load()
+            setattr(scene, meta["attribute"], structure)
+        return True
+
+    def store_structure(self, scene, obj_path: str) -> None:
+        key = self.structure_key(self.scene_hash(obj_path), self.structure_params(scene))
+        for attribute in ("flat_bvh",):
+            flat = getattr(scene, attribute)
+            if flat is not None:
+                arrays = {
+                    "bounds": np.frombuffer(flat.bounds, dtype=np.float64),
+                    "second_child": np.frombuffer(flat.second_child, dtype=np.int32),
+                    "first_primitive": np.frombuffer(flat.first_primitive, dtype=np.int32),
+                    "primitive_count": np.frombuffer(flat.primitive_count, dtype=np.int32),
+                    "primitive_index": np.array([face.index for face in flat.primitives], dtype=np.int64),
+                }
+                self._write(key, arrays, {"kind": "flat_bvh", "attribute": attribute})
+                return
+        flat = scene.flat_kd_tree
+        if flat is not None:
+            arrays = {
+                "bounds": np.array(flat.bounds, dtype=np.float64),
+                "split_axis": np.frombuffer(flat.split_axis, dtype=np.int32),
+                "split_position": np.frombuffer(flat.split_position, dtype=np.float64),
+                "second_child": np.frombuffer(flat.second_child, dtype=np.int32),
+                "first_primitive": np.frombuffer(flat.first_primitive, dtype=np.int32),
+                "primitive_count": np.frombuffer(flat.primitive_count, dtype=np.int32),
+                "primitive_index": np.array([face.index for face in flat.primitives], dtype=np.int64),
+            }
+            self._write(key, arrays, {"kind": "flat_kd_tree"})
+            return
+        for attribute in ("grid", "two_level_bvh"):
+            structure = getattr(scene, attribute)
+            if structure is not None:
+                data = io.BytesIO()
+                _ScenePickler(data, scene).dump(structure)
+                self._write(key, {}, {"kind": "pickle", "attribute": attribute},
+                            files={"structure.pickle": data.getvalue()})
+                return
+
+    def entries(self):
+        """
+        Returns (path, size in bytes, last use time) of every complete entry, least recently used first.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self._entry(name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+            entries.append((path, size, os.path.getmtime(path)))
+        entries.sort(key=lambda entry: entry[2])
+        return entries
+
+    def evict(self) -> None:
+        """
+        Deletes least recently used entries until the cache fits in max_size_bytes.
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_size_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self) -> None:
+        for path, _, _ in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _scene_face(index: int):
+    raise RuntimeError("scene references can only be resolved by _SceneUnpickler")
+
+
+def _scene_mesh(index: int):
+    raise RuntimeError("scene references can only be resolved by _SceneUnpickler")
+
+
+class _ScenePickler(pickle.Pickler):
+    """
+    Pickles a structure built over a scene, storing triangles and meshes by index instead of by value.
+
+    References are reduced to _scene_face(index) / _scene_mesh(index) calls, which _SceneUnpickler resolves against
+    the scene being loaded. Unlike persistent_id, reducer_override runs after the memo lookup, so a triangle that
+    appears in many nodes is only reduced once.
+    """
+    def __init__(self, file, scene):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.mesh_positions = {id(mesh): idx for idx, mesh in enumerate(scene.mesh_list)}
+
+    def reducer_override(self, obj):
+        if isinstance(obj, Triangle):
+            return _scene_face, (obj.index,)
+        if isinstance(obj, Mesh):
+            return _scene_mesh, (self.mesh_positions[id(obj)],)
+        return NotImplemented
+
+
+class _SceneUnpickler(pickle.Unpickler):
+    def __init__(self, file, scene):
+        super().__init__(file)
+        self.scene = scene
+
+    def find_class(self, module, name):
+        if module == __name__ and name == "_scene_face":
+            return self.scene.faces.__getitem__
+        if module == __name__ and name == "_scene_mesh":
+            return self.scene.mesh_list.__getitem__
+        return super().find_class(module, name)
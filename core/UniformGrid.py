@@ -1,4 +1,8 @@
+from array import array
 from typing import List, Tuple
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from core.Ray import Ray
 from models.Triangle import Triangle
 
@@ -8,17 +12,30 @@ class UniformGrid:
       - bounding_box_min and bounding_box_max
       - inv_cell_size
       - resolution (nx, ny, nz)
-      - cells -> {(ix, iy, iz): [triangles]}
+      - cell_offsets, triangle_index -> compressed (CSR) cell storage: the triangles of the cell with linear index
+        c = ix + nx * (iy + ny * iz) are faces[triangle_index[k]] for cell_offsets[c] <= k < cell_offsets[c + 1]
+      - faces -> the triangles the grid was built over
+      - mailbox -> id of the last ray tested against each triangle, indexed like faces
+      - rays, triangle_tests, cell_visits -> traversal counters; rays doubles as the mailbox ray id and is never
+        reset
+      - sub_grids, cell_subgrid -> grids nested in overfull cells of a hierarchical grid (see
+        build_hierarchical_grid); cell_subgrid holds the sub_grids index of every cell, -1 for plain cells, and is
+        None for a single-level grid
     """
     def __init__(self,
                  bounding_box_min: List[float],
                  bounding_box_max: List[float],
                  resolution: Tuple[int,int,int],
-                 cells):
+                 cell_offsets,
+                 triangle_index,
+                 faces: List[Triangle],
+                 mailbox=None):
         self.bounding_box_min = bounding_box_min
         self.bounding_box_max = bounding_box_max
         self.resolution = resolution
-        self.cells = cells
+        self.cell_offsets = array('i', np.asarray(cell_offsets, dtype=np.int32).tobytes())
+        self.triangle_index = array('i', np.asarray(triangle_index, dtype=np.int32).tobytes())
+        self.faces = faces
 
         size_x = bounding_box_max[0] - bounding_box_min[0]
         size_y = bounding_box_max[1] - bounding_box_min[1]
@@ -35,88 +52,234 @@ class UniformGrid:
             1.0 / self.cell_size[1] if self.cell_size[1] else 1e3,
             1.0 / self.cell_size[2] if self.cell_size[2] else 1e3,
         )
+        self.mailbox = array('q', [-1]) * len(faces) if mailbox is None else mailbox
+        self.sub_grids = []
+        self.cell_subgrid = None
+        self.rays = 0
+        self.triangle_tests = 0
+        self.cell_visits = 0
+
+    def cell(self, ix: int, iy: int, iz: int):
+        """
+        Returns the indices into faces of the triangles overlapping cell (ix, iy, iz).
+        """
+        nx, ny, _ = self.resolution
+        c = ix + nx * (iy + ny * iz)
+        return self.triangle_index[self.cell_offsets[c]:self.cell_offsets[c + 1]]
+
+
+def grid_resolution(triangle_count: int, extent, density: float = 8.0, max_resolution: int = 128) -> Tuple[int,int,int]:
+    """
+    Chooses the grid resolution with the cube-root rule: cells are made cubic and their number is about
+    density * triangle_count, so n_i = extent_i * cbrt(density * triangle_count / volume) along each axis.
+
+    Flat extents are widened to 1e-3 of the largest one before computing the volume, so planar scenes still get
+    several cells along their two long axes.
+    """
+    extent = np.asarray(extent, dtype=np.float64)
+    largest = float(extent.max())
+    if triangle_count == 0 or largest < 1e-8:
+        return (1, 1, 1)
+    extent = np.maximum(extent, largest * 1e-3)
+    cells_per_unit = (density * triangle_count / float(np.prod(extent))) ** (1.0 / 3.0)
+    return tuple(int(n) for n in np.clip(np.round(extent * cells_per_unit), 1, max_resolution))
 
 
-def build_grid(faces: List[Triangle], desired_resolution: int = 20) -> UniformGrid:
+def build_grid(faces: List[Triangle], desired_resolution: int = None, density: float = 8.0,
+               workers: int = 1) -> UniformGrid:
+    """
+    Builds a uniform grid over faces.
+
+    With desired_resolution the longest axis gets that many cells and the other axes proportionally fewer; by default
+    the resolution comes from grid_resolution. Every triangle is inserted only into the cells its bounding box
+    overlaps that also pass an exact triangle-box overlap test (see triangle_box_overlap). With more than one worker,
+    the triangles are binned in parallel chunks; the cell lists are identical to the serial build.
+    """
     if not faces:
-        return UniformGrid([0,0,0], [0,0,0], (1,1,1), {})
-
-    global_min = [float('inf')] * 3
-    global_max = [float('-inf')] * 3
-    for tri in faces:
-        tri_min, tri_max = get_triangle_bbox(tri)
-        for i in range(3):
-            if tri_min[i] < global_min[i]:
-                global_min[i] = tri_min[i]
-            if tri_max[i] > global_max[i]:
-                global_max[i] = tri_max[i]
+        return UniformGrid([0,0,0], [0,0,0], (1,1,1), [0, 0], [], [])
 
+    indices = np.fromiter((tri.index for tri in faces), dtype=np.int64, count=len(faces))
+    vertices = faces[0].buffer.vertices[indices]
     padding = 1e-3
-    global_min = [gm - padding for gm in global_min]
-    global_max = [gm + padding for gm in global_max]
-
-    size_x = global_max[0] - global_min[0]
-    size_y = global_max[1] - global_min[1]
-    size_z = global_max[2] - global_min[2]
+    global_min = vertices.min(axis=(0, 1)) - padding
+    global_max = vertices.max(axis=(0, 1)) + padding
+    size = global_max - global_min
 
-    if max(size_x, size_y, size_z) < 1e-8:
+    if desired_resolution is None:
+        resolution = grid_resolution(len(faces), size, density)
+    elif max(size) < 1e-8:
         resolution = (1,1,1)
     else:
-        nx = max(1, desired_resolution)
-        ny = max(1, int(nx * size_y / size_x)) if size_x > 0 else 1
-        nz = max(1, int(nx * size_z / size_x)) if size_x > 0 else 1
-
-        max_dim = max(size_x, size_y, size_z)
-        if size_y == max_dim:
-            ny = desired_resolution
-            nx = max(1, int(ny * size_x / size_y))
-            nz = max(1, int(ny * size_z / size_y))
-        elif size_z == max_dim:
-            nz = desired_resolution
-            nx = max(1, int(nz * size_x / size_z))
-            ny = max(1, int(nz * size_y / size_z))
-
-        resolution = (nx, ny, nz)
-
-    cells = {}
-    for tri in faces:
-        tri_min, tri_max = get_triangle_bbox(tri)
-        min_ix, min_iy, min_iz = point_to_grid_index(tri_min, global_min, global_max, resolution)
-        max_ix, max_iy, max_iz = point_to_grid_index(tri_max, global_min, global_max, resolution)
-        if min_ix > max_ix:
-            min_ix, max_ix = max_ix, min_ix
-        if min_iy > max_iy:
-            min_iy, max_iy = max_iy, min_iy
-        if min_iz > max_iz:
-            min_iz, max_iz = max_iz, min_iz
+        longest = float(size.max())
+        resolution = tuple(max(1, int(desired_resolution * float(s) / longest)) for s in size)
+    if workers <= 1:
+        cell_offsets, triangle_index = _bin_triangles(vertices, global_min, size / np.array(resolution), resolution)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            cell_offsets, triangle_index = _bin_triangles(vertices, global_min, size / np.array(resolution),
+                                                          resolution, pool, workers)
+    return UniformGrid(global_min.tolist(), global_max.tolist(), resolution, cell_offsets, triangle_index, list(faces))
 
-        nx, ny, nz = resolution
-        for ix in range(min_ix, max_ix + 1):
-            if ix < 0 or ix >= nx:
+
+def build_hierarchical_grid(faces: List[Triangle], max_in_cell: int = 16, density: float = 1.0,
+                            sub_density: float = 8.0, workers: int = 1) -> UniformGrid:
+    """
+    Builds a two-level grid for scenes with uneven triangle density.
+
+    The top level is a coarse uniform grid with about density cells per triangle. Every top-level cell holding more
+    than max_in_cell triangles gets its own sub-grid spanning exactly that cell, with a resolution chosen by
+    grid_resolution from the cell's triangle count and sub_density. Sub-grids index the top level's faces and share
+    its mailbox, so hit_grid and occluded_grid walk both levels with the same 3D-DDA (see grid_cells). With more than
+    one worker, the top level is binned in parallel and the sub-grids are built concurrently.
+    """
+    grid = build_grid(faces, density=density, workers=workers)
+    if not faces:
+        return grid
+
+    indices = np.fromiter((tri.index for tri in faces), dtype=np.int64, count=len(faces))
+    vertices = faces[0].buffer.vertices[indices]
+    offsets = np.frombuffer(grid.cell_offsets, dtype=np.int32)
+    triangle_index = np.frombuffer(grid.triangle_index, dtype=np.int32)
+    nx, ny, nz = grid.resolution
+    cell_size = np.array(grid.cell_size)
+    cell_subgrid = np.full(nx * ny * nz, -1, dtype=np.int32)
+    top_index = []
+    top_counts = np.zeros(nx * ny * nz, dtype=np.int64)
+    with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as pool:
+        sub_cells = []
+        for c in range(nx * ny * nz):
+            cell_triangles = triangle_index[offsets[c]:offsets[c + 1]]
+            if len(cell_triangles) <= max_in_cell:
+                top_index.append(cell_triangles)
+                top_counts[c] = len(cell_triangles)
                 continue
-            for iy in range(min_iy, max_iy + 1):
-                if iy < 0 or iy >= ny:
-                    continue
-                for iz in range(min_iz, max_iz + 1):
-                    if iz < 0 or iz >= nz:
-                        continue
-                    cells.setdefault((ix, iy, iz), []).append(tri)
+            cell_min = np.array(grid.bounding_box_min) + np.array((c % nx, (c // nx) % ny, c // (nx * ny))) * cell_size
+            resolution = grid_resolution(len(cell_triangles), cell_size, sub_density)
+            binning = (vertices[cell_triangles], cell_min, cell_size / np.array(resolution), resolution)
+            cell_subgrid[c] = len(sub_cells)
+            sub_cells.append((cell_triangles, cell_min, resolution,
+                              pool.submit(_bin_triangles, *binning) if pool else _bin_triangles(*binning)))
+
+        for cell_triangles, cell_min, resolution, binned in sub_cells:
+            sub_offsets, sub_index = binned.result() if pool else binned
+            grid.sub_grids.append(UniformGrid(cell_min.tolist(), (cell_min + cell_size).tolist(), resolution, sub_offsets,
+                                              cell_triangles[sub_index], grid.faces, mailbox=grid.mailbox))
+
+    grid.cell_offsets = array('i', np.concatenate(([0], np.cumsum(top_counts))).astype(np.int32).tobytes())
+    grid.triangle_index = array('i', np.concatenate(top_index).astype(np.int32).tobytes())
+    grid.cell_subgrid = array('i', cell_subgrid.tobytes())
+    return grid
+
+
+def _bin_triangles(vertices: np.ndarray, grid_min: np.ndarray, cell_size: np.ndarray, resolution, pool=None,
+                   chunks: int = 1):
+    """
+    Inserts triangles into the cells of a grid starting at grid_min.
+
+    Candidate cells come from the index range of every triangle's bounding box, clipped to the grid, and are kept only
+    if they pass triangle_box_overlap. With a pool, the triangles are split into about 2 * chunks contiguous ranges
+    binned by the workers (see _bin_chunk); their results are concatenated in order before sorting, so the output does
+    not depend on the chunking.
+
+    Returns:
+        tuple: (cell_offsets, triangle_index) in the CSR layout of UniformGrid, with positions into vertices.
+    """
+    res = np.array(resolution)
+    if pool is None:
+        tri, cell_id = _bin_chunk(vertices, grid_min, cell_size, resolution, 0)
+    else:
+        starts = [int(part[0]) for part in np.array_split(np.arange(len(vertices)), 2 * chunks) if len(part)]
+        ends = starts[1:] + [len(vertices)]
+        parts = [pool.submit(_bin_chunk, vertices[start:end], grid_min, cell_size, resolution, start)
+                 for start, end in zip(starts, ends)]
+        tri, cell_id = (np.concatenate(arrays) for arrays in zip(*(part.result() for part in parts)))
 
-    return UniformGrid(global_min, global_max, resolution, cells)
+    order = np.argsort(cell_id, kind='stable')
+    cell_offsets = np.concatenate(([0], np.cumsum(np.bincount(cell_id, minlength=int(res.prod())))))
+    return cell_offsets, tri[order]
 
 
-def hit_grid(ray: Ray, grid: UniformGrid):
-    if not aabb_hit(ray, grid.bounding_box_min, grid.bounding_box_max):
-        return None
+def _bin_chunk(vertices: np.ndarray, grid_min: np.ndarray, cell_size: np.ndarray, resolution, first: int):
+    """
+    Overlapping (triangle, cell id) pairs of a contiguous range of triangles, in triangle order. Triangle positions
+    are offset by first, the position of vertices[0] in the whole list.
+    """
+    res = np.array(resolution)
+    lo = np.clip(((vertices.min(axis=1) - grid_min) / cell_size).astype(np.int64), 0, res - 1)
+    hi = np.clip(((vertices.max(axis=1) - grid_min) / cell_size).astype(np.int64), 0, res - 1)
+    span = hi - lo + 1
+    counts = span.prod(axis=1)
+    tri = np.repeat(np.arange(len(vertices)), counts)
+    local = np.arange(len(tri)) - np.repeat(np.cumsum(counts) - counts, counts)
+    span_x, span_y = span[tri, 0], span[tri, 1]
+    cell = lo[tri] + np.stack((local % span_x, (local // span_x) % span_y, local // (span_x * span_y)), axis=1)
+
+    keep = np.empty(len(tri), dtype=bool)
+    chunk = 1 << 18
+    for start in range(0, len(tri), chunk):
+        part = slice(start, start + chunk)
+        center = grid_min + (cell[part] + 0.5) * cell_size
+        keep[part] = triangle_box_overlap(vertices[tri[part]] - center[:, None, :], cell_size * 0.5)
+
+    tri, cell = tri[keep], cell[keep]
+    return tri + first, cell[:, 0] + res[0] * (cell[:, 1] + res[1] * cell[:, 2])
+
+
+def triangle_box_overlap(vertices: np.ndarray, half_size: np.ndarray) -> np.ndarray:
+    """
+    Separating axis test of Akenine-Moller between triangles and an axis-aligned box centered at the origin.
 
-    t_bounds = compute_entry_exit_times(ray, grid.bounding_box_min, grid.bounding_box_max,
-                                        ray.t_min, ray.t_max)
+    Parameters:
+        vertices (np.ndarray): (K, 3, 3) triangle vertices relative to their box center.
+        half_size (np.ndarray): (3,) half extent of the box. It is grown by a tiny margin so triangles lying exactly
+            on a cell face are kept in both neighbouring cells.
+
+    Returns:
+        np.ndarray: (K,) True where the triangle overlaps its box.
+    """
+    half_size = half_size * (1 + 1e-9) + 1e-12
+    overlap = np.all((vertices.min(axis=1) <= half_size) & (vertices.max(axis=1) >= -half_size), axis=1)
+
+    edges = np.stack((vertices[:, 1] - vertices[:, 0], vertices[:, 2] - vertices[:, 1],
+                      vertices[:, 0] - vertices[:, 2]), axis=1)
+    normal = np.cross(edges[:, 0], edges[:, 1])
+    overlap &= np.abs(np.einsum('ki,ki->k', normal, vertices[:, 0])) <= np.abs(normal) @ half_size
+
+    for axis in np.eye(3):
+        for j in range(3):
+            separating = np.cross(axis, edges[:, j])
+            projection = np.einsum('kvi,ki->kv', vertices, separating)
+            radius = np.abs(separating) @ half_size
+            overlap &= (projection.min(axis=1) <= radius) & (projection.max(axis=1) >= -radius)
+    return overlap
+
+
+def grid_cells(ray: Ray, grid: UniformGrid, t_min: float = None, t_max: float = None):
+    """
+    Walks the cells pierced by a ray in front-to-back order with a 3D-DDA, restricted to [t_min, t_max] (by default
+    [ray.t_min, ray.t_max]). Cells holding a sub-grid are replaced by the cells of the sub-grid, walked by the same
+    function over the parameter range spent inside the parent cell.
+
+    Yields:
+        tuple: (triangles, t_cell_enter, t_cell_exit) for every visited cell inside the grid, where triangles are
+        the cell's indices into grid.faces and [t_cell_enter, t_cell_exit] the ray parameter range spent inside
+        the cell.
+    """
+    if t_min is None:
+        if not aabb_hit(ray, grid.bounding_box_min, grid.bounding_box_max):
+            return
+        t_min, t_max = ray.t_min, ray.t_max
+
+    t_bounds = compute_entry_exit_times(ray, grid.bounding_box_min, grid.bounding_box_max, t_min, t_max)
     if not t_bounds:
-        return None
+        return
     t_enter, t_exit = t_bounds
     p_enter = ray.at(t_enter)
     ix, iy, iz = point_to_grid_index(p_enter, grid.bounding_box_min,
                                      grid.bounding_box_max, grid.resolution)
+    # the entry point lies on the grid boundary and may round to an index just outside it
+    nx, ny, nz = grid.resolution
+    ix, iy, iz = min(max(ix, 0), nx - 1), min(max(iy, 0), ny - 1), min(max(iz, 0), nz - 1)
 
     dirx, diry, dirz = ray.direction
     step_x = 1 if dirx >= 0 else -1
@@ -141,20 +304,19 @@ def hit_grid(ray: Ray, grid: UniformGrid):
     while tNextZ < t_enter:
         tNextZ += dtZ
 
-    closest_hit = None
     current_t = t_enter
 
-    nx, ny, nz = grid.resolution
+    cell_offsets = grid.cell_offsets
+    triangle_index = grid.triangle_index
+    cell_subgrid = grid.cell_subgrid
     while current_t <= t_exit:
         if 0 <= ix < nx and 0 <= iy < ny and 0 <= iz < nz:
-            cell_triangles = grid.cells.get((ix, iy, iz), [])
-            for tri in cell_triangles:
-                res = tri.hit(ray)
-                if res:
-                    t_hit, pt, face = res
-                    if ray.t_min <= t_hit <= ray.t_max:
-                        if (closest_hit is None) or (t_hit < closest_hit[0]):
-                            closest_hit = (t_hit, pt, face)
+            c = ix + nx * (iy + ny * iz)
+            cell_exit = min(tNextX, tNextY, tNextZ, t_exit)
+            if cell_subgrid is not None and cell_subgrid[c] >= 0:
+                yield from grid_cells(ray, grid.sub_grids[cell_subgrid[c]], current_t, cell_exit)
+            else:
+                yield triangle_index[cell_offsets[c]:cell_offsets[c + 1]], current_t, cell_exit
 
         if tNextX < tNextY and tNextX < tNextZ:
             ix += step_x
@@ -174,14 +336,64 @@ def hit_grid(ray: Ray, grid: UniformGrid):
         if current_t > t_exit:
             break
 
+
+def hit_grid(ray: Ray, grid: UniformGrid):
+    """
+    Finds the closest intersection by walking the cells front to back.
+
+    A triangle overlapping several cells is tested once per ray: its mailbox entry is stamped with the ray id on the
+    first test. The walk ends in the first cell whose exit distance lies beyond the closest hit, since no later cell
+    can hold a closer one.
+    """
+    grid.rays += 1
+    ray_id = grid.rays
+    mailbox = grid.mailbox
+    faces = grid.faces
+    tests = cells = 0
+    closest_hit = None
+    for cell_triangles, _, cell_exit in grid_cells(ray, grid):
+        cells += 1
+        for tri in cell_triangles:
+            if mailbox[tri] == ray_id:
+                continue
+            mailbox[tri] = ray_id
+            tests += 1
+            res = faces[tri].hit(ray)
+            if res:
+                t_hit, pt, face = res
+                if ray.t_min <= t_hit <= ray.t_max:
+                    if (closest_hit is None) or (t_hit < closest_hit[0]):
+                        closest_hit = (t_hit, pt, face)
+        if closest_hit is not None and closest_hit[0] <= cell_exit:
+            break
+
+    grid.triangle_tests += tests
+    grid.cell_visits += cells
     return closest_hit
 
 
-def get_triangle_bbox(tri: Triangle):
-    xs = [tri.v0[0], tri.v1[0], tri.v2[0]]
-    ys = [tri.v0[1], tri.v1[1], tri.v2[1]]
-    zs = [tri.v0[2], tri.v1[2], tri.v2[2]]
-    return ([min(xs), min(ys), min(zs)], [max(xs), max(ys), max(zs)])
+def occluded_grid(ray: Ray, grid: UniformGrid, t_max: float) -> bool:
+    """
+    Any-hit query: True as soon as a triangle is hit with ray.t_min <= t < t_max. Cells entered beyond t_max
+    are never visited, and triangles are mailboxed as in hit_grid.
+    """
+    grid.rays += 1
+    ray_id = grid.rays
+    mailbox = grid.mailbox
+    faces = grid.faces
+    for cell_triangles, cell_enter, _ in grid_cells(ray, grid):
+        if cell_enter >= t_max:
+            return False
+        grid.cell_visits += 1
+        for tri in cell_triangles:
+            if mailbox[tri] == ray_id:
+                continue
+            mailbox[tri] = ray_id
+            grid.triangle_tests += 1
+            res = faces[tri].hit(ray)
+            if res and ray.t_min <= res[0] < t_max:
+                return True
+    return False
 
 
 def point_to_grid_index(point: List[float],
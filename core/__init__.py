@@ -4,4 +4,5 @@ from .Scene import Scene
 from .Camera import Camera
 from .BVH import BvhNode
 from .KDTree import KdTreeNode
-from .UniformGrid import UniformGrid
\ No newline at end of file
+from .UniformGrid import UniformGrid
+from .SceneCache import SceneCache
\ No newline at end of file
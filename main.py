@@ -1,11 +1,18 @@
 import argparse
 import pygame
-import timeit
+import time
+from datetime import datetime
 import os
+import sys
 import psutil
 from core.Utils import *
 from core import *
 from models import *
+from core.BVH import report_bvh
+from core.KDTree import report_kd_tree
+from core.Benchmark import RssSampler, save_results
+from core.Statistics import COUNTERS, render_statistics
+from core.Sampler import SAMPLERS
 import json
 
 # Parse arguments
@@ -13,62 +20,180 @@ def parse_args():
     parser = argparse.ArgumentParser(description="Ray Tracer")
     parser.add_argument('--trace_algorithm', type=str, default="raytracing", choices=["raytracing", "pathtracing"],
                         help="Wybór algorytmu śledzenia promieni")
-    parser.add_argument('--acceleration_structure', type=str, default="none", choices=["bvh", "grid", "kd-tree", "mesh_bvh", "no-structure"],
+    parser.add_argument('--acceleration_structure', type=str, default="none", choices=["bvh", "grid", "hierarchical_grid", "kd-tree", "mesh_bvh", "no-structure"],
                         help="Wybór struktury akceleracji.")
     parser.add_argument('--scene', type=str, required=True, help="Ścieżka do pliku sceny.")
     parser.add_argument('--scene_config', type=str, required=True, help="Ścieżka do pliku konfiguracji sceny.")
     parser.add_argument('--width', type=int, default=640, help="Szerokość okna.")
     parser.add_argument('--height', type=int, default=360, help="Wysokość okna.")
     parser.add_argument('--fov', type=float, default=60, help="Pole widzenia kamery.")
+    parser.add_argument('--render_mode', type=str, default="scalar", choices=["scalar", "packet"],
+                        help="Tryb renderowania: pojedyncze promienie lub pakiety promieni (NumPy, bez struktury akceleracji).")
+    parser.add_argument('--bvh_builder', type=str, default="median", choices=["median", "sah"],
+                        help="Metoda budowy BVH: podział w medianie lub heurystyka SAH.")
+    parser.add_argument('--bvh_report', action='store_true', help="Wypisz statystyki zbudowanego BVH.")
+    parser.add_argument('--kd_builder', type=str, default="sah", choices=["median", "sah"],
+                        help="Metoda budowy kd-drzewa: podział w medianie lub heurystyka SAH.")
+    parser.add_argument('--kd_report', action='store_true', help="Wypisz statystyki zbudowanego kd-drzewa.")
+    parser.add_argument('--workers', type=int, default=1, help="Liczba procesów renderujących kafelki obrazu.")
+    parser.add_argument('--build_workers', type=int, default=1,
+                        help="Liczba procesów budujących strukturę akceleracji.")
+    parser.add_argument('--no_nee', action='store_true',
+                        help="Path tracing bez bezpośredniego próbkowania świateł powierzchniowych (next-event estimation).")
+    parser.add_argument('--no_russian_roulette', action='store_true',
+                        help="Path tracing bez rosyjskiej ruletki: każda ścieżka śledzona do maksymalnej głębokości.")
+    parser.add_argument('--sampler', type=str, default="stratified", choices=list(SAMPLERS),
+                        help="Generator próbek: niezależny, stratyfikowany lub ciąg Haltona.")
+    parser.add_argument('--max_depth', type=int, default=None,
+                        help="Maksymalna liczba przecięć wzdłuż promienia (domyślnie 3 dla ray tracingu, 7 dla path tracingu).")
+    parser.add_argument('--spp', type=int, default=5, help="Liczba próbek na piksel (bez próbkowania adaptacyjnego).")
+    parser.add_argument('--adaptive_sampling', action='store_true',
+                        help="Próbkowanie adaptacyjne: próbkuj piksel, dopóki wariancja luminancji nie spadnie poniżej progu.")
+    parser.add_argument('--min_spp', type=int, default=4, help="Minimalna liczba próbek na piksel w trybie adaptacyjnym.")
+    parser.add_argument('--max_spp', type=int, default=32, help="Maksymalna liczba próbek na piksel w trybie adaptacyjnym.")
+    parser.add_argument('--variance_threshold', type=float, default=1e-4,
+                        help="Próg wariancji średniej luminancji piksela w trybie adaptacyjnym.")
+    parser.add_argument('--no_cache', action='store_true',
+                        help="Wyłącz pamięć podręczną wczytanych scen i zbudowanych struktur akceleracji.")
+    parser.add_argument('--cache_dir', type=str, default=".scene_cache", help="Katalog pamięci podręcznej scen.")
+    parser.add_argument('--cache_size_mb', type=int, default=1024,
+                        help="Maksymalny rozmiar pamięci podręcznej scen w MB.")
+    parser.add_argument('--progressive', action='store_true',
+                        help="Renderowanie progresywne: podgląd blokowy, potem kolejne próbki, z odświeżaniem okna po każdym przebiegu.")
+    parser.add_argument('--preview_blocks', type=int, nargs='*', default=[16, 4],
+                        help="Rozmiary bloków kolejnych przebiegów podglądu w trybie progresywnym.")
+    parser.add_argument('--headless', action='store_true',
+                        help="Renderuj bez okna (np. na serwerze); wynik zapisz opcją --output.")
+    parser.add_argument('--output', type=str, default=None,
+                        help="Zapisz wyrenderowany obraz do pliku .png, .ppm lub .pfm (HDR, bez przycinania).")
+    parser.add_argument('--statistics', action='store_true',
+                        help="Po pomiarze wyrenderuj obraz ponownie ze zliczaniem promieni, odwiedzin węzłów i testów "
+                             "przecięć; zapisz statystyki i mapę cieplną w Efficiency_results/statistics.")
+    parser.add_argument('--heat_map', type=str, default="triangle_tests", choices=COUNTERS,
+                        help="Licznik na piksel pokazywany na mapie cieplnej.")
     return parser.parse_args()
 
+def peak_memory_mb(process):
+    """Szczytowe zużycie pamięci procesu (MB) od jego uruchomienia."""
+    info = process.memory_info()
+    if hasattr(info, "peak_wset"):  # Windows
+        return info.peak_wset / (1024 * 1024)
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
 CAMERA_CONFIG_PATH = "camera_config.json"
 
-pygame.init()
 args = parse_args()
+if args.render_mode == "packet" and args.acceleration_structure != "no-structure":
+    # Pakiety przecinane są ze wszystkimi trójkątami naraz; struktura akceleracji nie byłaby używana
+    if args.acceleration_structure != "none":
+        print(f"Packet mode tests every triangle, ignoring --acceleration_structure {args.acceleration_structure}.")
+    args.acceleration_structure = "no-structure"
+if not args.headless:
+    pygame.init()
 
 with open(CAMERA_CONFIG_PATH, 'r') as f:
     camera_config = json.load(f)
 
 width, height = args.width, args.height
 
-screen = pygame.display.set_mode((width, height))
-pygame.display.set_caption("Ray Tracer")
-clock = pygame.time.Clock()
-running = True
-
-scene = Scene(acceleration_structure=args.acceleration_structure)
+if args.headless:
+    # Bez okna: obraz trafia tylko do bufora ramki i ewentualnie do pliku --output
+    screen = None
+    running = False
+else:
+    screen = pygame.display.set_mode((width, height))
+    pygame.display.set_caption("Ray Tracer")
+    clock = pygame.time.Clock()
+    running = True
+
+scene_cache = None if args.no_cache else SceneCache(args.cache_dir, max_size_bytes=args.cache_size_mb * 1024 * 1024)
+scene = Scene(acceleration_structure=args.acceleration_structure, bvh_builder=args.bvh_builder,
+              kd_builder=args.kd_builder, cache=scene_cache, build_workers=args.build_workers)
 scene.load_from_file(args.scene)
-scene.load_config(args.scene_config)
-
-camera = Camera(scene, width, height, camera_origin=camera_config['camera_origin'], lookat=camera_config['lookat'], vup=camera_config['vup'], fov=args.fov, trace_algorithm=args.trace_algorithm)
-
 # Monitor RAM usage
 process = psutil.Process(os.getpid())
+load_stats = scene.load_stats
+load_peak_memory = peak_memory_mb(process)
+print(f"Scene: {load_stats['triangles']} triangles, geometry {load_stats['geometry_time']:.3f} s"
+      f"{' (cache)' if load_stats['geometry_cached'] else ''}, structure {load_stats['structure_time']:.3f} s"
+      f"{' (cache)' if load_stats['structure_cached'] else ''}, peak RAM {load_peak_memory:.2f} MB")
+if (args.bvh_report or args.kd_report) and load_stats['structure_cached']:
+    # Z pamięci podręcznej wczytywane są tylko spłaszczone struktury, bez drzew, z których liczony jest raport
+    print("Structure loaded from cache, rerun with --no_cache for a report.")
+elif args.bvh_report:
+    if scene.bvh_root:
+        report_bvh(scene.bvh_root, name=f"BVH ({args.bvh_builder})")
+    if scene.mesh_bvh_root:
+        report_bvh(scene.mesh_bvh_root, name=f"Mesh BVH ({args.bvh_builder})")
+if args.kd_report and scene.kd_root and not load_stats['structure_cached']:
+    report_kd_tree(scene.kd_root, name=f"kd-tree ({args.kd_builder})", build_time=load_stats['structure_time'])
+scene.load_config(args.scene_config)
 
-# Pomiar zużycia pamięci RAM przed renderingiem
-initial_memory = process.memory_info().rss
-
-# Measure rendering time
-render_time = timeit.timeit(lambda: camera.render(), number=1)
-
-# Pomiar zużycia pamięci RAM po renderingu
-final_memory = process.memory_info().rss
-average_memory_usage = (initial_memory + final_memory) / 2 / (1024 * 1024)  # w MB
-
-#Calculate Pixels per second
-total_pixels = camera.img_height * camera.img_width
-pps = total_pixels / render_time
-
-output_dir = "Efficiency_results"
-os.makedirs(output_dir, exist_ok=True)
-
-# Save results to a single file
-efficiency_filename = os.path.join(output_dir, f"{args.trace_algorithm}_{args.acceleration_structure}_efficiency.txt")
-with open(efficiency_filename, "w") as f:
-    f.write(f"Render time: {render_time:.6f} seconds\n")
-    f.write(f"Average Pixels per second: {pps:.0f} pps\n")
-    f.write(f"Average RAM usage during rendering: {average_memory_usage:.2f} MB\n")
+camera = Camera(scene, width, height, camera_origin=camera_config['camera_origin'], lookat=camera_config['lookat'], vup=camera_config['vup'], fov=args.fov, trace_algorithm=args.trace_algorithm, render_mode=args.render_mode, workers=args.workers,
+                samples_per_pixel=args.spp, adaptive_sampling=args.adaptive_sampling, min_spp=args.min_spp,
+                max_spp=args.max_spp, variance_threshold=args.variance_threshold, headless=args.headless,
+                next_event_estimation=not args.no_nee, russian_roulette=not args.no_russian_roulette,
+                sampler=args.sampler, max_depth=args.max_depth)
+
+# Pojedynczy pomiar z otwartym oknem; powtarzane pomiary bez okna wykonuje benchmark.py
+first_image_time = None
+with RssSampler() as sampler:
+    if args.progressive:
+        # Po każdym przebiegu obraz trafia do okna, a zamknięcie okna przerywa rendering
+        render_time = 0.0
+        for progress in camera.render_progressive(tuple(args.preview_blocks)):
+            render_time = progress["time"]
+            if first_image_time is None:
+                first_image_time = render_time
+            print(f"Pass {progress['pass']} ({progress['kind']}, {progress['spp']} spp): {render_time:.3f} s")
+            if screen is None:
+                continue
+            screen.blit(camera.canvas, (0, 0))
+            pygame.display.flip()
+            if any(event.type == pygame.QUIT for event in pygame.event.get()):
+                running = False
+                break
+    else:
+        start = time.perf_counter()
+        camera.render()
+        render_time = time.perf_counter() - start
+
+# Statystyki zbiera osobny, niemierzony przebieg, więc nie wpływają na zmierzony czas
+statistics = None
+if args.statistics:
+    ray_statistics = render_statistics(camera)
+    statistics = ray_statistics.as_dict()
+    statistics_dir = os.path.join("Efficiency_results", "statistics")
+    os.makedirs(statistics_dir, exist_ok=True)
+    scene_name = os.path.splitext(os.path.basename(args.scene))[0]
+    statistics_name = f"{args.trace_algorithm}_{args.acceleration_structure}_{scene_name}"
+    ray_statistics.save(os.path.join(statistics_dir, f"{statistics_name}.json"))
+    ray_statistics.save_heat_map(os.path.join(statistics_dir, f"{statistics_name}_{args.heat_map}.png"), args.heat_map)
+    print(f"Rays {statistics['rays']}, {statistics['node_visits_per_ray']:.1f} nodes, "
+          f"{statistics['aabb_tests_per_ray']:.1f} AABB tests, {statistics['triangle_tests_per_ray']:.1f} "
+          f"triangle tests per ray")
+
+# Wynik trafia do tych samych plików co wyniki benchmark.py (Efficiency_results/benchmark.json i .csv)
+samples = float(camera.spp_map.sum()) if camera.spp_map is not None else 0.0
+save_results([{
+    "source": "main.py (progressive)" if args.progressive else "main.py", "scene": args.scene,
+    "structure": args.acceleration_structure, "algorithm": args.trace_algorithm, "render_mode": args.render_mode,
+    "width": width, "height": height, "spp": args.spp, "sampler": args.sampler, "workers": args.workers, "build_workers": args.build_workers,
+    "triangles": load_stats['triangles'], "warmup": 0, "repeats": 1,
+    "build_time_median": None if load_stats['structure_cached'] else load_stats['structure_time'],
+    "build_time_stddev": 0.0, "render_time_median": render_time, "render_time_stddev": 0.0,
+    "render_time_min": render_time, "camera_rays_per_second": samples / render_time,
+    "pixels_per_second": camera.img_height * camera.img_width / render_time, "average_spp": camera.average_spp,
+    "peak_rss_mb": max(sampler.peak_mb, load_peak_memory), "python_heap_peak_mb": None,
+    "time_to_first_image": first_image_time, "timestamp": datetime.now().isoformat(timespec="seconds"),
+    "build_times": [], "render_times": [render_time], "statistics": statistics,
+}])
+
+if args.output:
+    camera.save_image(args.output)
+    print(f"Image saved to {args.output}")
 
 while running:
     for event in pygame.event.get():
@@ -0,0 +1,68 @@
+import numpy as np
+
+# Emissive color of a pywavefront material without a Ke statement.
+DEFAULT_EMISSIVE = [0., 0., 0., 1.]
+
+
+class MaterialRecord:
+    """
+    Shading view of one material, compiled from its pywavefront Material when the scene is loaded.
+
+    Colors are plain RGB lists and the values the integrators derive from a material (Fresnel reflectance at normal
+    incidence, light and glass tests) are computed once here instead of at every hit.
+
+    Attributes:
+        ambient, diffuse, specular, emission (List[float]): RGB colors (Ka, Kd, Ks, Ke).
+        shininess (float): Phong exponent (Ns).
+        optical_density (float): Index of refraction (Ni).
+        reflectance (float): Schlick's R_0 = ((1 - Ni) / (1 + Ni))^2.
+        illumination_model (int): The material's illum.
+        is_glass (bool): Illumination model 4 or 5, reflected or refracted by its Fresnel reflectance.
+        is_emissive (bool): The path tracer treats the material as a light: it is not a mirror (illumination model
+            3) and its RGBA emissive color differs from the default [0, 0, 0, 1].
+    """
+    __slots__ = ('ambient', 'diffuse', 'specular', 'emission', 'shininess', 'optical_density', 'reflectance',
+                 'illumination_model', 'is_glass', 'is_emissive')
+
+    def __init__(self, material):
+        self.ambient = [float(x) for x in material.ambient[:3]]
+        self.diffuse = [float(x) for x in material.diffuse[:3]]
+        self.specular = [float(x) for x in material.specular[:3]]
+        self.emission = [float(x) for x in material.emissive[:3]]
+        self.shininess = float(material.shininess)
+        self.optical_density = float(material.optical_density)
+        self.reflectance = ((1 - self.optical_density) / (1 + self.optical_density)) ** 2
+        self.illumination_model = int(material.illumination_model)
+        self.is_glass = self.illumination_model in (4, 5)
+        self.is_emissive = self.illumination_model != 3 and list(material.emissive) != DEFAULT_EMISSIVE
+
+
+class MaterialTable:
+    """
+    The materials of a TriangleBuffer compiled for shading: one MaterialRecord per material for the scalar
+    integrators and the same values as NumPy columns for the packet kernels, both indexed by the buffer's
+    material_index.
+
+    Attributes:
+        records (List[MaterialRecord]): Record of every material.
+        ambient, diffuse, specular, emission (np.ndarray): (M, 3) colors.
+        shininess, optical_density, reflectance (np.ndarray): (M,) float columns of the records.
+        illumination_model (np.ndarray): (M,) illumination models.
+        is_glass, is_emissive (np.ndarray): (M,) boolean columns of the records.
+    """
+    def __init__(self, materials: list):
+        self.records = [MaterialRecord(material) for material in materials]
+        for name in ('ambient', 'diffuse', 'specular', 'emission'):
+            setattr(self, name, np.array([getattr(record, name) for record in self.records],
+                                         dtype=np.float64).reshape(-1, 3))
+        for name in ('shininess', 'optical_density', 'reflectance'):
+            setattr(self, name, np.array([getattr(record, name) for record in self.records], dtype=np.float64))
+        self.illumination_model = np.array([record.illumination_model for record in self.records], dtype=np.int64)
+        self.is_glass = np.array([record.is_glass for record in self.records], dtype=bool)
+        self.is_emissive = np.array([record.is_emissive for record in self.records], dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __getitem__(self, material_id: int) -> MaterialRecord:
+        return self.records[material_id]
@@ -0,0 +1,98 @@
+from typing import List
+import numpy as np
+from core.Utils import *
+from core.Ray import *
+
+class MeshInstance:
+    """
+    Places a Mesh in the scene with an affine transform, so one mesh can appear many times without copying its
+    triangles. The mesh itself stays in object space.
+
+    Attributes:
+        mesh (Mesh): The instanced mesh.
+        transform (np.ndarray): (4, 4) object-to-world matrix.
+        inverse (np.ndarray): (4, 4) world-to-object matrix.
+        normal_matrix (np.ndarray): (3, 3) inverse transpose of the linear part, maps object normals to world space.
+        is_identity (bool): True for the identity transform; rays and hits are then used without conversion.
+        bounding_box_min (List[float]): World-space minimum (x, y, z) of the transformed mesh bounding box.
+        bounding_box_max (List[float]): World-space maximum (x, y, z) of the transformed mesh bounding box.
+    """
+    def __init__(self, mesh, transform=None) -> None:
+        self.mesh = mesh
+        self.set_transform(np.eye(4) if transform is None else transform)
+
+    def set_transform(self, transform) -> None:
+        """
+        Sets the object-to-world matrix and updates the inverse matrices and the world bounding box.
+        """
+        self.transform = np.asarray(transform, dtype=np.float64).reshape(4, 4)
+        self.inverse = np.linalg.inv(self.transform)
+        self.normal_matrix = self.inverse[:3, :3].T
+        self.is_identity = bool(np.array_equal(self.transform, np.eye(4)))
+        self._to_object = self.inverse[:3].tolist()
+        self.update_bounds()
+
+    def update_bounds(self) -> None:
+        """
+        Recomputes the world bounding box from the eight transformed corners of the mesh bounding box.
+        """
+        lo, hi = self.mesh.bounding_box_min, self.mesh.bounding_box_max
+        corners = np.array([[x, y, z] for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+        world = corners @ self.transform[:3, :3].T + self.transform[:3, 3]
+        self.bounding_box_min = world.min(axis=0).tolist()
+        self.bounding_box_max = world.max(axis=0).tolist()
+
+    def ray_to_object(self, ray: Ray) -> Ray:
+        """
+        Transforms a world ray into object space. The direction is not normalized, so t values stay the same.
+        """
+        (a, b, c, d), (e, f, g, h), (i, j, k, l) = self._to_object
+        ox, oy, oz = ray.origin
+        dx, dy, dz = ray.direction
+        return Ray([a * ox + b * oy + c * oz + d, e * ox + f * oy + g * oz + h, i * ox + j * oy + k * oz + l],
+                   [a * dx + b * dy + c * dz, e * dx + f * dy + g * dz, i * dx + j * dy + k * dz],
+                   ray.t_min, ray.t_max)
+
+
+class InstanceTriangle:
+    """
+    World-space view of a triangle hit through a transformed MeshInstance.
+
+    Shading reads vertices, normals and material from the hit face; this view forwards the material, material record
+    and buffer index of the object-space triangle and transforms its geometry on access.
+
+    Attributes:
+        face (Triangle): The object-space triangle.
+        instance (MeshInstance): The instance it was hit through.
+    """
+    __slots__ = ('face', 'instance')
+
+    def __init__(self, face, instance: MeshInstance):
+        self.face = face
+        self.instance = instance
+
+    @property
+    def index(self) -> int:
+        return self.face.index
+
+    @property
+    def material(self):
+        return self.face.material
+
+    @property
+    def record(self):
+        return self.face.record
+
+    @property
+    def vertices(self) -> List[List[float]]:
+        transform = self.instance.transform
+        vertices = self.face.buffer.vertices[self.face.index]
+        return (vertices @ transform[:3, :3].T + transform[:3, 3]).tolist()
+
+    @property
+    def normal(self) -> List[float]:
+        return (self.instance.normal_matrix @ self.face.buffer.normal[self.face.index]).tolist()
+
+    @property
+    def unit_norm(self) -> List[float]:
+        return norm(self.normal)
@@ -6,25 +6,79 @@ class Triangle:
     """
     Represents a triangle in 3D space for ray tracing purposes.
 
+    A Triangle is a view into a scene-wide TriangleBuffer: it only stores the buffer and its own index, and reads
+    vertices, edges, normals and material from the buffer arrays on access.
+
     Attributes:
+        buffer: The TriangleBuffer holding the triangle data.
+        index: Position of the triangle within the buffer.
         v0,v1,v2: The three vertices of the triangle.
+        edge1,edge2: The edges v1 - v0 and v2 - v0.
         normal: The normal vector of the triangle's plane.
         unit_norm: The unit (normalized) normal vector.
         material: The material properties of the triangle.
+        record: The material compiled for shading, see MaterialRecord.
     """
-    def __init__(self, v0, v1, v2, material = None):
-        self.v0, self.v1, self.v2 = v0, v1, v2
-        self.normal = cross(sub(v1, v0), sub(v2, v0))
-        self.unit_norm = norm(self.normal)
-        self.material = material
+    __slots__ = ('buffer', 'index')
+
+    def __init__(self, buffer, index: int):
+        self.buffer = buffer
+        self.index = index
+
+    @property
+    def vertices(self) -> List[List[float]]:
+        """
+        All three vertices at once, cheaper than reading v0, v1 and v2 separately.
+        """
+        return self.buffer.vertices[self.index].tolist()
+
+    @property
+    def v0(self) -> List[float]:
+        return self.buffer.vertices[self.index, 0].tolist()
+
+    @property
+    def v1(self) -> List[float]:
+        return self.buffer.vertices[self.index, 1].tolist()
+
+    @property
+    def v2(self) -> List[float]:
+        return self.buffer.vertices[self.index, 2].tolist()
+
+    @property
+    def edge1(self) -> List[float]:
+        return self.buffer.edge1[self.index].tolist()
+
+    @property
+    def edge2(self) -> List[float]:
+        return self.buffer.edge2[self.index].tolist()
+
+    @property
+    def normal(self) -> List[float]:
+        return self.buffer.normal[self.index].tolist()
+
+    @property
+    def unit_norm(self) -> List[float]:
+        return self.buffer.unit_norm[self.index].tolist()
+
+    @property
+    def material(self):
+        return self.buffer.materials[self.buffer.material_index[self.index]]
+
+    @property
+    def record(self):
+        """
+        The triangle's material compiled for shading (a MaterialRecord).
+        """
+        return self.buffer.material_table.records[self.buffer.material_index[self.index]]
 
     def hit(self, ray: Ray):
         """
         Determines if a ray intersects with the triangle using the Möller-Trumbore algorithm.
         """
         EPSILON = 1e-8
-        edge1 = sub(self.v1, self.v0)
-        edge2 = sub(self.v2, self.v0)
+        v0 = self.buffer.vertices[self.index, 0].tolist()
+        edge1 = self.buffer.edge1[self.index].tolist()
+        edge2 = self.buffer.edge2[self.index].tolist()
         h = cross(ray.direction, edge2)
         a = dot(edge1, h)
 
@@ -32,7 +86,7 @@ class Triangle:
             return None
 
         f = 1.0 / a
-        s = sub(ray.origin, self.v0)
+        s = sub(ray.origin, v0)
         u = f * dot(s, h)
 
         if u < 0.0 or u > 1.0:
@@ -51,4 +105,4 @@ class Triangle:
             intersection_point = ray.at(t)
             return t, intersection_point, self
         else:
-            return None
\ No newline at end of file
+            return None
@@ -0,0 +1,61 @@
+import numpy as np
+from models.Material import MaterialTable
+
+
+class TriangleBuffer:
+    """
+    Scene-wide structure-of-arrays storage for triangles.
+
+    All triangles of a scene live in a handful of contiguous float arrays that are built once when the scene is
+    loaded. Triangle objects are thin views (buffer, index) into this storage, so per-face memory is a few dozen
+    bytes instead of a set of Python lists, and batched kernels can use the arrays directly.
+
+    Attributes:
+        vertices (np.ndarray): (N, 3, 3) vertex positions of every triangle.
+        v0 (np.ndarray): (N, 3) first vertex of every triangle (a view into vertices).
+        edge1 (np.ndarray): (N, 3) v1 - v0.
+        edge2 (np.ndarray): (N, 3) v2 - v0.
+        normal (np.ndarray): (N, 3) edge1 x edge2 (not normalized).
+        unit_norm (np.ndarray): (N, 3) normalized normals.
+        material_index (np.ndarray): (N,) index into materials for every triangle.
+        materials (list): Materials referenced by material_index.
+        material_table (MaterialTable): The materials compiled for shading, indexed like materials.
+    """
+    def __init__(self, vertices: np.ndarray, material_index: np.ndarray, materials: list):
+        self.vertices = np.ascontiguousarray(vertices, dtype=np.float64).reshape(-1, 3, 3)
+        self.v0 = self.vertices[:, 0]
+        self.edge1 = self.vertices[:, 1] - self.v0
+        self.edge2 = self.vertices[:, 2] - self.v0
+        self.normal = np.cross(self.edge1, self.edge2)
+        length = np.linalg.norm(self.normal, axis=1, keepdims=True)
+        assert np.all(length > 0), "Cannot normalize zero-length vector"
+        self.unit_norm = self.normal / length
+        self.material_index = np.asarray(material_index, dtype=np.int32)
+        self.materials = list(materials)
+        self.material_table = MaterialTable(self.materials)
+
+    @staticmethod
+    def from_arrays(vertices, edge1, edge2, normal, unit_norm, material_index, materials):
+        """
+        Creates a buffer from precomputed arrays (e.g. memory-mapped from the scene cache) without copying them.
+        """
+        buffer = TriangleBuffer.__new__(TriangleBuffer)
+        buffer.vertices = vertices
+        buffer.v0 = vertices[:, 0]
+        buffer.edge1 = edge1
+        buffer.edge2 = edge2
+        buffer.normal = normal
+        buffer.unit_norm = unit_norm
+        buffer.material_index = material_index
+        buffer.materials = list(materials)
+        buffer.material_table = MaterialTable(buffer.materials)
+        return buffer
+
+    def __len__(self) -> int:
+        return len(self.v0)
+
+    def bounding_boxes(self):
+        """
+        Returns the (N, 3) per-triangle bounding box minima and maxima.
+        """
+        return self.vertices.min(axis=1), self.vertices.max(axis=1)
@@ -1,2 +1,5 @@
 from .Mesh import Mesh
-from .Triangle import Triangle
\ No newline at end of file
+from .Triangle import Triangle
+from .TriangleBuffer import TriangleBuffer
+from .Material import MaterialRecord, MaterialTable
+from .MeshInstance import MeshInstance, InstanceTriangle
\ No newline at end of file